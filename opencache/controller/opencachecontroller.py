@@ -226,12 +226,16 @@ class Controller():
         Handle the three permutations of node descriptions (all, list or single). Do final calculations and conversion
         for the aggregate statistic.
 
+        Latency percentiles (e.g. 'total_latency_hit_ttfb_p99') are read from the latency histograms of every
+        cache instance merged together, as percentiles themselves cannot be combined.
+
         """
         try:
             total_result = dict([('total_cache_miss', 0), ('total_cache_miss_size', 0), ('total_cache_hit', 0),
                 ('total_cache_hit_size', 0), ('total_cache_object', 0), ('total_cache_object_size', 0),
                 ('start', 0), ('stop', 0), ('pause', 0), ('total_response_count',0), ('total_node_id_count',0),
-                ('total_expr_count',0), ('node_id_seen', set()), ('expr_seen', set()), ('node_expr_pairs_seen', set())])
+                ('total_expr_count',0), ('node_id_seen', set()), ('expr_seen', set()), ('node_expr_pairs_seen', set()),
+                ('latency', dict())])
             if rpc.node_id == '*':
                 for node in self._state.list_nodes():
                     total_result = self._stat_node(rpc.expr, node, total_result)
@@ -246,6 +250,9 @@ class Controller():
             total_result['node_id_seen'] = list(total_result['node_id_seen'])
             total_result['expr_seen'] = list(total_result['expr_seen'])
             total_result['node_expr_pairs_seen'] = list(total_result['node_expr_pairs_seen'])
+            for kind, histogram in total_result.pop('latency').items():
+                for name, value in histogram.percentiles().items():
+                    total_result['total_latency_' + kind + '_' + name] = value
             return total_result
         except Exception as e:
             raise lib.RemoteProcedureCallError(data={'exception' : str(e), 'node_id' : str(node.node_id), 'expr' : str(rpc.expr)}, code='-32603')
@@ -288,6 +295,8 @@ class Controller():
             total_result['total_cache_hit_size'] += int(result.cache_hit_size)
             total_result['total_cache_object'] += int(result.cache_object)
             total_result['total_cache_object_size'] += int(result.cache_object_size)
+            for kind, counts in (result.latency or dict()).items():
+                total_result['latency'].setdefault(kind, lib.LatencyHistogram()).merge_dict(counts)
             return total_result
         except Exception:
             pass
@@ -405,13 +414,19 @@ class Notification():
     def listen(self):
         """Handle notifications from cache instances."""
         while True:
-            notification = self._socket.recv_json()
-            if notification['method'] == 'redir' and  notification['id'] == None:
-                self._handle_redir_message(notification)
-            elif notification['method'] == 'stat' and  notification['id'] == None:
-                self._handle_stat_message(notification)
-            elif notification['method'] == 'alert' and  notification['id'] == None:
-                self._handle_alert_message(notification)
+            self._handle_message(self._socket.recv_json())
+
+    def _handle_message(self, notification):
+        """Handle a notification, or each of the notifications sent together in a batch."""
+        if notification['method'] == 'batch' and  notification['id'] == None:
+            for message in notification['params']['messages']:
+                self._handle_message(message)
+        elif notification['method'] == 'redir' and  notification['id'] == None:
+            self._handle_redir_message(notification)
+        elif notification['method'] == 'stat' and  notification['id'] == None:
+            self._handle_stat_message(notification)
+        elif notification['method'] == 'alert' and  notification['id'] == None:
+            self._handle_alert_message(notification)
 
     def _handle_redir_message(self, notification):
         """Handle a redirect message. Either add the redirect or remove it, depending on the message."""
@@ -430,14 +445,21 @@ class Notification():
         self._controller._state.add_stat(notification['params']['expr'], notification['params']['node_id'], notification['params']['status'],
             notification['params']['avg_load'], notification['params']['cache_miss'], notification['params']['cache_miss_size'],
             notification['params']['cache_hit'], notification['params']['cache_hit_size'],  notification['params']['cache_object'],
-            notification['params']['cache_object_size'])
+            notification['params']['cache_object_size'], notification['params'].get('latency'))
 
     def _handle_alert_message(self, notification):
-        """Handle an alert and print warning."""
+        """Handle an alert and print warning. An alert may summarise several of the same type, with the greatest value seen."""
         if notification['params']['type'] == 'load':
-            self._controller.print_warn(TAG, 'Load notification received from node %s with expression %s. Load at: %s requests per second.' % (notification['params']['node_id'], notification['params']['expr'], notification['params']['value']))
+            self._controller.print_warn(TAG, 'Load notification received from node %s with expression %s. Load at: %s requests per second.%s' % (notification['params']['node_id'], notification['params']['expr'], notification['params']['value'], self._get_alert_summary(notification, 'requests per second')))
         elif notification['params']['type'] == 'disk':
-            self._controller.print_warn(TAG, 'Disk notification received from node %s with expression %s. Disk usage at: %s bytes.' % (notification['params']['node_id'], notification['params']['expr'], notification['params']['value']))
+            self._controller.print_warn(TAG, 'Disk notification received from node %s with expression %s. Disk usage at: %s bytes.%s' % (notification['params']['node_id'], notification['params']['expr'], notification['params']['value'], self._get_alert_summary(notification, 'bytes')))
+
+    def _get_alert_summary(self, notification, unit):
+        """Describe the alerts an alert notification summarises, if there were several."""
+        count = notification['params'].get('count', 1)
+        if count <= 1:
+            return ''
+        return ' (%s alerts in %d seconds, peaking at %s %s.)' % (count, notification['params'].get('period', 0), notification['params']['max'], unit)
 
 
 if __name__ == '__main__':
@@ -31,6 +31,7 @@ class State:
             self.cache_hit_size = None
             self.cache_object = None
             self.cache_object_size = None
+            self.latency = None
 
     _client = None
     _database = None
@@ -151,15 +152,17 @@ class State:
         except Exception:
             pass
 
-    def add_stat(self, expr, node_id, status, avg_load, cache_miss, cache_miss_size, cache_hit, cache_hit_size, cache_object, cache_object_size):
+    def add_stat(self, expr, node_id, status, avg_load, cache_miss, cache_miss_size, cache_hit, cache_hit_size, cache_object, cache_object_size, latency=None):
         """Add a stat response to the database.
 
-        Also, update a node as we have seen a periodic response from it.
+        Also, update a node as we have seen a periodic response from it. The 'latency' histograms (if any)
+        are stored as given, so that they can be merged with those of other cache instances.
 
         """
         self._database.statistics.update({'node_id' : int(node_id), 'expr' : expr}, { '$set' : {'status': status, 'avg_load' : avg_load,
             'cache_miss' : cache_miss, 'cache_miss_size' : cache_miss_size, 'cache_hit' : cache_hit, 'cache_hit_size' : cache_hit_size,
-            'cache_object' : cache_object, 'cache_object_size' : cache_object_size, 'seen' : datetime.datetime.utcnow()}}, upsert=True, multi=False)
+            'cache_object' : cache_object, 'cache_object_size' : cache_object_size, 'latency' : latency or dict(),
+            'seen' : datetime.datetime.utcnow()}}, upsert=True, multi=False)
         self.update_node(node_id)
 
     def get_stat(self, expr, node_id):
@@ -182,6 +185,7 @@ class State:
             stat.cache_hit_size = result['cache_hit_size']
             stat.cache_object = result['cache_object']
             stat.cache_object_size = result['cache_object_size']
+            stat.latency = result.get('latency')
             return stat
         except Exception:
             return None
@@ -2,6 +2,7 @@
 
 """opencacheredis.py - Manages the state of the controller using a Redis database."""
 
+import json
 import time
 
 import redis
@@ -30,6 +31,7 @@ class State:
             self.cache_hit_size = None
             self.cache_object = None
             self.cache_object_size = None
+            self.latency = None
 
     _database = None
     _config = None
@@ -141,10 +143,11 @@ class State:
         except Exception: 
             pass
 
-    def add_stat(self, expr, node_id, status, avg_load, cache_miss, cache_miss_size, cache_hit, cache_hit_size, cache_object, cache_object_size):
+    def add_stat(self, expr, node_id, status, avg_load, cache_miss, cache_miss_size, cache_hit, cache_hit_size, cache_object, cache_object_size, latency=None):
         """Add a stat response to the database. 
 
-        Also, update a node as we have seen a periodic response from it.
+        Also, update a node as we have seen a periodic response from it. The 'latency' histograms (if any)
+        are stored as JSON, so that they can be merged with those of other cache instances.
 
         """
         pipe = self._database.pipeline()
@@ -152,7 +155,7 @@ class State:
             key = 'stat:' + str(expr) + ':node:' + str(node_id)
             self._database.delete(key)
             pipe.rpush(key, str(status), str(avg_load), str(cache_miss), str(cache_miss_size), str(cache_hit), str(cache_hit_size), 
-                str(cache_object), str(cache_object_size))
+                str(cache_object), str(cache_object_size), json.dumps(latency or dict()))
             pipe.expire(key, self._config['node_timeout'])
             pipe.execute()
         except Exception:
@@ -175,6 +178,8 @@ class State:
             stat.cache_hit_size = result[5]
             stat.cache_object = result[6]
             stat.cache_object_size = result[7]
+            if len(result) > 8:
+                stat.latency = json.loads(result[8])
             return stat
         except Exception:
             return None
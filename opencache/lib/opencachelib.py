@@ -2,16 +2,22 @@
 
 """opencachelib.py: Core OpenCache functionality shared between controller and node."""
 
+import errno
 import httplib
 import json
+import math
 import os
 import shutil
+import threading
 import urllib2
 import logging
 import logging.handlers
 
 TAG = "lib"
 
+LATENCY_SUB_BUCKETS = 32
+LATENCY_PERCENTILES = [('p50', 50.0), ('p95', 95.0), ('p99', 99.0), ('p999', 99.9)]
+
 def setup_logger(log_path, name, verbosity):
     """Setup logging functionality to both console and a rotating log file."""
     logger = logging.getLogger('opencache')
@@ -33,12 +39,13 @@ def setup_logger(log_path, name, verbosity):
     return logger
 
 def create_directory(path):
-    """Create a new directory if it doesn't exist."""
+    """Create a new directory if it doesn't exist (including if another thread or process creates it first)."""
     while not os.path.isdir(path):
         try:
             os.makedirs(path)
-        except Exception:
-            raise
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
 
 def delete_directory(path):
     """Removed an existing directory used for storing cached content specific to this HTTP server's expression."""
@@ -48,6 +55,23 @@ def delete_directory(path):
         except Exception:
             raise
 
+def config_enabled(value):
+    """Interpret a configuration value (e.g. 'true', 'yes', '1') as a boolean flag."""
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'on')
+
+def shard_path(root, name, levels, width=2):
+    """Get the path of a file within a directory tree sharded by the leading characters of its name.
+
+    Each of the 'levels' of subdirectories is named by the next 'width' characters of the name, so that
+    (for two levels) 'abcdef' is kept at 'root/ab/cd/abcdef'. With no levels, the file is kept in 'root'.
+
+    """
+    parts = [root]
+    for level in range(levels):
+        parts.append(name[level * width:(level + 1) * width])
+    parts.append(name)
+    return os.path.join(*parts)
+
 def expr_split(expr):
     expr_split = expr.split("/", 1)
     root = expr_split[0]
@@ -189,4 +213,100 @@ class RemoteProcedureCallError(Exception):
         self.code = code
 
     def __str__(self):
-        return repr(self.data)
\ No newline at end of file
+        return repr(self.data)
+
+
+class LatencyHistogram:
+    """A histogram of latencies, recorded to the microsecond, from which percentiles can be read.
+
+    Latencies are counted in log-linear buckets (as in an HDR histogram): below 64 microseconds each
+    bucket holds a single value, and above that each power of two is split into LATENCY_SUB_BUCKETS
+    buckets, so a percentile is accurate to within about 3%. Only buckets in use are held. Histograms
+    (unlike percentiles) can be merged, such as those of several worker processes or nodes, and are
+    passed between them as a dict.
+
+    """
+
+    def __init__(self, counts=None):
+        """Initialise an empty histogram, or one holding the bucket counts of 'to_dict'."""
+        self._counts = dict()
+        self._lock = threading.Lock()
+        if counts:
+            self.merge_dict(counts)
+
+    def record(self, seconds):
+        """Count a latency, given in seconds."""
+        bucket = _latency_bucket(max(0, int(seconds * 1000000)))
+        with self._lock:
+            self._counts[bucket] = self._counts.get(bucket, 0) + 1
+
+    def merge(self, other):
+        """Add the counts of another histogram to this one."""
+        self.merge_dict(other.to_dict())
+
+    def merge_dict(self, counts):
+        """Add the bucket counts of 'to_dict' (whose keys may have become strings, such as in JSON) to this histogram."""
+        with self._lock:
+            for bucket, count in counts.items():
+                bucket = int(bucket)
+                self._counts[bucket] = self._counts.get(bucket, 0) + int(count)
+
+    def count(self):
+        """Return the number of latencies recorded."""
+        return sum(self._counts.values())
+
+    def percentile(self, percent):
+        """Return the latency (in seconds) that the given percentage of those recorded are no greater than, or 0 if none are."""
+        with self._lock:
+            counts = sorted(self._counts.items())
+        total = sum(count for bucket, count in counts)
+        if total == 0:
+            return 0.0
+        rank = max(1, int(math.ceil(percent / 100.0 * total)))
+        seen = 0
+        for bucket, count in counts:
+            seen += count
+            if seen >= rank:
+                return _latency_bucket_top(bucket) / 1000000.0
+        return _latency_bucket_top(counts[-1][0]) / 1000000.0
+
+    def cumulative(self, bounds):
+        """Return the number of latencies no greater than each of the given bounds (in seconds), and the sum of all of them.
+
+        Each latency is taken to be the greatest of its bucket, so the sum is an estimate (to within about 3%).
+
+        """
+        with self._lock:
+            counts = sorted(self._counts.items())
+        totals = [0] * len(bounds)
+        total = 0.0
+        for bucket, count in counts:
+            top = _latency_bucket_top(bucket) / 1000000.0
+            total += top * count
+            for i, bound in enumerate(bounds):
+                if top <= bound:
+                    totals[i] += count
+        return totals, total
+
+    def percentiles(self):
+        """Return a dict of the LATENCY_PERCENTILES (e.g. 'p99') of this histogram, in seconds."""
+        return dict((name, self.percentile(percent)) for name, percent in LATENCY_PERCENTILES)
+
+    def to_dict(self):
+        """Return the count held in each bucket in use."""
+        with self._lock:
+            return dict(self._counts)
+
+def _latency_bucket(value):
+    """Get the histogram bucket of a latency in microseconds."""
+    if value < 2 * LATENCY_SUB_BUCKETS:
+        return value
+    shift = value.bit_length() - LATENCY_SUB_BUCKETS.bit_length()
+    return shift * LATENCY_SUB_BUCKETS + (value >> shift)
+
+def _latency_bucket_top(bucket):
+    """Get the greatest latency (in microseconds) counted in a histogram bucket."""
+    if bucket < 2 * LATENCY_SUB_BUCKETS:
+        return bucket
+    shift = bucket // LATENCY_SUB_BUCKETS - 1
+    return ((bucket - shift * LATENCY_SUB_BUCKETS + 1) << shift) - 1
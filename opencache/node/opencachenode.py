@@ -4,12 +4,12 @@
 
 import BaseHTTPServer
 import collections
-import httplib
 import json
 import multiprocessing
 import optparse
 import os
 import signal
+import socket
 import SocketServer
 import threading
 import time
@@ -17,7 +17,12 @@ import time
 import hashlib
 import configparser
 import opencache.lib.opencachelib as lib
+import opencache.node.server.opencacheevent as event_server
+import opencache.node.server.opencachebloom as bloom
 import opencache.node.server.opencachehttp as server
+import opencache.node.server.opencachemetrics as metrics
+import opencache.node.server.opencachemultiplex as multiplex
+import opencache.node.server.opencacheorigin as origin
 import opencache.node.state.opencachemongodb as database
 import zmq
 
@@ -33,6 +38,11 @@ class Node():
     node_id = None
     config = None
     ipc_socket = None
+    origins = None
+    metrics = None
+    multiplex_port = None
+
+    _multiplexer = None
 
     _controller_communication = None
     _json_server = None
@@ -43,8 +53,10 @@ class Node():
         Sets up signal handling to deal with interrupts. Loads configuration file, checks validity and creates
         sensible defaults if values missing. Starts loaded modules. Initialises logger to handle output durring
         running. Creates and binds socket for inter-process communications with server instances. Allocates
-        potential ports for server instances. Starts continuous communication with controller. Starts JSON server
-        ready to receive commands from the controller.
+        potential ports for server instances. Starts collecting the metrics of cache instances, if 'metrics' is
+        enabled. Starts the multiplexer serving all cache instances, if 'multiplex' is enabled. Starts continuous
+        communication with controller. Starts JSON server ready to receive commands from the controller (and
+        requests for metrics).
 
         """
         self._setup_signal_handling()
@@ -56,10 +68,17 @@ class Node():
         lib.create_directory(self.config["cache_path"] + 'shared')
         self._logger = lib.setup_logger(self.config["log_path"], TAG, self.config["verbosity"])
         self.database = database.State(self)
+        self.origins = origin.OriginPool(self.config["origin_pool_size"], self.config["origin_idle_timeout"],
+            self.config["origin_timeout"])
         self._allocate_ports(self.config["port_range"])
         context = zmq.Context()
         self.ipc_socket = context.socket(zmq.PUB)
         self.ipc_socket.bind("ipc://oc")
+        if lib.config_enabled(self.config["metrics"]):
+            self.metrics = metrics.MetricsCollector(self)
+            threading.Thread(target=self.metrics.run, args=()).start()
+        if lib.config_enabled(self.config["multiplex"]):
+            self._start_multiplexer()
         self._controller_communication = ControllerCommunication(self)
         self._json_server = JSONServer(self)
 
@@ -99,7 +118,40 @@ class Node():
         config['stat_refresh'] = '60'
         config['alert_load'] = '500'
         config['alert_disk'] = '9663676416'
+        config['alert_interval'] = '60'
+        config['notification_interval'] = '5'
+        config['notification_hwm'] = '1000'
+        config['metrics'] = 'false'
         config['max_disk'] = '10737418240'
+        config['eviction_policy'] = 'lru'
+        config['eviction_low_watermark'] = '0.9'
+        config['disk_scan_interval'] = '3600'
+        config['directory_levels'] = '2'
+        config['segment_store'] = 'false'
+        config['segment_size'] = '67108864'
+        config['segment_object_size'] = '65536'
+        config['segment_compact_threshold'] = '0.5'
+        config['default_max_age'] = '3600'
+        config['compression'] = 'off'
+        config['compression_types'] = 'text/,application/json,application/javascript,application/xml,application/x-mpegurl,application/vnd.apple.mpegurl,application/dash+xml,image/svg+xml'
+        config['compression_level'] = '6'
+        config['memory_size'] = '268435456'
+        config['memory_object_size'] = '8388608'
+        config['sendfile'] = 'true'
+        config['server_engine'] = 'threaded'
+        config['workers'] = '1'
+        config['multiplex'] = 'false'
+        config['key_filter_capacity'] = '1000000'
+        config['key_filter_error_rate'] = '0.01'
+        config['executor_threads'] = '4'
+        config['worker_threads'] = '64'
+        config['worker_queue'] = '256'
+        config['worker_overflow'] = 'queue'
+        config['keep_alive_timeout'] = '15'
+        config['keep_alive_requests'] = '100'
+        config['origin_pool_size'] = '8'
+        config['origin_idle_timeout'] = '30'
+        config['origin_timeout'] = '30'
         config['stat_refresh'] = '60'
         config['verbosity'] = '3'
         return config
@@ -121,6 +173,14 @@ class Node():
         for port in range(int(range_split[0]), int(range_split[1])):
             allocated_port_number.append(port)
 
+    def _start_multiplexer(self):
+        """Start the process that serves every cache instance from one port (the first in the range allocated)."""
+        self.multiplex_port = allocated_port_number.popleft()
+        self._multiplexer = multiprocessing.Process(target=multiplex.Multiplexer, args=(self, self.multiplex_port))
+        self._multiplexer.daemon = True
+        self._multiplexer.start()
+        self.print_info(TAG, "Multiplexer started on port: %s" % self.multiplex_port)
+
     def _stop(self):
         """Exit gracefully.
 
@@ -129,6 +189,9 @@ class Node():
         """
         self._controller_communication.send_goodbye_to_controller()
         getattr(RemoteProcedureCall,'stop')(self, {'expr' : '*'})
+        if self._multiplexer is not None:
+            time.sleep(0.1)
+            self._multiplexer.terminate()
 
 class RemoteProcedureCall():
 
@@ -183,10 +246,23 @@ class RemoteProcedureCall():
     def _start_new_server(node, expr):
         """Create a single (new) server.
 
-        Use next available port to start server process. Store server process and port.
+        Use next available port to start server process. Store server process and port. If more than one of
+        'workers' is configured, that many server processes are started, all listening on the port, and
+        sharing a Bloom filter of the keys of the objects they hold.
+
+        If the node has a multiplexer, it is told to create a cache instance for the expression instead.
 
         """
         root, path = lib.expr_split(expr)
+        if node.multiplex_port is not None:
+            try:
+                RemoteProcedureCall._send_to_server(node, root, 'create', path or '?')
+                server_dict[expr] = {"processes" : [], "port" : node.multiplex_port}
+                node.print_info(TAG, "New multiplexed server started with expr: %s" %expr)
+            except Exception as e:
+                node.print_error(TAG, "Error occured with 'start' (new server) for expression '%s': %s" % (expr, e))
+                raise lib.RemoteProcedureCallError(data={'exception' : str(e), 'node_id' : str(node.node_id), 'expr' : str(expr)}, code='-32603')
+            return
         try:
             try:
                 port_number_lock.acquire()
@@ -195,10 +271,26 @@ class RemoteProcedureCall():
             except IndexError:
                 node.print_error(TAG, "No ports remaining in allocation, cannot start new server.")
                 return False
-            process = multiprocessing.Process(target=server.Server, args=(node, root, port))
-            process.daemon = True
-            process.start()
-            server_dict[expr] = {"process" : process, "port" : port}
+            if node.config["server_engine"] == 'event':
+                target = event_server.Server
+            else:
+                target = server.Server
+            workers = max(1, int(node.config["workers"]))
+            if workers > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+                node.print_warn(TAG, "SO_REUSEPORT is not supported, starting a single server process for expression: %s" %expr)
+                workers = 1
+            keys = None
+            usage = None
+            if workers > 1:
+                keys = bloom.CountingBloomFilter(node.config["key_filter_capacity"], node.config["key_filter_error_rate"], True)
+                usage = server.DiskUsage(True)
+            processes = []
+            for worker in range(workers):
+                process = multiprocessing.Process(target=target, args=(node, root, port, worker, workers, keys, usage))
+                process.daemon = True
+                process.start()
+                processes.append(process)
+            server_dict[expr] = {"processes" : processes, "port" : port}
             node.print_info(TAG, "New server started with expr: %s" %expr)
         except Exception as e:
             node.print_error(TAG, "Error occured with 'start' (new server) for expression '%s': %s" % (expr, e))
@@ -241,17 +333,19 @@ class RemoteProcedureCall():
     def _stop_server(node, expr):
         """Instruct single server to stop.
 
-        Send stop command and then terminate process. Add port back to those available to new servers.
+        Send stop command and then terminate its processes. Add port back to those available to new servers.
 
         """
         root, path = lib.expr_split(expr)
         try:
             RemoteProcedureCall._send_to_server(node, root, 'stop')
             time.sleep(0.1)
-            server_dict[expr]["process"].terminate()
-            port_number_lock.acquire()
-            allocated_port_number.append(server_dict[expr]["port"])
-            port_number_lock.release()
+            for process in server_dict[expr]["processes"]:
+                process.terminate()
+            if server_dict[expr]["processes"]:
+                port_number_lock.acquire()
+                allocated_port_number.append(server_dict[expr]["port"])
+                port_number_lock.release()
             node.print_info(TAG, "Server stopped with expr: %s" %expr)
         except Exception as e:
             node.print_error(TAG, "Error occured with 'stop' command for expression '%s': %s" % (expr, e))
@@ -344,6 +438,7 @@ class RemoteProcedureCall():
             key = hashlib.sha224(path).hexdigest()
             path = node.config["cache_path"] + 'shared/' + transaction
             node.database.create({'key' : key, 'path' : path})
+            RemoteProcedureCall._send_to_server(node, root, 'seed', key, transaction)
             node.print_info(TAG, "Server seeded with expression: %s" %expr)
         except Exception as e:
             node.print_error(TAG, "Error occured with 'seed' command for expression '%s': %s" % (expr, e))
@@ -358,11 +453,9 @@ class RemoteProcedureCall():
         root, path = lib.expr_split(params['expr'])
         transaction = RemoteProcedureCall._find_transaction(params['expr'])
         object_path =  node.config["cache_path"] + 'shared/' + transaction
-        connection = httplib.HTTPConnection(root)
-        connection.request("GET", path)
-        response = connection.getresponse()
+        connection, response = node.origins.request(root, path)
         read_payload = response.read()
-        connection.close()
+        node.origins.release(root, connection, response)
         f = open(object_path, 'w')
         f.write(read_payload)
         f.close()
@@ -403,8 +496,15 @@ class HandlerClass(BaseHTTPServer.BaseHTTPRequestHandler):
         pass
 
     def do_GET(self):
-        """Ignore GET requests."""
-        pass
+        """Answer requests for '/metrics' (if enabled) with the metrics of every cache instance. Ignore other GET requests."""
+        if self.path.split('?')[0] != '/metrics' or self.server._node.metrics is None:
+            return
+        body = self.server._node.metrics.render()
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain; version=0.0.4')
+        self.send_header('Content-length', len(body))
+        self.end_headers()
+        self.wfile.write(body)
 
     def do_POST(self):
         """Handle POST message containing JSON request from controller."""
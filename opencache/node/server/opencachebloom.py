@@ -0,0 +1,81 @@
+#!/usr/bin/env python2.7
+
+"""opencachebloom.py: Bloom Filter - a counting Bloom filter of the keys of stored objects, to rule out definite misses."""
+
+import hashlib
+import math
+import mmap
+import multiprocessing
+import threading
+
+TAG = 'bloom'
+
+MAX_COUNT = 255
+
+class CountingBloomFilter:
+    """A counting Bloom filter: keys can be removed as well as added.
+
+    Each key sets 'hashes' counters (of one byte each) chosen from a fixed number sized for 'capacity' keys
+    at the given 'error_rate'. A key is held only if all of its counters are non-zero, so a key that was
+    never added is reported as held only with about the chosen false positive rate, and a key that was
+    added (and not removed) is always reported. Counters that reach MAX_COUNT are never decremented.
+
+    The counters are kept in an anonymous shared memory map. A 'shared' filter also has a lock shared
+    between processes, so that it can be updated by every worker process forked after it is created.
+
+    """
+
+    size = 0
+    hashes = 0
+    _counters = None
+    _lock = None
+
+    def __init__(self, capacity, error_rate, shared=False):
+        capacity = max(1, int(capacity))
+        error_rate = min(max(float(error_rate), 1e-9), 0.5)
+        self.size = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, int(round(float(self.size) / capacity * math.log(2))))
+        self._counters = mmap.mmap(-1, self.size)
+        if shared:
+            self._lock = multiprocessing.Lock()
+        else:
+            self._lock = threading.Lock()
+
+    def add(self, key):
+        """Add a key to the filter."""
+        positions = self._positions(key)
+        with self._lock:
+            for position in positions:
+                count = ord(self._counters[position])
+                if count < MAX_COUNT:
+                    self._counters[position] = chr(count + 1)
+
+    def remove(self, key):
+        """Remove a key (previously added) from the filter."""
+        positions = self._positions(key)
+        with self._lock:
+            for position in positions:
+                count = ord(self._counters[position])
+                if 0 < count < MAX_COUNT:
+                    self._counters[position] = chr(count - 1)
+
+    def clear(self):
+        """Remove every key from the filter."""
+        with self._lock:
+            self._counters[:] = '\x00' * self.size
+
+    def might_contain(self, key):
+        """Return False if the key is definitely not held, or True if it may be."""
+        return all(self._counters[position] != '\x00' for position in self._positions(key))
+
+    def false_positive_rate(self):
+        """Estimate the current false positive rate, from the fraction of counters in use."""
+        used = self.size - self._counters[:].count('\x00')
+        return (float(used) / self.size) ** self.hashes
+
+    def _positions(self, key):
+        """Get the counters for a key, combining two hashes of it (Kirsch and Mitzenmacher)."""
+        digest = hashlib.md5(key).hexdigest()
+        first = int(digest[:16], 16)
+        second = int(digest[16:], 16) | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
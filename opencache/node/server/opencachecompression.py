@@ -0,0 +1,119 @@
+#!/usr/bin/env python2.7
+
+"""opencachecompression.py: Compression - stores compressible objects compressed, and serves them to clients that accept it."""
+
+import os
+import tempfile
+import zlib
+
+TAG = 'compression'
+
+CHUNK_SIZE = 65536
+ENCODINGS = {'gzip' : 16 + zlib.MAX_WBITS}
+
+class Compressor:
+    """Compresses objects of the configured content types as they are stored.
+
+    Content types are matched by prefix, so 'text/' covers every text type. Objects that the origin
+    has already encoded, or that do not get any smaller, are stored as they are.
+
+    """
+
+    encoding = None
+    _types = None
+    _level = 6
+
+    def __init__(self, encoding, types, level):
+        self.encoding = encoding
+        self._types = [t.strip().lower() for t in types.split(',') if t.strip()]
+        self._level = int(level)
+
+    def compressible(self, headers):
+        """Return True if an object with the given (stored) headers should be compressed."""
+        content_type = None
+        for name, value in headers:
+            if name.lower() == 'content-encoding':
+                return False
+            if name.lower() == 'content-type':
+                content_type = value.split(';')[0].strip().lower()
+        if content_type is None:
+            return False
+        return any(content_type.startswith(t) for t in self._types)
+
+    def compress_file(self, path):
+        """Compress the file at the given path into a new temporary file alongside it.
+
+        Returns the path of the compressed file, or None if compressing would not save any space (in
+        which case no file is left behind).
+
+        """
+        compressor = zlib.compressobj(self._level, zlib.DEFLATED, ENCODINGS[self.encoding])
+        fd, temp_path = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as compressed:
+                with open(path, 'rb') as f:
+                    while True:
+                        chunk = f.read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        compressed.write(compressor.compress(chunk))
+                compressed.write(compressor.flush())
+            if os.path.getsize(temp_path) < os.path.getsize(path):
+                return temp_path
+        except (IOError, OSError, zlib.error):
+            _remove(temp_path)
+            raise
+        _remove(temp_path)
+        return None
+
+def accepts(accept_encoding, encoding):
+    """Return True if a client's 'Accept-Encoding' header allows the given content encoding."""
+    if not accept_encoding:
+        return False
+    wildcard = False
+    for item in accept_encoding.split(','):
+        name, separator, parameters = item.strip().partition(';')
+        quality = 1.0
+        for parameter in parameters.split(';'):
+            attribute, separator, value = parameter.strip().partition('=')
+            if attribute.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        name = name.strip().lower()
+        if name == encoding or (encoding == 'gzip' and name == 'x-gzip'):
+            return quality > 0
+        if name == '*':
+            wildcard = quality > 0
+    return wildcard
+
+def encoded_headers(encoding):
+    """Get the headers to send with an object delivered in the given content encoding."""
+    return [('Content-encoding', encoding), ('Vary', 'Accept-Encoding')]
+
+def decompress(data, encoding):
+    """Decompress a whole object held in memory."""
+    return zlib.decompress(data, ENCODINGS[encoding])
+
+def decompress_chunks(f, encoding):
+    """Decompress an object from an open file, yielding chunks of at most CHUNK_SIZE bytes."""
+    decompressor = zlib.decompressobj(ENCODINGS[encoding])
+    while True:
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        while chunk:
+            data = decompressor.decompress(chunk, CHUNK_SIZE)
+            if data:
+                yield data
+            chunk = decompressor.unconsumed_tail
+    data = decompressor.flush()
+    if data:
+        yield data
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
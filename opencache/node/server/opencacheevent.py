@@ -0,0 +1,1283 @@
+#!/usr/bin/env python2.7
+
+"""opencacheevent.py: Event HTTP Server - serves cached HTTP objects to requesting clients from a single event loop."""
+
+import asynchat
+import asyncore
+import BaseHTTPServer
+import collections
+import email.utils
+import errno
+import hashlib
+import mimetools
+import os
+import Queue
+import signal
+import socket
+import StringIO
+import sys
+import threading
+import time
+
+import opencache.node.server.opencachecompression as compression
+import opencache.node.server.opencachefreshness as freshness
+import opencache.node.server.opencachehttp as http
+import opencache.node.server.opencacherange as byte_range
+
+TAG = 'server'
+
+MAX_HEADER_SIZE = 65536
+MAX_PENDING_CHUNKS = 16
+READ_AHEAD_CHUNKS = 4
+IDLE_CHECK_INTERVAL = 1.0
+
+class Server(http.Server):
+    """A cache instance whose clients are all served from one event loop, rather than a thread per connection.
+
+    Statistics, state changes and communication with the node and controller are unchanged. Blocking
+    calls (database lookups and file I/O) are handed to a small executor so that the loop never waits
+    on them.
+
+    """
+
+    def _create_server(self):
+        """Create the event-driven HTTP server that handles client requests for this cache instance."""
+        server = EventHTTPServer(('', self._port), int(self._node.config["executor_threads"]), self._workers > 1)
+        server._keep_alive_timeout = float(self._node.config["keep_alive_timeout"])
+        server._keep_alive_requests = int(self._node.config["keep_alive_requests"])
+        return server
+
+class EventHTTPServer(asyncore.dispatcher):
+    """Accept client connections and run the event loop that serves them."""
+
+    _status = None
+    _node = None
+    _server_path = None
+    _expr = None
+    _server = None
+    _memory = None
+    _sendfile = False
+    _default_max_age = 0
+    _inflight = None
+    _inflight_lock = None
+    _partial = None
+    _eviction = None
+    _index = None
+    _keep_alive_timeout = None
+    _keep_alive_requests = 0
+
+    def __init__(self, server_address, executor_threads, reuse_port=False):
+        """Create the listening socket, the (initially paused) running state, executors and request counters.
+
+        If 'reuse_port' is set, other processes may listen on the same port, with the kernel sharing
+        connections out between them.
+
+        """
+        self._map = dict()
+        asyncore.dispatcher.__init__(self, map=self._map)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        if reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.bind(server_address)
+        self.listen(socket.SOMAXCONN)
+        self._running = threading.Event()
+        self._idle_checked = time.time()
+        self._completions = Queue.Queue()
+        self._wakeup = Wakeup(self, self._map)
+        self._executor = Executor(executor_threads, self.call_soon)
+        self._writer = Executor(1, self.call_soon)
+        self._cache_hit_size = http.Counter()
+        self._cache_miss_size = http.Counter()
+        self._cache_hit = http.Counter()
+        self._cache_miss = http.Counter()
+        self._cache_coalesced = http.Counter()
+        self._cache_revalidated = http.Counter()
+        self._cache_not_modified = http.Counter()
+        self._latency = http.RequestLatency()
+        self._load = http.Counter()
+        self._connections = http.Counter()
+        self._requests_served = http.Counter()
+
+    def _setup_signal_handling(self):
+        """Setup signal handling for SIGQUIT and SIGINT events"""
+        signal.signal(signal.SIGINT, self._exit_server)
+        signal.signal(signal.SIGQUIT, self._exit_server)
+
+    def _exit_server(self, signal, frame):
+        raise SystemExit
+
+    def resume(self):
+        """Start accepting requests."""
+        self._running.set()
+        self._wakeup.notify()
+
+    def suspend(self):
+        """Stop accepting requests. Connections wait in the listen backlog until resumed.
+
+        Persistent connections already open are closed (from the loop) once any request in progress on them
+        has been answered.
+
+        """
+        self._running.clear()
+        self.call_soon(self._close_connections, None, None)
+
+    def _close_connections(self, result, error):
+        for channel in self._map.values():
+            if isinstance(channel, EventConnection):
+                channel.suspended()
+
+    def serve_forever(self):
+        """Run the event loop. Blocks in poll() until there is work to do, whether running or paused.
+
+        Wakes at least once a second to close persistent connections that have been idle for longer
+        than the keep-alive timeout.
+
+        """
+        while True:
+            asyncore.loop(timeout=IDLE_CHECK_INTERVAL, use_poll=True, map=self._map, count=1)
+            self._close_idle_connections()
+
+    def _close_idle_connections(self):
+        if not self._keep_alive_timeout:
+            return
+        now = time.time()
+        if now - self._idle_checked < IDLE_CHECK_INTERVAL:
+            return
+        self._idle_checked = now
+        for channel in self._map.values():
+            if isinstance(channel, EventConnection) and channel.idle_since(now) > self._keep_alive_timeout:
+                channel.close()
+
+    def readable(self):
+        return self._running.is_set()
+
+    def writable(self):
+        return False
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is None:
+            return
+        sock, address = pair
+        EventConnection(self, sock)
+        self._connections.increment()
+
+    def handle_error(self):
+        self._node.print_error(TAG, 'Could not accept client connection: %s' % sys.exc_info()[1])
+
+    def get_worker_stats(self):
+        """The event loop has no worker pool to report on."""
+        return dict()
+
+    def submit(self, function, args, callback):
+        """Run a blocking function on the executor. The callback is later run on the loop as callback(result, error)."""
+        self._executor.submit(function, args, callback)
+
+    def submit_write(self, function, args, callback=None):
+        """Run a blocking file write on the (single, ordered) writer executor."""
+        self._writer.submit(function, args, callback)
+
+    def call_soon(self, callback, result, error):
+        """Schedule a callback to run on the loop. Safe to call from any thread."""
+        self._completions.put((callback, result, error))
+        self._wakeup.notify()
+
+    def run_completions(self):
+        """Run the callbacks scheduled from executor threads."""
+        while True:
+            try:
+                callback, result, error = self._completions.get_nowait()
+            except Queue.Empty:
+                return
+            callback(result, error)
+
+class Wakeup(asyncore.file_dispatcher):
+    """Wake the event loop from other threads, for state changes and completed executor calls."""
+
+    def __init__(self, server, map):
+        self._server = server
+        self._read, self._write = os.pipe()
+        asyncore.file_dispatcher.__init__(self, self._read, map=map)
+
+    def notify(self):
+        os.write(self._write, 'w')
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            self.recv(512)
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+        self._server.run_completions()
+
+    def handle_error(self):
+        self._server._node.print_error(TAG, 'Error in event loop callback: %s' % sys.exc_info()[1])
+
+class Executor:
+    """A small pool of worker threads that run blocking calls off the event loop."""
+
+    def __init__(self, threads, call_soon):
+        self._queue = Queue.Queue()
+        self._call_soon = call_soon
+        for i in range(max(1, threads)):
+            worker = threading.Thread(target=self._work, args=())
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, function, args, callback=None):
+        self._queue.put((function, args, callback))
+
+    def _work(self):
+        while True:
+            function, args, callback = self._queue.get()
+            result = None
+            error = None
+            try:
+                result = function(*args)
+            except Exception as e:
+                error = e
+            if callback is not None:
+                self._call_soon(callback, result, error)
+
+class ReadAheadProducer:
+    """Produce chunks read (by calling 'read') on an executor, so that the event loop never waits on the disk.
+
+    Reading starts once the producer reaches the front of its connection's output, and keeps up to
+    READ_AHEAD_CHUNKS chunks ready, with one read outstanding at a time. The connection holds off sending
+    whilst the producer at the front is not 'ready'.
+
+    """
+
+    _submit = None
+    _read = None
+    _chunks = None
+    _reading = False
+    _exhausted = False
+
+    def __init__(self, submit, read):
+        """Initialise the producer. Each chunk is read by 'read()', run with 'submit(function, args, callback)'.
+
+        'read' returns an empty string once there are no more chunks.
+
+        """
+        self._submit = submit
+        self._read = read
+        self._chunks = collections.deque()
+
+    def ready(self):
+        """Return True if 'more' can be called without waiting for a read. Starts reading if need be."""
+        self.fill()
+        return bool(self._chunks) or self._exhausted
+
+    def fill(self):
+        """Start reading the next chunk, if there is room for it and no read is outstanding."""
+        if not self._reading and not self._exhausted and len(self._chunks) < READ_AHEAD_CHUNKS:
+            self._reading = True
+            self._submit(self._read, (), self._read_done)
+
+    def more(self):
+        if self._chunks:
+            data = self._chunks.popleft()
+            self.fill()
+            return data
+        return ''
+
+    def _read_done(self, data, error):
+        self._reading = False
+        if error is not None or not data:
+            self._exhausted = True
+            self._finished(error)
+            return
+        self._chunks.append(data)
+        self.fill()
+
+    def _finished(self, error):
+        """Called on the loop once there is nothing more to read, or a read has failed."""
+        pass
+
+class FileProducer(ReadAheadProducer):
+    """Produce the contents of an open file in chunks (from 'offset', if given), closing it once exhausted.
+
+    When several producers share a file, only the last should be created with 'close' set. Producers
+    of the same connection read in turn, so they may share a file.
+
+    """
+
+    def __init__(self, submit, f, length, offset=None, close=True):
+        ReadAheadProducer.__init__(self, submit, self._read_chunk)
+        self._file = f
+        self._remaining = length
+        self._offset = offset
+        self._close = close
+
+    def _read_chunk(self):
+        if self._remaining <= 0:
+            return ''
+        if self._offset is not None:
+            self._file.seek(self._offset)
+            self._offset = None
+        data = self._file.read(min(http.CHUNK_SIZE, self._remaining))
+        self._remaining -= len(data)
+        return data
+
+    def _finished(self, error):
+        if self._close:
+            self._file.close()
+
+class DecompressProducer(ReadAheadProducer):
+    """Produce the decompressed contents of an open file in chunks, closing it once exhausted."""
+
+    def __init__(self, submit, f, encoding):
+        chunks = compression.decompress_chunks(f, encoding)
+        ReadAheadProducer.__init__(self, submit, lambda: next(chunks, ''))
+        self._file = f
+
+    def _finished(self, error):
+        self._file.close()
+
+class ReplayProducer(FileProducer):
+    """Produce the start of an object from the temporary file an origin fetch is writing it to, for a client attaching late.
+
+    The file is opened, and read, on the writer executor, so each read follows the writes before it and
+    the file is opened before the fetch can move it into place. Should the file hold less than expected
+    (because a write failed), the client's connection is closed rather than sent a body with a gap in it.
+
+    """
+
+    def __init__(self, submit, fetch, client, length):
+        FileProducer.__init__(self, submit, None, length)
+        self._client = client
+        submit(self._open, (fetch, ))
+
+    def _open(self, fetch):
+        try:
+            self._file = open(fetch._temp_path, 'rb')
+        except (IOError, OSError, TypeError):
+            self._file = None
+
+    def _read_chunk(self):
+        if self._file is None:
+            return ''
+        return FileProducer._read_chunk(self)
+
+    def _finished(self, error):
+        if self._file is not None:
+            self._file.close()
+        if self._remaining > 0 and self._client.connected:
+            self._client.close()
+
+class LatencyRecorder:
+    """Records the latency of a request once all of its response, queued ahead of the recorder, has been sent."""
+
+    _latency = None
+
+    def __init__(self, latency, missed, started, first_byte):
+        self._latency = latency
+        self._missed = missed
+        self._started = started
+        self._first_byte = first_byte
+
+    def more(self):
+        self.record()
+        return ''
+
+    def record(self):
+        """Record the latency up to now, unless it has been recorded already."""
+        if self._latency is not None:
+            self._latency.record(self._missed, self._started, self._first_byte, time.time())
+            self._latency = None
+
+class SentRecorder:
+    """Adds the number of bytes of a response body sent to a statistics counter.
+
+    The recorder is queued both ahead of the response and after it. What the connection sends in
+    between, less the response header, is the body. Should the connection close first, the part of the
+    body sent is recorded.
+
+    """
+
+    _counter = None
+    _start = None
+    header_length = 0
+
+    def __init__(self, connection, counter):
+        self._connection = connection
+        self._counter = counter
+
+    def more(self):
+        if self._start is None:
+            self._start = self._connection._bytes_sent
+        else:
+            self.record()
+        return ''
+
+    def record(self):
+        """Record the bytes of the body sent up to now, unless they have been recorded already."""
+        if self._counter is not None and self._start is not None:
+            self._counter.increment(max(0, self._connection._bytes_sent - self._start - self.header_length))
+        self._counter = None
+
+class EventConnection(asynchat.async_chat):
+    """A client connection. Parses requests and delivers cached or fetched objects from the event loop."""
+
+    ac_out_buffer_size = http.CHUNK_SIZE
+
+    def __init__(self, server, sock):
+        asynchat.async_chat.__init__(self, sock, map=server._map)
+        self.server = server
+        self.path = None
+        self._key = None
+        self._incoming = []
+        self._incoming_size = 0
+        self._requests = []
+        self._busy = False
+        self._keep_alive = False
+        self._coalesced = False
+        self._request_count = 0
+        self._http_10 = False
+        self._range_header = None
+        self._if_range_header = None
+        self._if_none_match = None
+        self._if_modified_since = None
+        self._accept_encoding = None
+        self._started = None
+        self._first_byte = None
+        self._missed = False
+        self._cached = None
+        self._header_length = 0
+        self._bytes_sent = 0
+        self._last_activity = time.time()
+        self.set_terminator('\r\n\r\n')
+
+    def idle_since(self, now):
+        """Return how long (in seconds) the connection has been waiting for a new request, or 0 if it is in use."""
+        if self._busy or self._incoming or self.producer_fifo:
+            return 0
+        return now - self._last_activity
+
+    def suspended(self):
+        """Close the connection once the request in progress (if any) has been answered and sent."""
+        self._keep_alive = False
+        if not self._busy:
+            self.close_when_done()
+
+    def close(self):
+        """Close the connection, recording the latency and bytes sent of requests whose responses were not all sent."""
+        for producer in self.producer_fifo:
+            if isinstance(producer, (LatencyRecorder, SentRecorder)):
+                producer.record()
+        asynchat.async_chat.close(self)
+
+    def handle_read(self):
+        self._last_activity = time.time()
+        asynchat.async_chat.handle_read(self)
+
+    def pending(self):
+        """Return the number of responses or chunks waiting to be sent to the client."""
+        return len(self.producer_fifo)
+
+    def writable(self):
+        """Wait, rather than poll, whilst the producer at the front of the output is waiting for a read."""
+        if self._waiting_for_read():
+            return False
+        return asynchat.async_chat.writable(self)
+
+    def initiate_send(self):
+        """Send what is ready at the front of the output (as asynchat does), stopping at a producer waiting for a read."""
+        while self.producer_fifo and self.connected:
+            if self._waiting_for_read():
+                return
+            first = self.producer_fifo[0]
+            if not first:
+                del self.producer_fifo[0]
+                if first is None:
+                    self.handle_close()
+                    return
+                continue
+            if not isinstance(first, str):
+                data = first.more()
+                if data:
+                    self.producer_fifo.appendleft(data)
+                else:
+                    del self.producer_fifo[0]
+                continue
+            try:
+                num_sent = self.send(first[:self.ac_out_buffer_size])
+            except socket.error:
+                self.handle_error()
+                return
+            if num_sent:
+                self._bytes_sent += num_sent
+                if num_sent < len(first):
+                    self.producer_fifo[0] = first[num_sent:]
+                else:
+                    del self.producer_fifo[0]
+            return
+
+    def _waiting_for_read(self):
+        return (bool(self.producer_fifo) and isinstance(self.producer_fifo[0], ReadAheadProducer) and
+            not self.producer_fifo[0].ready())
+
+    def collect_incoming_data(self, data):
+        self._incoming.append(data)
+        self._incoming_size += len(data)
+        if self._incoming_size > MAX_HEADER_SIZE:
+            self.close()
+
+    def found_terminator(self):
+        request = ''.join(self._incoming).lstrip('\r\n')
+        self._incoming = []
+        self._incoming_size = 0
+        if self._busy:
+            self._requests.append(request)
+        else:
+            self._handle_request(request)
+
+    def handle_error(self):
+        self.server._node.print_error(TAG, 'Could not deliver content to client: %s' % sys.exc_info()[1])
+        self.close()
+
+    def _handle_request(self, request):
+        """Parse a request and handle it, if it is a GET. Calculate the hash value for the content requested."""
+        try:
+            request_line, headers = request.split('\r\n', 1) if '\r\n' in request else (request, '')
+            method, path, version = request_line.split()
+            headers = mimetools.Message(StringIO.StringIO(headers))
+        except ValueError:
+            self._keep_alive = False
+            self._send_error(400)
+            return
+        self._request_count += 1
+        self.server._requests_served.increment()
+        self.server._load.increment()
+        connection = headers.get('connection', '').lower()
+        self._keep_alive = ((version == 'HTTP/1.1' and connection != 'close') or
+            (version == 'HTTP/1.0' and connection == 'keep-alive'))
+        self._http_10 = version == 'HTTP/1.0'
+        self._range_header = headers.get('range')
+        self._if_range_header = headers.get('if-range')
+        self._if_none_match = headers.get('if-none-match')
+        self._if_modified_since = headers.get('if-modified-since')
+        self._accept_encoding = headers.get('accept-encoding')
+        if self.server._keep_alive_requests > 0 and self._request_count >= self.server._keep_alive_requests:
+            self._keep_alive = False
+        if not self.server._running.is_set():
+            self._keep_alive = False
+        if method != 'GET':
+            self._keep_alive = False
+            self._send_error(501)
+            return
+        self.path = path
+        self._key = hashlib.sha224(path).hexdigest()
+        self._coalesced = False
+        self._started = time.time()
+        self._first_byte = None
+        self._missed = False
+        self._cached = None
+        self._busy = True
+        self._handle_get(self._key)
+
+    def _handle_get(self, key, revalidated=False):
+        """Serve from the memory tier if possible. Otherwise, look the object up on the executor.
+
+        Objects that are certainly not cached (not in the object index, nor possibly stored by another
+        worker process) are fetched from the origin straight away.
+
+        Stale objects are first revalidated with the origin (unless they just have been), and conditional
+        requests for an object that has not changed are answered with a 304 from the object index alone.
+        Conditional range requests ('If-Range') need the time the object was stored, so are served from
+        disk unless they carry the object's entity tag.
+
+        """
+        indexed = self.server._index.get(key)
+        etag = None
+        if indexed is not None:
+            if not revalidated and not freshness.is_fresh(indexed[2]):
+                self._revalidate(key, indexed[2])
+                return
+            self._cached = indexed[2]
+            if self._not_modified(indexed[2]):
+                return
+            etag = indexed[2].get('etag')
+        entry = None
+        if self._range_header is None or self._if_range_header is None or self._if_range_header.strip() == etag:
+            entry = self.server._memory.get(key)
+        if entry is not None:
+            headers, local_object = entry
+            self.server._node.print_debug(TAG, 'memory hit: %s%s' %(self.server._expr, self.path))
+            self.server._eviction.touch(key)
+            recorder = self._record_sent(self.server._cache_hit_size)
+            if indexed is not None and 'encoding' in indexed[2]:
+                self._push_encoded(local_object, indexed[2], headers, None)
+            else:
+                ranges = self._requested_ranges(len(local_object), None, etag)
+                if ranges is None:
+                    self.push(self._response_header(200, headers, len(local_object)) + local_object)
+                else:
+                    self._push_ranges(local_object, len(local_object), ranges, headers)
+            self._recorded_sent(recorder)
+            self.server._cache_hit.increment()
+            self._done()
+            return
+        if indexed is None and self._range_header is None and not self.server._index.may_find(key):
+            self._cache_miss(key)
+            return
+        self._busy = True
+        self.server.submit(self._open_cached, (key, ), self._opened_cached)
+
+    def _requested_ranges(self, length, modified, etag=None):
+        """Get the byte ranges requested of an object stored at the given time, or None to send all of it."""
+        return byte_range.requested_ranges(self._range_header, self._if_range_header, length, modified, etag)
+
+    def _revalidate(self, key, metadata):
+        """Ask the origin whether a stale object has changed, sending the validators held for it.
+
+        Objects held without validators are simply fetched again. Only one revalidation (or fetch) of an
+        object is made at a time: other requests for it attach to the one in progress, and share its answer.
+
+        """
+        self._busy = True
+        headers = freshness.conditional_headers(metadata)
+        if not headers:
+            self._cache_miss(key)
+            return
+        fetch = self.server._inflight.get(key)
+        if fetch is not None and self._range_header is None and fetch.attach(self):
+            self.server._node.print_debug(TAG, 'cache revalidate (coalesced): %s%s' %(self.server._expr, self.path))
+            self._coalesced = True
+            return
+        self.server._node.print_debug(TAG, 'cache revalidate: %s%s' %(self.server._expr, self.path))
+        fetch = OriginFetch(self.server, key, self, False, revalidate=metadata)
+        if self.server._inflight.get(key) is None and self._range_header is None:
+            self.server._inflight[key] = fetch
+        self.server.submit(fetch.prepare, (), fetch.prepared)
+
+    def revalidated(self):
+        """Serve the object from the cache, once the origin has confirmed it is unchanged (or cannot be reached)."""
+        self._handle_get(self._key, True)
+
+    def _not_modified(self, metadata):
+        """Answer a conditional request with a 304 if the cached object satisfies it. Return True if answered."""
+        if self._if_none_match is None and self._if_modified_since is None:
+            return False
+        if not freshness.not_modified(self._if_none_match, self._if_modified_since, metadata):
+            return False
+        self.server._node.print_debug(TAG, 'cache not modified: %s%s' %(self.server._expr, self.path))
+        self.push(self._response_header(304, http.not_modified_headers(metadata), None))
+        self.server._cache_hit.increment()
+        self.server._cache_not_modified.increment()
+        self._done()
+        return True
+
+    def _open_cached(self, key):
+        """Find and open a cached object (runs on the executor).
+
+        Returns None if the object is not cached. Otherwise returns (data, None, length, modified, False)
+        for objects small enough for the memory tier, or (None, file, length, modified, False) for larger
+        objects to be streamed from disk. For range requests, an object of which all of the ranges asked
+        for have been fetched is returned as (None, file, length, modified, True). Objects held in segment
+        files are always read into memory.
+
+        """
+        entry = self.server._index.get(key) or self.server._index.find(key)
+        if entry is None:
+            return self._open_partial(key)
+        try:
+            if 'offset' in entry[2]:
+                data = self.server._segments.read(entry[0], entry[2]['offset'], entry[1])
+                return data, None, entry[1], entry[2].get('stored'), False
+            f = open(entry[0], 'rb')
+        except (IOError, OSError):
+            self.server._server._forget_missing_object(key)
+            raise
+        stat = os.fstat(f.fileno())
+        if self._range_header is None and self.server._memory.admits(stat.st_size):
+            try:
+                return f.read(), None, stat.st_size, stat.st_mtime, False
+            finally:
+                f.close()
+        return None, f, stat.st_size, stat.st_mtime, False
+
+    def _open_partial(self, key):
+        """Open the partially stored object, if it holds all of the byte ranges requested (runs on the executor)."""
+        if self._range_header is None:
+            return None
+        held = self.server._partial.get(key)
+        if held is None:
+            return None
+        length, held_ranges, modified = held
+        ranges = self._requested_ranges(length, modified)
+        if ranges is None or not self.server._partial.covers(key, ranges):
+            return None
+        return None, open(self.server._partial.data_path(key), 'rb'), length, modified, True
+
+    def _opened_cached(self, result, error):
+        """Deliver a cached object (or byte ranges of it) to the client, or treat the request as a cache miss."""
+        if error is not None:
+            self.server._node.print_warn(TAG, ('Could not retrieve content from filesystem, cache miss\'ing instead: %s' % error))
+            result = None
+        if not self.connected:
+            if result is not None and result[1] is not None:
+                result[1].close()
+            return
+        if result is None:
+            self._cache_miss(self._key)
+            return
+        local_object, f, length, modified, partial = result
+        headers = http.DEFAULT_HEADERS
+        metadata = dict()
+        if partial:
+            self.server._node.print_debug(TAG, 'cache hit (partial): %s%s' %(self.server._expr, self.path))
+        else:
+            self.server._node.print_debug(TAG, 'cache hit: %s%s' %(self.server._expr, self.path))
+            self.server._eviction.touch(self._key)
+            indexed = self.server._index.get(self._key)
+            if indexed is not None:
+                headers = http.object_headers(indexed[2])
+                metadata = indexed[2]
+                self._cached = metadata
+        ranges = None
+        if 'encoding' not in metadata:
+            ranges = self._requested_ranges(length, modified, metadata.get('etag'))
+        recorder = self._record_sent(self.server._cache_hit_size)
+        if 'encoding' in metadata:
+            self._push_encoded(local_object if f is None else f, metadata, headers, modified)
+            if f is None:
+                self.server._memory.put(self._key, headers, local_object)
+        elif ranges is not None:
+            self._push_ranges(local_object if f is None else f, length, ranges, headers)
+        elif f is None:
+            self.push(self._response_header(200, headers, length) + local_object)
+            self.server._memory.put(self._key, headers, local_object)
+        else:
+            self.push(self._response_header(200, headers, length))
+            self.push_with_producer(FileProducer(self.server.submit, f, length))
+        self._recorded_sent(recorder)
+        self.server._cache_hit.increment()
+        self._done()
+
+    def _cache_miss(self, key):
+        """Fetch the object from the origin, attaching to a fetch already in progress if possible.
+
+        Range requests are not attached to other fetches, and fetch only the byte ranges asked for.
+
+        """
+        self._missed = True
+        self._cached = None
+        if self._range_header is not None:
+            self.server._node.print_debug(TAG, 'cache miss (range): %s%s' %(self.server._expr, self.path))
+            fetch = OriginFetch(self.server, key, self, False, self._range_header, self._if_range_header)
+            self.server.submit(fetch.prepare, (), fetch.prepared)
+            return
+        fetch = self.server._inflight.get(key)
+        if fetch is not None and fetch.attach(self):
+            self._coalesced = True
+            return
+        self.server._node.print_debug(TAG, 'cache miss: %s%s' %(self.server._expr, self.path))
+        fetch = OriginFetch(self.server, key, self, fetch is None)
+        if fetch.store:
+            self.server._inflight[key] = fetch
+        self.server.submit(fetch.prepare, (), fetch.prepared)
+
+    def fetch_started(self, status, length, headers=http.DEFAULT_HEADERS):
+        """Send the response header for an object being fetched from the origin."""
+        if length is None:
+            self._keep_alive = False
+        self.push(self._response_header(status, headers, length))
+
+    def fetch_committed(self):
+        """Serve the request again, once the fetch it was waiting on has stored the object (or failed to)."""
+        self._coalesced = False
+        self._handle_get(self._key)
+
+    def fetch_finished(self, status, bytes_read, complete):
+        """Record statistics once an origin fetch this client is attached to has ended."""
+        if status is None:
+            self._send_error(502)
+            return
+        self.server._cache_miss.increment()
+        self.server._cache_miss_size.increment(bytes_read)
+        if self._coalesced:
+            self.server._cache_coalesced.increment()
+        if not complete:
+            self._keep_alive = False
+        self._done()
+
+    def _push_encoded(self, source, metadata, headers, modified):
+        """Deliver a compressed object, from memory or from an open file (which is closed once sent).
+
+        Clients that accept the object's encoding are sent the compressed bytes as they are. Other
+        clients, and range requests, are sent the object decompressed.
+
+        """
+        encoding = metadata['encoding']
+        length = metadata['length']
+        if self._range_header is None and compression.accepts(self._accept_encoding, encoding):
+            headers = headers + compression.encoded_headers(encoding)
+            if isinstance(source, str):
+                self.push(self._response_header(200, headers, len(source)) + source)
+            else:
+                size = os.fstat(source.fileno()).st_size
+                self.push(self._response_header(200, headers, size))
+                self.push_with_producer(FileProducer(self.server.submit, source, size))
+            return
+        headers = headers + [('Vary', 'Accept-Encoding')]
+        ranges = self._requested_ranges(length, modified, metadata.get('etag'))
+        if ranges is not None:
+            if not isinstance(source, str):
+                f = source
+                try:
+                    source = f.read()
+                finally:
+                    f.close()
+            self._push_ranges(compression.decompress(source, encoding), length, ranges, headers)
+            return
+        if isinstance(source, str):
+            source = StringIO.StringIO(source)
+        self.push(self._response_header(200, headers, length))
+        self.push_with_producer(DecompressProducer(self.server.submit, source, encoding))
+
+    def _push_ranges(self, source, length, ranges, headers):
+        """Deliver byte ranges of a cached object, from memory or from an open file (which is closed once sent).
+
+        If none of the ranges can be satisfied, a 416 is sent instead.
+
+        """
+        if not ranges:
+            if not isinstance(source, str):
+                source.close()
+            self.push(self._response_header(416, [('Content-range', 'bytes */%d' % length)], 0))
+            return
+        headers, parts, body_length = byte_range.range_response(ranges, length, headers)
+        self.push(self._response_header(206, headers, body_length))
+        last_slice = max(i for i, part in enumerate(parts) if not isinstance(part, str))
+        for i, part in enumerate(parts):
+            if isinstance(part, str):
+                self.push(part)
+                continue
+            first, last = part
+            if isinstance(source, str):
+                self.push(source[first:last + 1])
+            else:
+                self.push_with_producer(FileProducer(self.server.submit, source, last - first + 1, first, i == last_slice))
+
+    def _send_error(self, code):
+        self.push(self._response_header(code, [], 0))
+        self._done()
+
+    def _done(self):
+        """Finish the current request, and start on the next pipelined request (if any).
+
+        The latency of a GET request is recorded once all of the response has been sent (or the connection
+        has closed).
+
+        """
+        self._busy = False
+        self._last_activity = time.time()
+        if self._started is not None:
+            self.push_with_producer(LatencyRecorder(self.server._latency, self._missed, self._started, self._first_byte))
+            self._started = None
+        if not self._keep_alive:
+            self.close_when_done()
+            return
+        if self._requests:
+            self._handle_request(self._requests.pop(0))
+
+    def _record_sent(self, counter):
+        """Queue the start of a response whose body, once sent, is to be added to the given counter."""
+        recorder = SentRecorder(self, counter)
+        self.push_with_producer(recorder)
+        return recorder
+
+    def _recorded_sent(self, recorder):
+        """Queue the end of a response begun with '_record_sent'."""
+        recorder.header_length = self._header_length
+        self.push_with_producer(recorder)
+
+    def _response_header(self, status, headers, length):
+        if self._first_byte is None:
+            self._first_byte = time.time()
+        lines = ['HTTP/1.1 %s %s' % (status, BaseHTTPServer.BaseHTTPRequestHandler.responses.get(status, ('', ))[0])]
+        lines.append('Date: %s' % email.utils.formatdate(usegmt=True))
+        for name, value in headers:
+            lines.append('%s: %s' % (name, value))
+        if self._cached is not None and freshness.age(self._cached) is not None:
+            lines.append('Age: %s' % freshness.age(self._cached))
+        if length is not None:
+            lines.append('Content-length: %s' % length)
+        if not self._keep_alive:
+            lines.append('Connection: close')
+        elif self._http_10:
+            lines.append('Connection: keep-alive')
+        header = '\r\n'.join(lines) + '\r\n\r\n'
+        self._header_length = len(header)
+        return header
+
+class OriginFetch(asynchat.async_chat):
+    """A non-blocking fetch of an object from the origin.
+
+    The body is delivered to every attached client and (if it is to be stored) written to a temporary
+    file by the writer executor, which moves it into place once the body is complete.
+
+    A fetch made for a range request asks the origin for just those byte ranges, and has no other
+    clients attached. A single range received is written into the object's partial file instead.
+
+    A fetch made to 'revalidate' a stale object sends the validators held for it. If the origin answers
+    304 (or cannot be reached), the object's freshness is refreshed and the client is served from the
+    cache instead; otherwise the response is delivered and stored as for any cache miss.
+
+    Requests are sent with HTTP/1.1 over a connection taken from the cache instance's origin pool, and
+    chunked responses are decoded. The connection is handed back to the pool once its response has been
+    read in full, unless the origin closes it.
+
+    """
+
+    def __init__(self, server, key, client, store, range_header=None, if_range_header=None, revalidate=None):
+        asynchat.async_chat.__init__(self, map=server._map)
+        self.server = server
+        self.store = store
+        self._key = key
+        self._path = client.path
+        self._range_header = range_header
+        self._if_range_header = if_range_header
+        self._revalidate = revalidate
+        self._metadata = None
+        self._clients = [client]
+        self._waiting = []
+        self._incoming = []
+        self._status = None
+        self._length = None
+        self._headers = http.DEFAULT_HEADERS
+        self._room = False
+        self._writing = False
+        self._partial_range = None
+        self._received = 0
+        self._finished = False
+        self._cache_file = None
+        self._temp_path = None
+        self._object_path = None
+        self._write_failed = False
+        self._requested = None
+        self._host = server._expr
+        self._connection = None
+        self._reused = False
+        self._persistent = False
+        self._chunk_state = None
+        self.set_terminator('\r\n\r\n')
+
+    def attach(self, client):
+        """Attach another client to this fetch.
+
+        A client attached once some of the body has been delivered is first sent what has been written to
+        the temporary file so far (read back on the writer executor, so after those writes), then follows
+        the fetch as the rest arrives. This is only possible whilst the body is being stored. Clients attached
+        to a revalidation are served from the cache if the origin answers 304.
+
+        A client attached once the fetch has ended waits for the object to be stored, and is then served
+        from the cache.
+
+        """
+        if not (self.store or self._revalidate is not None):
+            return False
+        if self._finished:
+            self._waiting.append(client)
+            return True
+        if self._received > 0 and (not self._writing or self._write_failed):
+            return False
+        self._clients.append(client)
+        if self._status is not None:
+            client.fetch_started(self._status, self._length, self._headers)
+        if self._received > 0:
+            client.push_with_producer(ReplayProducer(self.server.submit_write, self, client, self._received))
+        return True
+
+    def prepare(self):
+        """Get a connection to the origin and open a temporary file to store the object in (runs on the executor)."""
+        connection, reused = self.server._origins.connect(self._host)
+        try:
+            if self.store:
+                if self.server._server._disk_check():
+                    object_path = self.server._server._get_object_path(self._key)
+                    cache_file, temp_path = http.open_temp_file(object_path)
+                    return connection, reused, True, object_path, cache_file, temp_path
+                self.server._node.print_info(TAG, 'Cache instance has reached maximum disk usage and cannot store object: %s%s' %(self.server._expr, self._path))
+            elif self._range_header is not None or self._revalidate is not None:
+                return connection, reused, self.server._server._disk_check(), None, None, None
+            return connection, reused, False, None, None, None
+        except Exception:
+            connection.close()
+            raise
+
+    def prepared(self, result, error):
+        """Send the request over the connection to the origin."""
+        if error is not None:
+            self.server._node.print_error(TAG, 'Could not retrieve content from origin server: %s' % error)
+            self._finish(False)
+            return
+        connection, reused, self._room, self._object_path, self._cache_file, self._temp_path = result
+        self._send_request((connection, reused), None)
+
+    def _send_request(self, connection, error):
+        """Take over the (connected) origin connection given as (connection, reused), and send the request on it."""
+        if error is not None:
+            self.server._node.print_error(TAG, 'Could not retrieve content from origin server: %s' % error)
+            self._finish(False)
+            return
+        self._connection, self._reused = connection
+        headers = ''
+        if self._range_header is not None:
+            headers += 'Range: %s\r\n' % self._range_header
+        if self._if_range_header is not None:
+            headers += 'If-Range: %s\r\n' % self._if_range_header
+        if self._revalidate is not None:
+            for name, value in freshness.conditional_headers(self._revalidate).items():
+                headers += '%s: %s\r\n' % (name, value)
+        self._connection.sock.setblocking(0)
+        self.set_socket(self._connection.sock, self.server._map)
+        self.connected = True
+        self._requested = time.time()
+        self.push('GET %s HTTP/1.1\r\nHost: %s\r\n%s\r\n' % (self._path, self.server._expr, headers))
+
+    def _reconnect(self):
+        """Send the request again on a new connection, as a reused connection was closed by the origin before answering."""
+        self.del_channel()
+        self.discard_buffers()
+        self.socket = None
+        self.connected = False
+        self._connection.close()
+        self.server.submit(self.server._origins.connect, (self._host, False), self._send_request)
+
+    def readable(self):
+        """Stop reading from the origin whilst any attached client has too much data waiting to be sent."""
+        for client in self._clients:
+            if client.connected and client.pending() > MAX_PENDING_CHUNKS:
+                return False
+        return asynchat.async_chat.readable(self)
+
+    def collect_incoming_data(self, data):
+        if self._finished:
+            return
+        if self._status is None or self._chunk_state not in (None, 'data'):
+            self._incoming.append(data)
+        else:
+            self._deliver(data)
+
+    def found_terminator(self):
+        """Parse the origin response header and start the response to each attached client."""
+        if self._finished:
+            return
+        if self._status is not None:
+            self._found_chunk_terminator()
+            return
+        response = ''.join(self._incoming)
+        self._incoming = []
+        status_line, headers = response.split('\r\n', 1) if '\r\n' in response else (response, '')
+        headers = mimetools.Message(StringIO.StringIO(headers))
+        try:
+            self._status = int(status_line.split()[1])
+            length = headers.get('content-length')
+            self._length = int(length) if length is not None else None
+        except (IndexError, ValueError):
+            self.server._node.print_error(TAG, 'Could not parse response from origin server: %s' % status_line)
+            self._status = None
+            self._finish(False)
+            return
+        if self._status in (204, 304):
+            self._length = 0
+        self.server._latency.origin.record(time.time() - self._requested)
+        self._persistent = status_line.startswith('HTTP/1.1') and headers.get('connection', '').lower() != 'close'
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            self._length = None
+            self._chunk_state = 'size'
+            self.set_terminator('\r\n')
+        else:
+            self.set_terminator(None)
+        self._metadata = http.object_metadata(headers, self.server._default_max_age, self._revalidate)
+        if self._revalidate is not None and self._status == 304:
+            self.server._server._refresh_object(self._key, self._metadata)
+            self._finish(True)
+            return
+        self._headers = http.response_headers(headers)
+        if headers.get('content-range') is not None:
+            self._headers.append(('Content-range', headers.get('content-range')))
+        if freshness.storable(headers):
+            self._start_writing(byte_range.parse_content_range(headers.get('content-range')))
+        for client in self._clients:
+            client.fetch_started(self._status, self._length, self._headers)
+        if self._length == 0:
+            self._finish(True)
+
+    def _found_chunk_terminator(self):
+        """Follow the framing of a chunked response: each chunk's size line, its data and the trailer after the last one."""
+        line = ''.join(self._incoming)
+        self._incoming = []
+        if self._chunk_state == 'size':
+            try:
+                size = int(line.split(';', 1)[0].strip(), 16)
+            except ValueError:
+                self.server._node.print_error(TAG, 'Could not parse chunked response from origin server: %s%s' %(self.server._expr, self._path))
+                self._persistent = False
+                self._finish(False)
+                return
+            if size == 0:
+                self._chunk_state = 'trailer'
+            else:
+                self._chunk_state = 'data'
+                self.set_terminator(size)
+        elif self._chunk_state == 'data':
+            self._chunk_state = 'end'
+            self.set_terminator('\r\n')
+        elif self._chunk_state == 'end':
+            self._chunk_state = 'size'
+        elif not line:
+            self._chunk_state = None
+            self._finish(True)
+
+    def _start_writing(self, received):
+        """Decide whether the body is to be stored, now that the response status is known.
+
+        For a range request, the file to write to is opened by the writer executor: a temporary file if
+        the origin sent the whole object, or the partial file if it sent a single range.
+
+        """
+        if self._cache_file is not None:
+            self._writing = self._status == 200
+        elif self._room and self._status == 200:
+            self._writing = True
+            self.server.submit_write(self._open_temp, ())
+        elif (self._room and self._status == 206 and received is not None and
+                self._length == received[1] - received[0] + 1):
+            self._writing = True
+            self._partial_range = received
+            self.server.submit_write(self._open_partial, ())
+
+    def _deliver(self, data):
+        """Deliver a chunk of the body to the attached clients and the temporary file."""
+        if self._length is not None:
+            data = data[:self._length - self._received]
+        if not data:
+            return
+        self._received += len(data)
+        for client in self._clients:
+            if client.connected:
+                client.push(data)
+        if self._writing:
+            self.server.submit_write(self._write, (data, ))
+        if self._length is not None and self._received >= self._length:
+            self._finish(True)
+
+    def handle_connect(self):
+        pass
+
+    def handle_close(self):
+        if self._reused and self._status is None and not self._incoming:
+            self._reconnect()
+            return
+        self._persistent = False
+        self._finish(self._status is not None and self._length is None and self._chunk_state is None)
+
+    def handle_error(self):
+        if self._reused and self._status is None and not self._incoming:
+            self._reconnect()
+            return
+        self.server._node.print_error(TAG, 'Could not retrieve content from origin server: %s' % sys.exc_info()[1])
+        self._persistent = False
+        self._finish(False)
+
+    def _finish(self, complete):
+        """End the fetch, notify the attached clients, and store or discard the temporary file.
+
+        The connection to the origin is handed back to the pool if all of a response it has left open has been read.
+
+        """
+        if self._finished:
+            return
+        self._finished = True
+        if self.socket is not None and complete and self._persistent:
+            self._release()
+        elif self.socket is not None:
+            self.close()
+        self.server._node.print_debug(TAG, 'cache fetched: %s%s at %s bytes' %(self.server._expr, self._path, self._received))
+        for client in self._clients:
+            if not client.connected:
+                continue
+            if self._revalidate is not None and (self._status is None or self._status == 304):
+                client.revalidated()
+            else:
+                client.fetch_finished(self._status, self._received, complete)
+        store = complete and self._writing
+        if self._cache_file is not None or self._writing:
+            self.server.submit_write(self._commit, (store, ), self._committed)
+        else:
+            self._committed(None, None)
+
+    def _release(self):
+        """Hand the connection to the origin back to the pool, for the next fetch to reuse."""
+        sock = self.socket
+        self.del_channel()
+        self.socket = None
+        self.connected = False
+        sock.settimeout(self._connection.timeout)
+        self.server._origins.keep(self._host, self._connection)
+
+    def _open_temp(self):
+        """Open a temporary file to store the whole object in (runs on the writer executor)."""
+        try:
+            self._object_path = self.server._server._get_object_path(self._key)
+            self._cache_file, self._temp_path = http.open_temp_file(self._object_path)
+        except (IOError, OSError) as e:
+            self.server._node.print_warn(TAG, ('Could not save content to filesystem: %s' % e))
+            self._write_failed = True
+
+    def _open_partial(self):
+        """Open the object's partial file at the start of the range received (runs on the writer executor)."""
+        first, last, length = self._partial_range
+        try:
+            self._cache_file = self.server._partial.open_writer(self._key, length, first)
+        except (IOError, OSError) as e:
+            self.server._node.print_warn(TAG, ('Could not save content to filesystem: %s' % e))
+            self._write_failed = True
+
+    def _write(self, data):
+        """Write a chunk to the temporary file (runs on the writer executor)."""
+        if self._write_failed or self._cache_file is None:
+            return
+        try:
+            self._cache_file.write(data)
+        except (IOError, OSError) as e:
+            self.server._node.print_warn(TAG, ('Could not save content to filesystem: %s' % e))
+            self._write_failed = True
+
+    def _commit(self, store):
+        """Move a complete object into place, or discard it (runs on the writer executor).
+
+        A range written into the partial file is recorded there instead, and the partial file is moved
+        into place once it holds the whole object.
+
+        """
+        if self._cache_file is None:
+            return
+        self._cache_file.close()
+        store = store and not self._write_failed
+        if self._partial_range is not None:
+            first, last, length = self._partial_range
+            if store and self.server._partial.add(self._key, first, last):
+                object_path = self.server._server._get_object_path(self._key)
+                self.server._server._store_object(self._key, self.server._partial.data_path(self._key), object_path, self._metadata)
+        elif store:
+            self.server._server._store_object(self._key, self._temp_path, self._object_path, self._metadata)
+        else:
+            http.discard_file(self._temp_path)
+
+    def _committed(self, result, error):
+        if error is not None:
+            self.server._node.print_warn(TAG, ('Could not save content to filesystem: %s' % error))
+        if self.server._inflight.get(self._key) is self:
+            del self.server._inflight[self._key]
+        for client in self._waiting:
+            if client.connected:
+                client.fetch_committed()
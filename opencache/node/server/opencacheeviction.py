@@ -0,0 +1,281 @@
+#!/usr/bin/env python2.7
+
+"""opencacheeviction.py: Disk Eviction - keeps the objects stored by a cache instance within its disk limit."""
+
+import collections
+import heapq
+import itertools
+import threading
+
+TAG = 'eviction'
+
+CHECK_INTERVAL = 1.0
+
+class LRUPolicy:
+    """Evict the least recently used object first."""
+
+    def __init__(self):
+        self._objects = collections.OrderedDict()
+
+    def add(self, key, size):
+        self._objects.pop(key, None)
+        self._objects[key] = size
+
+    def touch(self, key):
+        size = self._objects.pop(key, None)
+        if size is not None:
+            self._objects[key] = size
+
+    def remove(self, key):
+        self._objects.pop(key, None)
+
+    def evict(self):
+        if not self._objects:
+            return None
+        key, size = self._objects.popitem(last=False)
+        return key
+
+class _PriorityPolicy:
+    """Evict the object with the lowest priority first, ties going to the least recently used.
+
+    Priorities are kept in a heap. Entries made stale by a change of priority are skipped when they
+    reach the top, and cleared out whenever they outnumber the live entries.
+
+    """
+
+    def __init__(self, priority):
+        """Initialise the policy. The priority of an object is given by 'priority(size, frequency)'."""
+        self._priority = priority
+        self._heap = []
+        self._entries = dict()
+        self._counter = itertools.count()
+
+    def add(self, key, size):
+        self._push(key, size, 1)
+
+    def touch(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._push(key, entry[2], entry[3] + 1)
+
+    def remove(self, key):
+        self._entries.pop(key, None)
+
+    def evict(self):
+        while self._heap:
+            priority, sequence, key = heapq.heappop(self._heap)
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] == sequence:
+                del self._entries[key]
+                self._evicted(priority)
+                return key
+        return None
+
+    def _push(self, key, size, frequency):
+        priority = self._priority(size, frequency)
+        sequence = next(self._counter)
+        self._entries[key] = (priority, sequence, size, frequency)
+        heapq.heappush(self._heap, (priority, sequence, key))
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._heap = [(priority, sequence, key) for key, (priority, sequence, size, frequency) in self._entries.iteritems()]
+            heapq.heapify(self._heap)
+
+    def _evicted(self, priority):
+        pass
+
+class LFUPolicy(_PriorityPolicy):
+    """Evict the least frequently used object first."""
+
+    def __init__(self):
+        _PriorityPolicy.__init__(self, lambda size, frequency: frequency)
+
+class GDSFPolicy(_PriorityPolicy):
+    """Greedy-Dual-Size-Frequency: evict the object with the least frequency per byte first.
+
+    Priorities are inflated by the priority of the last object evicted, so that objects which were
+    popular once, but are no longer accessed, age out.
+
+    """
+
+    def __init__(self):
+        _PriorityPolicy.__init__(self, self._inflated_priority)
+        self._inflation = 0.0
+
+    def _inflated_priority(self, size, frequency):
+        return self._inflation + float(frequency) / max(size, 1)
+
+    def _evicted(self, priority):
+        self._inflation = priority
+
+class S3FIFOPolicy:
+    """S3-FIFO: a small probationary queue in front of a main queue, with a ghost queue of recent evictions.
+
+    New objects enter the small queue, which holds about a tenth of the bytes stored. Objects leaving it
+    that were accessed again move to the main queue; the rest are evicted and remembered in the ghost
+    queue, so that they go straight to the main queue if they are stored again. Objects reaching the end
+    of the main queue are given another pass for each access (up to three) before being evicted.
+
+    """
+
+    SMALL_FRACTION = 0.1
+    MAX_FREQUENCY = 3
+
+    def __init__(self):
+        self._small = collections.OrderedDict()
+        self._main = collections.OrderedDict()
+        self._ghost = collections.OrderedDict()
+        self._frequency = dict()
+        self._small_size = 0
+        self._size = 0
+
+    def add(self, key, size):
+        self.remove(key)
+        self._frequency[key] = 0
+        self._size += size
+        if self._ghost.pop(key, None) is not None:
+            self._main[key] = size
+        else:
+            self._small[key] = size
+            self._small_size += size
+
+    def touch(self, key):
+        frequency = self._frequency.get(key)
+        if frequency is not None:
+            self._frequency[key] = min(frequency + 1, self.MAX_FREQUENCY)
+
+    def remove(self, key):
+        if self._frequency.pop(key, None) is None:
+            return
+        size = self._small.pop(key, None)
+        if size is not None:
+            self._small_size -= size
+        else:
+            size = self._main.pop(key)
+        self._size -= size
+
+    def evict(self):
+        while self._small or self._main:
+            if self._small and (self._small_size >= self.SMALL_FRACTION * self._size or not self._main):
+                key, size = self._small.popitem(last=False)
+                self._small_size -= size
+                if self._frequency[key] > 0:
+                    self._frequency[key] = 0
+                    self._main[key] = size
+                    continue
+                self._ghost[key] = True
+                while len(self._ghost) > max(len(self._main), 1):
+                    self._ghost.popitem(last=False)
+            else:
+                key, size = self._main.popitem(last=False)
+                if self._frequency[key] > 0:
+                    self._frequency[key] -= 1
+                    self._main[key] = size
+                    continue
+            del self._frequency[key]
+            self._size -= size
+            return key
+        return None
+
+POLICIES = {'lru' : LRUPolicy, 'lfu' : LFUPolicy, 'gdsf' : GDSFPolicy, 's3fifo' : S3FIFOPolicy}
+
+class Evictor:
+    """Tracks the objects stored by a cache instance, and evicts them in the background once it is full.
+
+    Once more than 'max_size' bytes are in use, objects chosen by the eviction policy are removed until
+    no more than 'low_size' bytes are. Each object is removed by calling 'remove' with its key, path and
+    size. The bytes in use are given by calling 'usage' (such as the cache instance's disk usage total,
+    which also counts files that are not tracked here), or are those of the objects tracked if it is None.
+
+    """
+
+    _policy = None
+    _objects = None
+    _lock = None
+    _wakeup = None
+    _remove = None
+    _usage = None
+    _max_size = 0
+    _low_size = 0
+    size = 0
+    evicted = 0
+    evicted_size = 0
+
+    def __init__(self, policy, max_size, low_size, remove, usage=None):
+        self._policy = policy
+        self._objects = dict()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._remove = remove
+        self._usage = usage if usage is not None else lambda: self.size
+        self._max_size = int(max_size)
+        self._low_size = min(int(low_size), self._max_size)
+
+    def add(self, key, path, size):
+        """Record that an object has been stored (or replaced) at the given path."""
+        with self._lock:
+            previous = self._objects.get(key)
+            if previous is not None:
+                self.size -= previous[1]
+            self._objects[key] = (path, size)
+            self.size += size
+            self._policy.add(key, size)
+        if self._usage() > self._max_size:
+            self._wakeup.set()
+
+    def touch(self, key):
+        """Record an access to an object."""
+        with self._lock:
+            if key in self._objects:
+                self._policy.touch(key)
+
+    def remove(self, key):
+        """Stop tracking an object that has been removed by other means."""
+        with self._lock:
+            entry = self._objects.pop(key, None)
+            if entry is not None:
+                self.size -= entry[1]
+                self._policy.remove(key)
+
+    def clear(self):
+        """Stop tracking every object (once they have all been removed)."""
+        with self._lock:
+            for key in self._objects:
+                self._policy.remove(key)
+            self._objects.clear()
+            self.size = 0
+
+    def count(self):
+        """Return the number of objects tracked."""
+        return len(self._objects)
+
+    def run(self):
+        """Wait until more than the limit is in use, then evict down to the low watermark. Never returns.
+
+        The bytes in use are also checked every CHECK_INTERVAL seconds, as they may grow without an object being added.
+
+        """
+        while True:
+            self._wakeup.wait(CHECK_INTERVAL)
+            self._wakeup.clear()
+            if self._usage() > self._max_size:
+                self.evict(self._low_size)
+
+    def evict(self, target):
+        """Evict objects, in the order chosen by the policy, to bring the bytes in use down to 'target'.
+
+        The bytes in use are read once, and the size of each object removed taken off them, as objects
+        removed from a segment free no space until it is compacted.
+
+        """
+        excess = self._usage() - target
+        while excess > 0:
+            with self._lock:
+                key = self._policy.evict()
+                if key is None:
+                    return
+                path, size = self._objects.pop(key)
+                self.size -= size
+            self._remove(key, path, size)
+            self.evicted += 1
+            self.evicted_size += size
+            excess -= size
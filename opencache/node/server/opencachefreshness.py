@@ -0,0 +1,160 @@
+#!/usr/bin/env python2.7
+
+"""opencachefreshness.py: Freshness - decides how long cached objects stay fresh, and how to revalidate them with the origin."""
+
+import email.utils
+import time
+
+TAG = 'freshness'
+
+HEURISTIC_FRACTION = 0.1
+
+def parse_cache_control(value):
+    """Parse a 'Cache-Control' header into a dictionary of (lower case) directives and their values (or None)."""
+    directives = dict()
+    if not value:
+        return directives
+    for directive in value.split(','):
+        name, separator, argument = directive.strip().partition('=')
+        if name:
+            directives[name.strip().lower()] = argument.strip().strip('"') if separator else None
+    return directives
+
+def parse_date(value):
+    """Parse an HTTP date into seconds since the epoch, or None if it is missing or invalid."""
+    if not value:
+        return None
+    date = email.utils.parsedate_tz(value)
+    if date is None:
+        return None
+    try:
+        return email.utils.mktime_tz(date)
+    except (OverflowError, ValueError):
+        return None
+
+def storable(headers):
+    """Return False if the origin's response headers forbid a shared cache from storing the object."""
+    directives = parse_cache_control(headers.getheader('cache-control'))
+    return 'no-store' not in directives and 'private' not in directives
+
+def lifetime(headers, default_max_age, now):
+    """Get the freshness lifetime (in seconds) of a response, from the age it already has at the origin.
+
+    Explicit directives ('s-maxage', 'max-age', then 'Expires') are used where given, and 'no-cache'
+    means the object must be revalidated every time. Otherwise, a tenth of the time since the object was
+    last modified is used, up to 'default_max_age', or 'default_max_age' itself.
+
+    """
+    directives = parse_cache_control(headers.getheader('cache-control'))
+    date = parse_date(headers.getheader('date')) or now
+    if 'no-cache' in directives:
+        return 0
+    for directive in ('s-maxage', 'max-age'):
+        if directive in directives:
+            try:
+                return max(0, int(directives[directive]))
+            except (TypeError, ValueError):
+                return 0
+    if headers.getheader('expires') is not None:
+        expires = parse_date(headers.getheader('expires'))
+        if expires is None:
+            return 0
+        return max(0, expires - date)
+    last_modified = parse_date(headers.getheader('last-modified'))
+    if last_modified is not None and last_modified < date:
+        return min(default_max_age, int((date - last_modified) * HEURISTIC_FRACTION))
+    return default_max_age
+
+def metadata(headers, default_max_age, previous=None, now=None):
+    """Get the validators and freshness of an object from the origin's response headers.
+
+    Returns a dictionary holding the 'etag' and 'last_modified' validators (if given), the time
+    until which the object is fresh ('expires'), and the time at which its age was nought ('date'),
+    taking into account any age it already had at the origin. Validators missing from a revalidation
+    response are carried over from the 'previous' metadata.
+
+    """
+    if now is None:
+        now = time.time()
+    result = dict()
+    if previous is not None:
+        for name in ('etag', 'last_modified'):
+            if name in previous:
+                result[name] = previous[name]
+    if headers.getheader('etag') is not None:
+        result['etag'] = headers.getheader('etag')
+    if headers.getheader('last-modified') is not None:
+        result['last_modified'] = headers.getheader('last-modified')
+    try:
+        age = max(0, int(headers.getheader('age') or 0))
+    except ValueError:
+        age = 0
+    result['expires'] = now + lifetime(headers, default_max_age, now) - age
+    result['date'] = now - age
+    return result
+
+def age(metadata, now=None):
+    """Get the current age (in whole seconds) of an object with the given metadata, or None if it is not known."""
+    date = metadata.get('date')
+    if date is None:
+        return None
+    if now is None:
+        now = time.time()
+    return max(0, int(now - date))
+
+def is_fresh(metadata, now=None):
+    """Return True if an object with the given metadata may be served without revalidating it.
+
+    Objects stored without any freshness information never go stale.
+
+    """
+    expires = metadata.get('expires')
+    if expires is None:
+        return True
+    if now is None:
+        now = time.time()
+    return now < expires
+
+def conditional_headers(metadata):
+    """Get the headers that make a revalidation request conditional on the validators held for an object."""
+    headers = dict()
+    if 'etag' in metadata:
+        headers['If-None-Match'] = metadata['etag']
+    if 'last_modified' in metadata:
+        headers['If-Modified-Since'] = metadata['last_modified']
+    return headers
+
+def not_modified(if_none_match, if_modified_since, metadata):
+    """Return True if a client's conditional request is satisfied by the copy held (so a 304 can be sent).
+
+    'If-None-Match' takes precedence over 'If-Modified-Since', and is compared weakly.
+
+    """
+    if if_none_match is not None:
+        etag = metadata.get('etag')
+        if if_none_match.strip() == '*':
+            return True
+        if etag is None:
+            return False
+        tags = [_opaque_tag(tag) for tag in if_none_match.split(',')]
+        return _opaque_tag(etag) in tags
+    if if_modified_since is not None:
+        since = parse_date(if_modified_since)
+        last_modified = parse_date(metadata.get('last_modified'))
+        return since is not None and last_modified is not None and last_modified <= since
+    return False
+
+def validator_headers(metadata):
+    """Get the validator headers to send with a response for an object with the given metadata."""
+    headers = []
+    if 'etag' in metadata:
+        headers.append(('ETag', metadata['etag']))
+    if 'last_modified' in metadata:
+        headers.append(('Last-modified', metadata['last_modified']))
+    return headers
+
+def _opaque_tag(tag):
+    tag = tag.strip()
+    if tag.startswith('W/'):
+        tag = tag[2:]
+    return tag
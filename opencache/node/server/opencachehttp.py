@@ -4,20 +4,48 @@
 
 import BaseHTTPServer
 import collections
+import ctypes
+import ctypes.util
+import errno
 import hashlib
 import httplib
+import mmap
+import multiprocessing
 import os
+import Queue
+import select
 import signal
+import socket
 import SocketServer
+import StringIO
+import struct
 import sys
+import tempfile
 import threading
+import time
 
 import opencache.lib.opencachelib as lib
+import opencache.node.server.opencachecompression as compression
+import opencache.node.server.opencacheeviction as eviction
+import opencache.node.server.opencachefreshness as freshness
+import opencache.node.server.opencacheindex as index
+import opencache.node.server.opencachememory as memory
+import opencache.node.server.opencachemetrics as metrics
+import opencache.node.server.opencachenotify as notify
+import opencache.node.server.opencacheorigin as origin
+import opencache.node.server.opencacherange as byte_range
+import opencache.node.server.opencachesegment as segment
 import opencache.node.state.opencachemongodb as database
 import zmq
 
 TAG = 'server'
 
+DEFAULT_HEADERS = [('Content-type', 'text-html')]
+STORED_HEADERS = ['Content-type', 'Content-encoding', 'Content-language', 'Content-disposition', 'Cache-control', 'Expires',
+    'ETag', 'Last-modified', 'Vary']
+CHUNK_SIZE = 65536
+DISK_USAGE_FORMAT = struct.Struct('=qqqqq')
+
 class Server:
 
     _server_path = None
@@ -29,35 +57,236 @@ class Server:
     _expr = None
     _load = 0
     _load_data = None
+    _worker = 0
+    _workers = 1
+    _worker_counters = None
+    _worker_socket = None
+    _notifier = None
+    _metrics_socket = None
 
-    def __init__(self, node, expr, port):
-        """Initialise server instance.
-
-        Creates new connection manager. Creates new HTTP server. Passes objects to the server to facilitate
-        callbacks. Sets server status to 'start'. Runs server until terminated.
-
-        """
+    def __init__(self, node, expr, port, worker=0, workers=1, keys=None, usage=None):
+        """Initialise server instance, as one of 'workers' processes sharing the port, the Bloom filter of 'keys'
+        and the disk 'usage' total. Runs server until terminated."""
         self._setup_signal_handling()
         self._database = node.database
         self._node = node
         self._expr = expr
         self._port = port
+        self._worker = worker
+        self._workers = workers
+        self._worker_counters = dict()
         self._load_data = collections.deque(maxlen=int(self._node.config["stat_refresh"]))
         self._set_path(expr)
+        self._directory_levels = int(self._node.config["directory_levels"])
         lib.create_directory(self._server_path)
-        self._server = self.ThreadedHTTPServer(('', self._port), self.HandlerClass)
-        #self._server = self.ThreadedHTTPServer((self._node.config["node_host"], self._port), self.HandlerClass)
+        self._server = self._create_server()
         self._server._setup_signal_handling()
         self._server._server = self
         self._server._node = self._node
         self._server._expr = self._expr
         self._server._server_path = self._server_path
-        threading.Thread(target=self._conn_manager, args=(expr, )).start()
+        self._server._memory = self._create_memory_tier()
+        self._server._sendfile = lib.config_enabled(self._node.config["sendfile"])
+        self._server._default_max_age = int(self._node.config["default_max_age"])
+        self._server._compression = self._create_compressor()
+        self._server._inflight = dict()
+        self._server._inflight_lock = threading.Lock()
+        self._server._index = index.ObjectIndex(self._node, self._expr, self._workers > 1, keys)
+        self._server._index.load(self._worker == 0)
+        if self._worker == 0:
+            self._migrate_layout()
+        self._server._disk_usage = usage if usage is not None else DiskUsage()
+        self._server._partial = byte_range.PartialStore(self._server_path, self._server._disk_usage, self._directory_levels)
+        self._server._segments = self._create_segment_store()
+        self._server._eviction = self._create_evictor()
+        self._node.origins.close_all()
+        self._server._origins = origin.OriginPool(self._node.config["origin_pool_size"],
+            self._node.config["origin_idle_timeout"], self._node.config["origin_timeout"], self._server._latency.origin)
+        self._notifier = self._create_notifier()
+        self._run()
+
+    def _run(self):
+        """Start communicating with the node and controller, then serve requests until terminated."""
+        threading.Thread(target=self._conn_manager, args=(self._expr, )).start()
         threading.Thread(target=self._load_monitor, args=()).start()
-        threading.Thread(target=self._stat_reporter, args=()).start()
+        if self._worker == 0:
+            threading.Thread(target=self._stat_reporter, args=()).start()
+        if self._worker == 0 and self._workers > 1:
+            threading.Thread(target=self._worker_collector, args=()).start()
+        if self._notifier is not None:
+            threading.Thread(target=self._notifier.run, args=()).start()
+        self._start_background()
         self._start()
         self._server.serve_forever()
 
+    def _start_background(self):
+        """Start the threads that write to the database, evict objects, reconcile disk usage (from the first worker) and compact segments."""
+        threading.Thread(target=self._server._index.run, args=()).start()
+        threading.Thread(target=self._server._eviction.run, args=()).start()
+        if self._worker == 0:
+            threading.Thread(target=self._disk_reconciler, args=()).start()
+        if self._server._segments is not None:
+            threading.Thread(target=self._server._segments.run, args=()).start()
+
+    def _create_server(self):
+        """Create the HTTP server that handles client requests for this cache instance."""
+        server = self.ThreadedHTTPServer(('', self._port), self.HandlerClass, self._workers > 1)
+        #server = self.ThreadedHTTPServer((self._node.config["node_host"], self._port), self.HandlerClass)
+        server.start_workers(int(self._node.config["worker_threads"]), int(self._node.config["worker_queue"]),
+            self._node.config["worker_overflow"] == 'reject')
+        server._keep_alive_timeout = float(self._node.config["keep_alive_timeout"])
+        server._keep_alive_requests = int(self._node.config["keep_alive_requests"])
+        return server
+
+    def _create_notifier(self):
+        """Create the channel this process sends notifications to the controller over. Only the first worker process has one."""
+        if self._worker != 0:
+            return None
+        return notify.Notifier(self._node, self._node.config["notification_hwm"], self._node.config["notification_interval"],
+            self._node.config["alert_interval"])
+
+    def _create_evictor(self):
+        """Create the evictor that keeps this cache instance within 'max_disk', tracking any objects it already holds.
+
+        Objects are evicted in the order chosen by the 'eviction_policy' (lru, lfu, gdsf or s3fifo), down to
+        the 'eviction_low_watermark' fraction of 'max_disk'. The disk usage total (the same one checked before
+        storing) decides when to evict. Objects already held are tracked in order of last access.
+
+        With several worker processes, each is given an equal share of 'max_disk' and of the shared disk usage
+        total, and tracks the objects it stores itself. Objects already held are shared out between the workers by key.
+
+        """
+        policy = eviction.POLICIES.get(self._node.config["eviction_policy"].strip().lower())
+        if policy is None:
+            self._node.print_warn(TAG, 'Unknown eviction policy \'%s\', using \'lru\' instead' % self._node.config["eviction_policy"])
+            policy = eviction.LRUPolicy
+        max_size = int(self._node.config["max_disk"]) / self._workers
+        low_size = max_size * float(self._node.config["eviction_low_watermark"])
+        evictor = eviction.Evictor(policy(), max_size, low_size, self._evict_object,
+            lambda: self._server._disk_usage.size() / self._workers)
+        existing = []
+        for key, (path, size, metadata) in self._server._index.items():
+            if not path.startswith(self._server_path + '/'):
+                continue
+            if int(key, 16) % self._workers != self._worker:
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                self._server._index.remove(key)
+                continue
+            if 'offset' in metadata:
+                existing.append((metadata.get('stored', 0), key, path, size))
+            else:
+                existing.append((stat.st_atime, key, path, stat.st_size))
+        for accessed, key, path, size in sorted(existing):
+            evictor.add(key, path, size)
+        return evictor
+
+    def _create_memory_tier(self):
+        """Create the tier that holds the hottest objects in memory, of up to 'memory_size' bytes.
+
+        The tier is disabled when there are several worker processes, as a copy held by one would be
+        served after another had replaced or evicted the object.
+
+        """
+        if self._workers > 1:
+            return memory.MemoryTier(0, 0)
+        return memory.MemoryTier(self._node.config["memory_size"], self._node.config["memory_object_size"])
+
+    def _create_segment_store(self):
+        """Create the store that packs small objects into segment files, if 'segment_store' is enabled.
+
+        Objects of up to 'segment_object_size' bytes are appended to segments of 'segment_size' bytes, which
+        are compacted once less than the 'segment_compact_threshold' fraction of them is in use. Objects
+        left in segments by a previous run are dropped if the store has since been disabled.
+
+        The store is not used when there are several worker processes, as compaction would move objects
+        out from under the index entries of the others.
+
+        """
+        enabled = lib.config_enabled(self._node.config["segment_store"])
+        if enabled and self._workers > 1:
+            if self._worker == 0:
+                self._node.print_warn(TAG, 'Segment store is not used with several worker processes, for: %s' % self._expr)
+            enabled = False
+        stored = []
+        for key, (path, size, metadata) in self._server._index.items():
+            if 'offset' not in metadata:
+                continue
+            if enabled:
+                stored.append((key, path, metadata['offset'], size))
+            else:
+                self._server._index.remove(key, self._worker != 0)
+        if not enabled:
+            if self._worker == 0:
+                lib.delete_directory(self._segment_path())
+            return None
+        store = segment.SegmentStore(self._segment_path(), self._node.config["segment_size"],
+            self._node.config["segment_object_size"], self._node.config["segment_compact_threshold"],
+            self._server._disk_usage, self._relocate_object)
+        store.load(stored)
+        return store
+
+    def _segment_path(self):
+        """Get the directory holding the segments of this cache instance."""
+        return self._server_path + '/segments'
+
+    def _relocate_object(self, key, old_path, path, offset):
+        """Record an object moved to another segment by compaction in the object index."""
+        self._server._index.move(key, old_path, path, {'offset' : offset})
+
+    def _create_compressor(self):
+        """Create the compressor for objects stored by this cache instance, if 'compression' names an encoding (gzip).
+
+        Only objects whose content type starts with one of the 'compression_types' are compressed.
+
+        """
+        encoding = self._node.config["compression"].strip().lower()
+        if encoding in ('', 'none', 'off'):
+            return None
+        if encoding not in compression.ENCODINGS:
+            self._node.print_warn(TAG, 'Unsupported compression \'%s\', storing objects uncompressed' % self._node.config["compression"])
+            return None
+        return compression.Compressor(encoding, self._node.config["compression_types"], self._node.config["compression_level"])
+
+    def _migrate_layout(self):
+        """Move files stored under a different directory layout (such as the flat layout of earlier versions) into place.
+
+        Objects are found through the object index, and moved into the subdirectories given by
+        'directory_levels'. Partially stored objects are found at the top of the cache directory.
+
+        """
+        moved = 0
+        for key, (path, size, metadata) in self._server._index.items():
+            object_path = lib.shard_path(self._server_path, key, self._directory_levels)
+            if path == object_path or not path.startswith(self._server_path + '/') or 'offset' in metadata:
+                continue
+            try:
+                lib.create_directory(os.path.dirname(object_path))
+                os.rename(path, object_path)
+            except OSError as e:
+                self._node.print_warn(TAG, 'Could not move content into the directory layout: %s' % e)
+                continue
+            self._server._index.put(key, object_path, size, metadata)
+            moved += 1
+        for name in os.listdir(self._server_path):
+            key, separator, suffix = name.partition('.')
+            if not key or suffix not in ('part', 'ranges'):
+                continue
+            path = os.path.join(self._server_path, name)
+            partial_path = lib.shard_path(self._server_path, key, self._directory_levels) + separator + suffix
+            if path == partial_path:
+                continue
+            try:
+                lib.create_directory(os.path.dirname(partial_path))
+                os.rename(path, partial_path)
+            except OSError as e:
+                self._node.print_warn(TAG, 'Could not move content into the directory layout: %s' % e)
+                continue
+            moved += 1
+        if moved > 0:
+            self._node.print_info(TAG, 'Moved %d files into the directory layout for: %s' % (moved, self._expr))
 
     def _setup_signal_handling(self):
         """Setup signal handling for SIGQUIT and SIGINT events"""
@@ -85,12 +314,26 @@ class Server:
             else:
                 getattr(self, "_" + str(call))(path, transaction)
 
+    def _seed(self, key, transaction):
+        """Add an object seeded by the node (which has already recorded it in the database) to the object index."""
+        object_path = self._node.config["cache_path"] + 'shared/' + transaction
+        try:
+            size = os.path.getsize(object_path)
+        except OSError as e:
+            self._node.print_warn(TAG, 'Could not find seeded content on filesystem: %s' % e)
+            return
+        self._server._index.put(key, object_path, size, persist=False)
+
     def _send_message_to_controller(self, message):
-        """Send given message to controller notification port."""
-        context = zmq.Context()
-        ipc_socket = context.socket(zmq.PUSH)
-        ipc_socket.connect("tcp://" +  self._node.config["controller_host"] + ":" + self._node.config["notification_port"])
-        ipc_socket.send_json(message)
+        """Send given message to controller notification port. Only the first worker process speaks to the controller.
+
+        Stats and alerts are sent in batches, every 'notification_interval' seconds, with repeated alerts
+        collapsed into a summary (see Notifier).
+
+        """
+        if self._notifier is None:
+            return
+        self._notifier.send(message)
 
     def _stat_reporter(self):
         """Report statistics back to the controller periodcially."""
@@ -100,11 +343,94 @@ class Server:
     def _load_monitor(self):
         """Monitor the request load every second. Send alert to controller if it exceeds a configured amount."""
         threading.Timer(interval=int(1), function=self._load_monitor, args=()).start()
-        self._current_load = self._server._load
+        self._check_load()
+
+    def _check_load(self):
+        """Record the request load over the last second, alerting the controller if it exceeds 'alert_load'."""
+        self._current_load = self._server._load.reset()
+        if self._worker != 0:
+            self._push_counters(self._current_load)
+            return
+        for counters in self._worker_counters.values():
+            self._current_load += counters.get('load', 0)
         self._load_data.append(self._current_load)
-        self._server._load = 0
         if int(self._current_load) > int(self._node.config["alert_load"]):
             self._send_message_to_controller(self._get_alert('load', self._current_load))
+        if lib.config_enabled(self._node.config["metrics"]):
+            self._push_metrics()
+
+    def _worker_collector(self):
+        """Receive the counters pushed every second by the other worker processes serving this instance."""
+        context = zmq.Context()
+        worker_socket = context.socket(zmq.PULL)
+        worker_socket.bind(self._get_worker_address())
+        while True:
+            message = worker_socket.recv_json()
+            self._worker_counters[message['worker']] = message['counters']
+
+    def _push_counters(self, load):
+        """Push this worker process's counters, and its load over the last second, to the first worker.
+
+        Counters are dropped, rather than queued, if the first worker is not receiving them.
+
+        """
+        if self._worker_socket is None:
+            context = zmq.Context()
+            self._worker_socket = context.socket(zmq.PUSH)
+            self._worker_socket.setsockopt(zmq.LINGER, 0)
+            self._worker_socket.connect(self._get_worker_address())
+        counters = self._get_counters()
+        counters['load'] = load
+        counters['latency'] = self._server._latency.to_dict()
+        try:
+            self._worker_socket.send_json({'worker' : self._worker, 'counters' : counters}, zmq.NOBLOCK)
+        except zmq.ZMQError:
+            pass
+
+    def _push_metrics(self):
+        """Push this instance's metrics to the node, to be served from its metrics endpoint.
+
+        Metrics are dropped, rather than queued, if the node is not receiving them.
+
+        """
+        if self._metrics_socket is None:
+            context = zmq.Context()
+            self._metrics_socket = context.socket(zmq.PUSH)
+            self._metrics_socket.setsockopt(zmq.LINGER, 0)
+            self._metrics_socket.setsockopt(zmq.SNDHWM, 16)
+            self._metrics_socket.connect(metrics.ADDRESS)
+        try:
+            self._metrics_socket.send_json(self._get_metrics(), zmq.NOBLOCK)
+        except zmq.ZMQError:
+            pass
+
+    def _get_metrics(self):
+        """Get this instance's counters, gauges and latency histograms for the node's metrics endpoint.
+
+        Unlike '_get_stats', nothing is read from the database and no statistics are reset, so metrics
+        can be read as often as needed. The number of objects is that held in the object index.
+
+        """
+        counters, latency = self._get_totals()
+        snapshot = dict()
+        snapshot['expr'] = self._server._expr
+        snapshot['status'] = self._server._status
+        snapshot['load'] = self._current_load
+        snapshot['workers'] = self._workers
+        snapshot['cache_object'] = self._server._index.stored()
+        snapshot['cache_object_size'] = self._server._disk_usage.size()
+        snapshot['counters'] = counters
+        snapshot['latency'] = latency.to_dict()
+        return snapshot
+
+    def _get_worker_address(self):
+        """Get the address that worker processes push their counters to."""
+        return "ipc://oc-" + str(self._port)
+
+    def _disk_reconciler(self):
+        """Reconcile the running disk usage with the contents of the cache directory periodically."""
+        threading.Timer(interval=int(self._node.config["disk_scan_interval"]), function=self._disk_reconciler, args=()).start()
+        self._server._disk_usage.reconcile(self._server_path)
 
     def _get_average_load(self):
         """Calculate load average over given time."""
@@ -133,8 +459,8 @@ class Server:
         Set status to indicate new state.
 
         """
-        self._server._stop = False
         self._server._status = 'start'
+        self._server.resume()
         self._send_message_to_controller(self._get_redirect('add'))
 
     def _stop(self):
@@ -145,9 +471,16 @@ class Server:
 
         """
         self._send_message_to_controller(self._get_redirect('remove'))
-        self._server._stop = True
-        self._database.remove({'expr' : self._expr})
-        lib.delete_directory(self._server_path)
+        self._server.suspend()
+        self._server._memory.clear()
+        self._server._partial.clear()
+        self._server._eviction.clear()
+        if self._server._segments is not None:
+            self._server._segments.clear()
+        self._server._disk_usage.reset()
+        self._server._index.clear()
+        if self._worker == 0:
+            lib.delete_directory(self._server_path)
         self._server._status = 'stop'
         self._stat()
 
@@ -158,7 +491,7 @@ class Server:
 
         """
         self._send_message_to_controller(self._get_redirect('remove'))
-        self._server._stop = True
+        self._server.suspend()
         self._server._status = 'pause'
 
     def _get_redirect(self, action):
@@ -176,24 +509,12 @@ class Server:
 
     def _stat(self):
         """Retrieve statistics for this HTTP server and send them to the controller."""
+        if self._worker != 0:
+            return
         self._send_message_to_controller(self._get_stats())
 
     def _get_stats(self):
-        """Get message body for a statistics notification to the controller.
-
-        The statistics returned to the controller include:
-
-        status -- current status of the HTTP server
-        expr -- the OpenCache expression to which this node is serving
-        node_id -- the ID number given to the node by the OpenCache controller
-        cache_miss -- number of cache miss (content not found in cache) events (one per request)
-        cache_miss_size -- number of bytes served whilst handling cache miss (content not found in cache) events
-        cache_hit -- number of cache hit (content already found in cache) events (one per request)
-        cache_hit_size -- number of bytes served whilst handling cache hit (content already found in cache) events
-        cache_object -- number of objects currently stored by the cache
-        cache_object_size -- size of cached objects on disk (actual, in bytes)
-
-        """
+        """Get message body for a statistics notification to the controller. The statistics are described in opencachemetrics."""
         statistics = dict()
         statistics['method'] = 'stat'
         statistics['id'] = None
@@ -202,35 +523,281 @@ class Server:
         statistics['params']['avg_load'] = self._get_average_load()
         statistics['params']['expr'] = self._server._expr
         statistics['params']['node_id'] = self._node.node_id
-        statistics['params']['cache_miss'] = self._server._cache_miss
-        statistics['params']['cache_miss_size'] = self._server._cache_miss_size
-        statistics['params']['cache_hit'] = self._server._cache_hit
-        statistics['params']['cache_hit_size'] = self._server._cache_hit_size
-        statistics['params']['cache_object'] = len(self._database.lookup({}))
-        dir_size = get_dir_size(self._server_path)
-        statistics['params']['cache_object_size'] = dir_size
+        counters, latency = self._get_totals()
+        statistics['params'].update(counters)
+        statistics['params'].update(latency.percentiles())
+        statistics['params']['latency'] = latency.to_dict()
+        if counters['connection_requests'] > 0:
+            statistics['params']['connection_reuse'] = max(0.0, 1.0 - float(counters['connection_count']) / counters['connection_requests'])
+        else:
+            statistics['params']['connection_reuse'] = 0.0
+        statistics['params']['cache_object'] = self._get_object_count()
+        statistics['params']['cache_object_size'] = self._server._disk_usage.size()
+        statistics['params']['workers'] = self._workers
+        if self._server._index.keys is not None:
+            statistics['params']['key_filter_size'] = self._server._index.keys.size
+            statistics['params']['key_filter_false_positive'] = self._server._index.keys.false_positive_rate()
+        else:
+            statistics['params']['key_filter_size'] = 0
+            statistics['params']['key_filter_false_positive'] = 0.0
+        statistics['params'].update(self._server.get_worker_stats())
         return statistics
 
+    def _get_totals(self):
+        """Get the counters, and the latency histograms, of this and every other worker process (as last pushed) added together."""
+        counters = self._get_counters()
+        latency = RequestLatency()
+        latency.merge_dict(self._server._latency.to_dict())
+        for worker_counters in self._worker_counters.values():
+            for name in counters:
+                counters[name] += worker_counters.get(name, 0)
+            latency.merge_dict(worker_counters.get('latency', dict()))
+        return counters, latency
+
+    def _get_counters(self):
+        """Get the statistics of this worker process that are added together with those of the other workers."""
+        counters = dict()
+        counters['cache_miss'] = self._server._cache_miss.value()
+        counters['cache_miss_size'] = self._server._cache_miss_size.value()
+        counters['cache_hit'] = self._server._cache_hit.value()
+        counters['cache_hit_size'] = self._server._cache_hit_size.value()
+        counters['cache_coalesced'] = self._server._cache_coalesced.value()
+        counters['cache_revalidated'] = self._server._cache_revalidated.value()
+        counters['cache_not_modified'] = self._server._cache_not_modified.value()
+        counters['cache_eviction'] = self._server._eviction.evicted
+        counters['cache_eviction_size'] = self._server._eviction.evicted_size
+        counters['connection_count'] = self._server._connections.value()
+        counters['connection_requests'] = self._server._requests_served.value()
+        counters['origin_connection'] = self._server._origins.created
+        counters['origin_connection_reused'] = self._server._origins.reused
+        counters['key_filter_skipped'] = self._server._index.filtered
+        if self._server._segments is not None:
+            counters['segment_object'] = self._server._segments.count()
+            counters['segment_compacted'] = self._server._segments.compacted
+        else:
+            counters['segment_object'] = 0
+            counters['segment_compacted'] = 0
+        counters['memory_hit'] = self._server._memory.hit
+        counters['memory_miss'] = self._server._memory.miss
+        counters['memory_eviction'] = self._server._memory.eviction
+        counters['memory_object'] = self._server._memory.count()
+        counters['memory_object_size'] = self._server._memory.size
+        return counters
+
+    def _get_object_count(self):
+        """Get the number of objects stored for this expression.
+
+        This is kept up to date by the object index as objects are stored and removed. Should the index not
+        have been loaded from the database, or be shared with other worker processes, the objects recorded
+        in the database are counted instead.
+
+        """
+        if self._server._index.loaded and not self._server._index.shared:
+            return self._server._index.stored()
+        return self._database.count({'expr' : self._expr})
+
+    def _disk_check(self):
+        """Check if it possible to write a given object to disk.
+
+        If the current directory size is greater than the 'alert_disk' configuration setting, send an alert to the controller.
+        Objects are evicted in the background to stay within 'max_disk', so storing is only refused if the directory
+        is over 'max_disk' and there are no objects left to evict. The directory size is the running total kept as
+        objects are stored and removed, which also decides when objects are evicted.
+
+        """
+        dir_size = self._server._disk_usage.size()
+        if int(dir_size) > int(self._node.config["alert_disk"]):
+            self._send_message_to_controller(self._get_alert('disk', dir_size))
+            if int(dir_size) > int(self._node.config["max_disk"]) and self._server._eviction.count() == 0:
+                return False
+        return True
+
+    def _get_object_path(self, key):
+        """Get the path an object should be stored at: where it is already held, if it has a file of its own."""
+        entry = self._server._index.get(key)
+        if entry is not None and 'offset' not in entry[2]:
+            return entry[0]
+        return lib.shard_path(self._server_path, key, self._directory_levels)
+
+    def _store_object(self, key, temp_path, object_path, metadata=None):
+        """Atomically move a completely fetched object into place and record it (and its metadata) in the object index."""
+        try:
+            temp_path, metadata = self._compress_object(temp_path, metadata)
+            size = os.path.getsize(temp_path)
+            segments = self._server._segments
+            if segments is not None and segments.admits(size) and object_path.startswith(self._server_path + '/'):
+                self._store_segment_object(key, temp_path, object_path, size, metadata)
+                return
+            if segments is not None:
+                segments.remove(key)
+            try:
+                replaced = os.path.getsize(object_path)
+            except OSError:
+                replaced = None
+            os.rename(temp_path, object_path)
+            if replaced is None:
+                self._server._disk_usage.add(size)
+            else:
+                self._server._disk_usage.add(size - replaced, 0)
+            self._server._memory.remove(key)
+            self._server._partial.remove(key)
+            self._server._index.put(key, object_path, size, metadata, persist=object_path.startswith(self._server_path + '/'))
+            if object_path.startswith(self._server_path + '/'):
+                self._server._eviction.add(key, object_path, size)
+        except (IOError, OSError) as e:
+            self._node.print_warn(TAG, ('Could not save content to filesystem: %s' % e))
+            discard_file(temp_path)
+
+    def _store_segment_object(self, key, temp_path, object_path, size, metadata):
+        """Append a small fetched object to the segment store, recording its segment and offset in the object index.
+
+        Any copy of the object previously stored in a file of its own is removed.
+
+        """
+        with open(temp_path, 'rb') as f:
+            data = f.read()
+        path, offset = self._server._segments.append(key, data)
+        discard_file(temp_path)
+        metadata = dict(metadata or dict())
+        metadata['offset'] = offset
+        metadata['stored'] = time.time()
+        self._server._memory.remove(key)
+        self._server._partial.remove(key)
+        self._server._index.put(key, path, size, metadata)
+        self._server._eviction.add(key, path, size)
+        try:
+            replaced = os.path.getsize(object_path)
+            os.remove(object_path)
+            self._server._disk_usage.add(-replaced, -1)
+        except OSError:
+            pass
+
+    def _compress_object(self, temp_path, metadata):
+        """Compress a fetched object before it is stored, if its content type is one configured for compression.
+
+        Returns the path of the file to store, and the object's metadata, which records the encoding and
+        the uncompressed length of a compressed object.
+
+        """
+        compressor = self._server._compression
+        if compressor is None or metadata is None or not compressor.compressible(object_headers(metadata)):
+            return temp_path, metadata
+        try:
+            length = os.path.getsize(temp_path)
+            compressed_path = compressor.compress_file(temp_path)
+        except (IOError, OSError) as e:
+            self._node.print_warn(TAG, ('Could not compress content, storing it uncompressed: %s' % e))
+            return temp_path, metadata
+        if compressed_path is None:
+            return temp_path, metadata
+        discard_file(temp_path)
+        metadata = dict(metadata)
+        metadata['encoding'] = compressor.encoding
+        metadata['length'] = length
+        return compressed_path, metadata
+
+    def _refresh_object(self, key, metadata):
+        """Record the new freshness of a stale object that the origin has confirmed is unchanged."""
+        entry = self._server._index.get(key)
+        if entry is None:
+            return
+        path, size, previous = entry
+        metadata = dict(metadata)
+        for name in ('encoding', 'length', 'offset', 'stored'):
+            if name in previous:
+                metadata[name] = previous[name]
+        if 'offset' in previous:
+            # Compaction may move the object meanwhile, so only refresh it where it was found.
+            self._server._index.move(key, path, path, metadata)
+        else:
+            self._server._index.put(key, path, size, metadata, persist=path.startswith(self._server_path + '/'))
+        self._server._memory.replace_headers(key, object_headers(metadata))
+        self._server._cache_revalidated.increment()
+
+    def _forget_missing_object(self, key):
+        """Drop an object that could not be read from the object index, the memory tier and the evictor, if it is no longer on disk."""
+        entry = self._server._index.get(key)
+        if entry is None:
+            return
+        path, size, metadata = entry
+        if 'offset' in metadata and self._server._segments is not None:
+            try:
+                self._server._segments.read(path, metadata['offset'], size)
+                return
+            except IOError:
+                pass
+        elif 'offset' not in metadata and os.path.exists(path):
+            return
+        self._node.print_info(TAG, 'Cache object missing from filesystem, forgetting it: %s (%s)' %(self._expr, key))
+        self._server._index.remove(key)
+        self._server._memory.remove(key)
+        self._server._eviction.remove(key)
+
+    def _evict_object(self, key, path, size):
+        """Remove an object chosen for eviction from the object index (and database), the memory tier and the disk."""
+        self._node.print_debug(TAG, 'cache evicted: %s (%s)' %(self._expr, key))
+        try:
+            self._server._index.remove(key)
+            self._server._memory.remove(key)
+            if self._server._segments is not None and self._server._segments.holds(path):
+                self._server._segments.remove(key)
+            else:
+                os.remove(path)
+                self._server._disk_usage.add(-size, -1)
+        except Exception as e:
+            self._node.print_warn(TAG, ('Could not evict content from filesystem: %s' % e))
+
     def _set_path(self, expr):
         """Set the path used to store cached content specific to this HTTP server's expression."""
         self._server_path = self._node.config["cache_path"] + hashlib.sha224(expr).hexdigest()
 
-    class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
-        """Create a threaded HTTP server."""
-        allow_reuse_address = True
-        daemon_threads = True
-        _stop = True
-        _status = 'start'
-        _cache_hit_size = 0
-        _cache_miss_size = 0
-        _cache_hit = 0
-        _cache_miss = 0
-        _load = 0
+    class BaseCacheServer:
+        """The state and request counters of a cache instance, without a socket or worker pool of its own."""
+        _running = None
+        _cache_hit_size = None
+        _cache_miss_size = None
+        _cache_hit = None
+        _cache_miss = None
+        _cache_coalesced = None
+        _cache_revalidated = None
+        _cache_not_modified = None
+        _latency = None
+        _load = None
         _status = None
         _node = None
         _server_path = None
         _expr = None
         _server = None
+        _memory = None
+        _sendfile = True
+        _default_max_age = 0
+        _compression = None
+        _inflight = None
+        _inflight_lock = None
+        _partial = None
+        _eviction = None
+        _index = None
+        _disk_usage = None
+        _origins = None
+        _keep_alive_timeout = None
+        _keep_alive_requests = 0
+
+        def __init__(self):
+            """Create the (initially paused) running state and the request counters."""
+            self._running = threading.Event()
+            self._cache_hit_size = Counter()
+            self._cache_miss_size = Counter()
+            self._cache_hit = Counter()
+            self._cache_miss = Counter()
+            self._cache_coalesced = Counter()
+            self._cache_revalidated = Counter()
+            self._cache_not_modified = Counter()
+            self._latency = RequestLatency()
+            self._load = Counter()
+            self._connections = Counter()
+            self._requests_served = Counter()
+            self._handlers = set()
+            self._handlers_lock = threading.Lock()
 
         def _setup_signal_handling(self):
             """Setup signal handling for SIGQUIT and SIGINT events"""
@@ -240,156 +807,1313 @@ class Server:
         def _exit_server(self, signal, frame):
             raise SystemExit
 
+        def get_worker_stats(self):
+            """Get worker pool utilisation and queue waiting time since the last call. There is no worker pool here."""
+            return dict()
+
+        def resume(self):
+            """Start accepting requests."""
+            self._running.set()
+
+        def suspend(self):
+            """Stop accepting requests. Persistent connections already open are closed once any request in progress on them has been answered."""
+            self._running.clear()
+            self._close_connections()
+
+        def add_handler(self, handler):
+            """Track the handler of a connection that has been opened, so that it can be closed on suspending."""
+            with self._handlers_lock:
+                self._handlers.add(handler)
+
+        def remove_handler(self, handler):
+            with self._handlers_lock:
+                self._handlers.discard(handler)
+
+        def _close_connections(self):
+            with self._handlers_lock:
+                handlers = list(self._handlers)
+            for handler in handlers:
+                handler.close_when_done()
+
+    class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer, BaseCacheServer):
+        """Create a threaded HTTP server."""
+        allow_reuse_address = True
+        daemon_threads = True
+        _wakeup = None
+        _reject = False
+        _reuse_port = False
+
+        def __init__(self, server_address, RequestHandlerClass, reuse_port=False):
+            """Create the listening socket, the (initially paused) running state and the request counters.
+
+            If 'reuse_port' is set, other processes may listen on the same port, with the kernel sharing
+            connections out between them.
+
+            """
+            self._reuse_port = reuse_port
+            BaseHTTPServer.HTTPServer.__init__(self, server_address, RequestHandlerClass)
+            Server.BaseCacheServer.__init__(self)
+            self._wakeup = os.pipe()
+            self._requests = None
+            self._worker_threads = 0
+            self._worker_busy_time = Counter()
+            self._worker_queue_wait = Counter()
+            self._worker_dequeued = Counter()
+            self._worker_rejected = Counter()
+            self._worker_stats_time = time.time()
+
+        def server_bind(self):
+            """Bind the listening socket, allowing other worker processes to bind the same port if 'reuse_port' is set."""
+            if self._reuse_port:
+                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            BaseHTTPServer.HTTPServer.server_bind(self)
+
+        def start_workers(self, threads, queue_depth, reject):
+            """Pre-spawn a bounded pool of worker threads to handle connections.
+
+            Accepted connections wait in a queue of at most 'queue_depth' for a free worker. If the queue is
+            full, the connection is rejected with a 503 when 'reject' is set; otherwise accepting is held up
+            until there is room (leaving further connections in the listen backlog). With no threads, a new
+            thread is created for each connection instead.
+
+            """
+            if threads <= 0:
+                return
+            self._requests = Queue.Queue(maxsize=max(1, queue_depth))
+            self._worker_threads = threads
+            self._reject = reject
+            for i in range(threads):
+                worker = threading.Thread(target=self._work, args=())
+                worker.daemon = True
+                worker.start()
+
+        def process_request(self, request, client_address):
+            """Queue the connection for the worker pool (if there is one), or start a new thread for it."""
+            if self._requests is None:
+                SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+                return
+            try:
+                self._requests.put((request, client_address, time.time()), block=not self._reject)
+            except Queue.Full:
+                self._reject_request(request)
+
+        def _reject_request(self, request):
+            """Turn away a connection that there is no room to queue."""
+            self._worker_rejected.increment()
+            try:
+                request.sendall('HTTP/1.1 503 Service Unavailable\r\nContent-length: 0\r\nConnection: close\r\n\r\n')
+            except socket.error:
+                pass
+            self.shutdown_request(request)
+
+        def _work(self):
+            """Handle queued connections, one at a time."""
+            while True:
+                request, client_address, queued = self._requests.get()
+                started = time.time()
+                self._worker_queue_wait.increment(started - queued)
+                self._worker_dequeued.increment()
+                try:
+                    self.finish_request(request, client_address)
+                except Exception:
+                    self.handle_error(request, client_address)
+                finally:
+                    self.shutdown_request(request)
+                    self._worker_busy_time.increment(time.time() - started)
+
+        def get_worker_stats(self):
+            """Get worker pool utilisation and queue waiting time since the last call."""
+            if self._requests is None:
+                return dict()
+            now = time.time()
+            elapsed = max(now - self._worker_stats_time, 0.001)
+            self._worker_stats_time = now
+            dequeued = self._worker_dequeued.reset()
+            queue_wait = self._worker_queue_wait.reset()
+            stats = dict()
+            stats['worker_threads'] = self._worker_threads
+            stats['worker_utilisation'] = min(1.0, self._worker_busy_time.reset() / (elapsed * self._worker_threads))
+            stats['worker_queue_wait'] = queue_wait / dequeued if dequeued else 0.0
+            stats['worker_queue'] = self._requests.qsize()
+            stats['worker_rejected'] = self._worker_rejected.value()
+            return stats
+
+        def resume(self):
+            """Start accepting requests."""
+            Server.BaseCacheServer.resume(self)
+            os.write(self._wakeup[1], 'r')
+
+        def suspend(self):
+            """Stop accepting requests. Connections wait in the listen backlog until resumed.
+
+            Persistent connections already open are closed once any request in progress on them has been answered.
+
+            """
+            self._running.clear()
+            os.write(self._wakeup[1], 's')
+            self._close_connections()
+
         def serve_forever (self):
-            """Overide default behaviour to handle one request at a time until state is changed.
+            """Overide default behaviour to serve requests only whilst in the 'start' state.
 
-            Serve content as long as the HTTP server is a 'start' state. When 'paused' or 'stopped',
-            requests will not be handled.
+            Blocks until either a connection arrives or the state is changed (signalled through the
+            wakeup pipe), so no CPU is used whilst 'paused' or 'stopped'. When running, each accepted
+            connection is handed to the worker pool (or its own thread).
 
             """
             while True:
-                if self._stop != True:
-                    self.handle_request()
-                    self._load += 1
+                if self._running.is_set():
+                    waiting = [self.socket, self._wakeup[0]]
+                else:
+                    waiting = [self._wakeup[0]]
+                try:
+                    readable, writable, exceptional = select.select(waiting, [], [])
+                except select.error as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                if self._wakeup[0] in readable:
+                    os.read(self._wakeup[0], 512)
+                if self.socket in readable and self._running.is_set():
+                    self._handle_request_noblock()
 
     class HandlerClass(BaseHTTPServer.BaseHTTPRequestHandler):
 
         protocol_version = 'HTTP/1.1'
+        wbufsize = -1
 
         def log_message( self, format, *args ):
             """Ignore log messages."""
             pass
 
+        def setup(self):
+            """Apply the idle timeout to a new (persistent) connection, and count it."""
+            self.timeout = self.server._keep_alive_timeout
+            self._request_count = 0
+            self._connection_header = False
+            self._first_byte = None
+            self._cached = None
+            BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+            self.server._connections.increment()
+            self.server.add_handler(self)
+
+        def finish(self):
+            try:
+                BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+            finally:
+                self.server.remove_handler(self)
+
+        def close_when_done(self):
+            """Close the connection once any request in progress has been answered, or now if it is waiting for one."""
+            self.close_connection = 1
+            try:
+                self.connection.shutdown(socket.SHUT_RD)
+            except socket.error:
+                pass
+
+        def parse_request(self):
+            self._started = time.time()
+            self._first_byte = None
+            self._missed = False
+            self._cached = None
+            if not BaseHTTPServer.BaseHTTPRequestHandler.parse_request(self):
+                return False
+            return self._accept_request()
+
+        def _accept_request(self):
+            """Count each request towards the load. Close the connection after the configured number of requests, or if suspended."""
+            self._request_count += 1
+            self.server._requests_served.increment()
+            self.server._load.increment()
+            if self.server._keep_alive_requests > 0 and self._request_count >= self.server._keep_alive_requests:
+                self.close_connection = 1
+            if not self.server._running.is_set():
+                self.close_connection = 1
+            return True
+
+        def send_response(self, code, message=None):
+            self._connection_header = False
+            BaseHTTPServer.BaseHTTPRequestHandler.send_response(self, code, message)
+
+        def send_header(self, keyword, value):
+            if keyword.lower() == 'connection':
+                self._connection_header = True
+            BaseHTTPServer.BaseHTTPRequestHandler.send_header(self, keyword, value)
+
+        def end_headers(self):
+            """Tell the client whether the connection will persist after this response, and the age of a cached object sent."""
+            if self._cached is not None and freshness.age(self._cached) is not None:
+                self.send_header('Age', freshness.age(self._cached))
+            if not self._connection_header:
+                if self.close_connection:
+                    self.send_header('Connection', 'close')
+                elif self.request_version == 'HTTP/1.0':
+                    self.send_header('Connection', 'keep-alive')
+            BaseHTTPServer.BaseHTTPRequestHandler.end_headers(self)
+            if self._first_byte is None:
+                self._first_byte = time.time()
+
+        def _send_empty(self, code):
+            """Send a response with no body, leaving the connection usable for further requests."""
+            self.send_response(code)
+            self.send_header('Content-length', 0)
+            self.end_headers()
+
         def do_GET(self):
             """Handle incoming GET messages from clients.
 
-            Calculate hash value for content request. Check to see if this has already been cached.
-            If it has, a cache hit occurs. If the content is not present on the disk or has not
-            been cached previously, a cache miss occurs.
+            Calculate hash value for content request. Check to see if this has already been cached (in the
+            object index). If it has, a cache hit occurs; the hottest objects are served from the memory
+            tier without consulting the disk. If the content is not present on the disk or has not been
+            cached previously, a cache miss occurs.
+
+            Requests with a 'Range' header are answered with just the byte ranges asked for (206).
+
+            Cached objects that have gone stale are revalidated with the origin before being served. Conditional
+            requests for an object that has not changed are answered with a 304 from the object index alone.
+            Responses from the cache (including 304s) carry the object's current 'Age'.
+
+            The latency of each request is recorded once it has been answered.
 
             """
+            try:
+                self._get()
+            finally:
+                self.server._latency.record(self._missed, self._started, self._first_byte, time.time())
+
+        def _get(self):
             key = hashlib.sha224(self.path).hexdigest()
-            if len(self.server._server._database.lookup({'key' : key})) == 1:
+            entry = self.server._index.get(key) or self.server._index.find(key)
+            if entry is not None and not freshness.is_fresh(entry[2]):
+                entry = self._revalidate(key, entry)
+                if entry is None:
+                    return
+            if entry is not None:
+                self._cached = entry[2]
+            if entry is not None and self._not_modified(entry[2]):
+                return
+            if self._memory_hit(key, entry):
+                return
+            if entry is not None:
                 try:
-                    self._cache_hit(key)
+                    self._cache_hit(key, entry)
                 except (IOError, OSError) as e:
                     self.server._node.print_warn(TAG, ('Could not retrieve content from filesystem, cache miss\'ing instead: %s' % e))
-                    self._cache_miss(key)
+                    self.server._server._forget_missing_object(key)
+                    self._miss(key)
             else:
-                self._cache_miss(key)
+                self._miss(key)
 
         def do_POST(self):
-            """Ignore POST messages."""
-            pass
+            """Ignore POST messages. The body is not read, so the connection is closed after answering."""
+            self.close_connection = 1
+            self._send_empty(501)
+
+        def _miss(self, key):
+            """Handle a cache miss for the whole object or, if only some byte ranges were requested, for those ranges."""
+            self._cached = None
+            if self.headers.getheader('range') is None:
+                self._cache_miss(key)
+            else:
+                self._range_miss(key)
+
+        def _requested_ranges(self, length, modified, etag=None):
+            """Get the byte ranges requested of an object stored at the given time, or None to send all of it."""
+            return byte_range.requested_ranges(self.headers.getheader('range'), self.headers.getheader('if-range'),
+                length, modified, etag)
+
+        def _revalidate(self, key, entry):
+            """Ask the origin whether a stale object has changed, sending the validators held for it.
+
+            If the origin answers 304, the object's freshness is refreshed and its (updated) index entry is
+            returned, to be served from the cache. If the object has changed, the origin's response is
+            relayed and stored as for any cache miss, and None is returned. Objects held without validators
+            are simply fetched again. Should the origin be unreachable, the stale object is served.
+
+            Only one request revalidates an object at a time, through the same table of flights as cache
+            misses. Other requests for the object wait for its answer (see '_wait_for_revalidation').
+
+            """
+            headers = freshness.conditional_headers(entry[2])
+            if not headers:
+                self._miss(key)
+                return None
+            with self.server._inflight_lock:
+                flight = self.server._inflight.get(key)
+                leader = flight is None
+                if leader:
+                    flight = Flight()
+                    self.server._inflight[key] = flight
+            if not leader:
+                return self._wait_for_revalidation(key, flight, entry)
+            self.server._node.print_debug(TAG, 'cache revalidate: %s%s' %(self.server._expr, self.path))
+            try:
+                try:
+                    connection, response = self.server._origins.request(self.server._expr, self.path, headers)
+                except (httplib.HTTPException, socket.error) as e:
+                    self.server._node.print_warn(TAG, 'Could not revalidate content with origin server, serving stale copy: %s' % e)
+                    flight.finish(True, cached=True)
+                    return entry
+                if response.status != httplib.NOT_MODIFIED:
+                    self._cache_miss(key, (connection, response), flight)
+                    return None
+                response.read()
+                self.server._origins.release(self.server._expr, connection, response)
+                self.server._server._refresh_object(key, object_metadata(response, self.server._default_max_age, entry[2]))
+                flight.finish(True, cached=True)
+                return self.server._index.get(key) or entry
+            finally:
+                flight.finish(False)
+                with self.server._inflight_lock:
+                    if self.server._inflight.get(key) is flight:
+                        del self.server._inflight[key]
+
+        def _wait_for_revalidation(self, key, flight, entry):
+            """Wait for another request's revalidation (or fetch) of an object, and share its answer.
+
+            If the object was unchanged (or the origin could not be reached), the cached object's index
+            entry is returned, to be served. If it has changed, the new object is streamed from the fetch
+            as it arrives, and None is returned. Should that not be possible, the object is fetched again.
+
+            """
+            self.server._node.print_debug(TAG, 'cache revalidate (coalesced): %s%s' %(self.server._expr, self.path))
+            flight.wait_for_start()
+            if flight.cached():
+                return self.server._index.get(key) or entry
+            self._missed = True
+            bytes_sent = self._attach_to_flight(flight)
+            if bytes_sent is None:
+                self._miss(key)
+                return None
+            self.server._cache_miss.increment()
+            self.server._cache_miss_size.increment(bytes_sent)
+            self.server._cache_coalesced.increment()
+            return None
+
+        def _not_modified(self, metadata):
+            """Answer a conditional request with a 304 if the cached object satisfies it. Return True if answered."""
+            if_none_match = self.headers.getheader('if-none-match')
+            if_modified_since = self.headers.getheader('if-modified-since')
+            if if_none_match is None and if_modified_since is None:
+                return False
+            if not freshness.not_modified(if_none_match, if_modified_since, metadata):
+                return False
+            self.server._node.print_debug(TAG, 'cache not modified: %s%s' %(self.server._expr, self.path))
+            self.send_response(304)
+            for name, value in not_modified_headers(metadata):
+                self.send_header(name, value)
+            self.end_headers()
+            self.server._cache_hit.increment()
+            self.server._cache_not_modified.increment()
+            return True
+
+        def _memory_hit(self, key, entry=None):
+            """Serve the object from the memory tier, if it is held there. Return True if the object was served.
 
-        def _cache_hit(self, key):
+            The time at which an object was stored is not kept in memory, so conditional range requests
+            ('If-Range') are left to be served from the disk, unless they carry the object's entity tag.
+
+            """
+            etag = entry[2].get('etag') if entry is not None else None
+            if_range = self.headers.getheader('if-range')
+            if self.headers.getheader('range') is not None and if_range is not None and if_range.strip() != etag:
+                return False
+            cached = self.server._memory.get(key)
+            if cached is None:
+                return False
+            headers, local_object = cached
+            self.server._node.print_debug(TAG, 'memory hit: %s%s' %(self.server._expr, self.path))
+            self.server._eviction.touch(key)
+            hit_size = self._send_data(key, local_object, entry[2] if entry is not None else dict(), headers, None)
+            self.server._cache_hit.increment()
+            self.server._cache_hit_size.increment(hit_size)
+            return True
+
+        def _cache_hit(self, key, entry):
             """The content has been seen before, and should be sent to the client using the cached copy.
 
-            Statistics updated accordingly.
+            Objects small enough for the memory tier are read and promoted to it, so that subsequent hits
+            avoid the database and the disk. Larger objects are streamed straight from the file to the
+            client socket (when 'sendfile' is enabled), using constant memory. Byte ranges are sent straight
+            from the file. Compressed objects are sent as they are to clients that accept their encoding, and
+            decompressed for the rest. Small objects packed into segment files are read through the segment's
+            memory map. Statistics updated accordingly.
 
             """
 
-            path = self.server._server._database.lookup({'key' : key})[0]['path']
             try:
                 self.server._node.print_debug(TAG, 'cache hit: %s%s' %(self.server._expr, self.path))
-                f = open(path, 'r')
-                local_object = f.read()
-                self._send_object(local_object)
-                f.close()
-                self.server._cache_hit += 1
-                self.server._cache_hit_size += sys.getsizeof(local_object)
+                if 'offset' in entry[2]:
+                    self._segment_hit(key, entry)
+                    return
+                f = open(entry[0], 'rb')
+                self.server._eviction.touch(key)
+                try:
+                    stat = os.fstat(f.fileno())
+                    length = stat.st_size
+                    headers = object_headers(entry[2])
+                    ranges = None
+                    if 'encoding' not in entry[2]:
+                        ranges = self._requested_ranges(length, stat.st_mtime, entry[2].get('etag'))
+                    if 'encoding' in entry[2]:
+                        hit_size = self._send_encoded(key, f, entry[2], headers, stat.st_mtime)
+                    elif ranges is not None:
+                        hit_size = self._send_ranges(f, length, ranges, headers)
+                    elif self.server._sendfile and not self.server._memory.admits(length):
+                        hit_size = self._send_file(f, length, headers)
+                    else:
+                        local_object = f.read()
+                        hit_size = self._send_object(local_object, headers)
+                        self.server._memory.put(key, headers, local_object)
+                finally:
+                    f.close()
+                self.server._cache_hit.increment()
+                self.server._cache_hit_size.increment(hit_size)
             except IOError:
                 raise
 
-        def _cache_miss(self, key):
+        def _segment_hit(self, key, entry):
+            """Serve an object held in a segment file, and promote it to the memory tier.
+
+            Compaction may have moved the object since it was looked up, so it is read from wherever the
+            object index now says it is. Raises IOError if the object is no longer held.
+
+            """
+            path, size, metadata = self.server._index.get(key) or entry
+            local_object = self.server._segments.read(path, metadata['offset'], size)
+            self.server._eviction.touch(key)
+            headers = object_headers(metadata)
+            self.server._memory.put(key, headers, local_object)
+            hit_size = self._send_data(key, local_object, metadata, headers, metadata.get('stored'))
+            self.server._cache_hit.increment()
+            self.server._cache_hit_size.increment(hit_size)
+
+        def _send_data(self, key, data, metadata, headers, modified):
+            """Deliver an object held in memory (all of it, or the byte ranges requested). Returns the number of bytes sent."""
+            if 'encoding' in metadata:
+                return self._send_encoded(key, data, metadata, headers, modified)
+            ranges = self._requested_ranges(len(data), modified, metadata.get('etag'))
+            if ranges is None:
+                return self._send_object(data, headers)
+            return self._send_ranges(data, len(data), ranges, headers)
+
+        def _cache_miss(self, key, fetched=None, flight=None):
             """The content has not been seen before, and needs to be retrieved before it can be
              sent to the client.
 
-            Once the content has been delivered, the object can be stored on disk to serve future
+            The content is streamed to the client and, if there is room on disk, to a temporary file
+            at the same time. Once the body is complete, the file is moved into place to serve future
             cache requests. Statistics updated accordingly.
 
+            Only one origin fetch is made per object at a time. Requests for an object that is already
+            being fetched attach to that fetch, and stream from the temporary file as it grows.
+
+            A (connection, response) already 'fetched' from the origin, when revalidating a stale object, is
+            used rather than making another request. The revalidating request passes the 'flight' it leads.
+
             """
             self.server._node.print_debug(TAG, 'cache miss: %s%s' %(self.server._expr, self.path))
-            remote_object = self._fetch_and_send_object(self.server._expr)
-            if self._disk_check():
-                lookup = self.server._server._database.lookup({'key' : key})
-                if len(lookup) == 1:
-                    object_path = lookup[0]['path']
+            self._missed = True
+            leader = flight is not None
+            if not leader:
+                with self.server._inflight_lock:
+                    flight = self.server._inflight.get(key)
+                    leader = flight is None
+                    if leader:
+                        flight = Flight()
+                        self.server._inflight[key] = flight
+            if not leader:
+                if fetched is not None:
+                    fetched[0].close()
+                    fetched = None
+                bytes_sent = self._attach_to_flight(flight)
+                if bytes_sent is not None:
+                    self.server._cache_miss.increment()
+                    self.server._cache_miss_size.increment(bytes_sent)
+                    self.server._cache_coalesced.increment()
+                    return
+                flight = None
+            try:
+                self._lead_cache_miss(key, flight, fetched)
+            finally:
+                if flight is not None:
+                    flight.finish(False)
+                    with self.server._inflight_lock:
+                        del self.server._inflight[key]
+
+        def _lead_cache_miss(self, key, flight, fetched=None):
+            """Fetch a missing object from the origin, on behalf of this and any attached requests."""
+            object_path = None
+            if self.server._server._disk_check():
+                object_path = self.server._server._get_object_path(key)
+            else:
+                self.server._node.print_info(TAG, 'Cache instance has reached maximum disk usage and cannot store object: %s%s' %(self.server._expr, self.path))
+            bytes_read, temp_path, metadata = self._fetch_and_send_object(self.server._expr, object_path, flight, fetched)
+            if temp_path is not None:
+                self.server._server._store_object(key, temp_path, object_path, metadata)
+            self.server._cache_miss.increment()
+            self.server._cache_miss_size.increment(bytes_read)
+
+        def _range_miss(self, key):
+            """Some byte ranges of an object that has not been cached have been requested.
+
+            If earlier range requests have already fetched all of the ranges asked for, they are sent from
+            the partially stored object. Otherwise, just those ranges are fetched from the origin. Statistics
+            updated accordingly.
+
+            """
+            held = self.server._partial.get(key)
+            if held is not None:
+                length, held_ranges, modified = held
+                ranges = self._requested_ranges(length, modified)
+                if ranges is not None and self.server._partial.covers(key, ranges):
+                    try:
+                        f = open(self.server._partial.data_path(key), 'rb')
+                    except IOError:
+                        f = None
+                    if f is not None:
+                        self.server._node.print_debug(TAG, 'cache hit (partial): %s%s' %(self.server._expr, self.path))
+                        try:
+                            hit_size = self._send_ranges(f, length, ranges)
+                        finally:
+                            f.close()
+                        self.server._cache_hit.increment()
+                        self.server._cache_hit_size.increment(hit_size)
+                        return
+            self.server._node.print_debug(TAG, 'cache miss (range): %s%s' %(self.server._expr, self.path))
+            self._missed = True
+            bytes_read = self._fetch_and_send_range(self.server._expr, key)
+            self.server._cache_miss.increment()
+            self.server._cache_miss_size.increment(bytes_read)
+
+        def _attach_to_flight(self, flight):
+            """Deliver an object to the client from an origin fetch already in progress.
+
+            Returns the number of bytes sent, or None if the fetch is not being stored (and so cannot
+            be shared), in which case the caller should fetch the object itself.
+
+            """
+            temp_path, object_path, status, length, headers = flight.wait_for_start()
+            if temp_path is None:
+                return None
+            try:
+                f = open(temp_path, 'rb')
+            except IOError:
+                try:
+                    f = open(object_path, 'rb')
+                except IOError:
+                    return None
+            self.server._node.print_debug(TAG, 'cache miss (coalesced): %s%s' %(self.server._expr, self.path))
+            try:
+                self.send_response(status)
+                for name, value in headers:
+                    self.send_header(name, value)
+                if length is None:
+                    self.send_header('Connection', 'close')
+                    self.close_connection = 1
                 else:
-                    object_path = self.server._server_path + "/" + key
+                    self.send_header('Content-length', length)
+                self.end_headers()
+                bytes_sent = 0
+                while True:
+                    available, done, complete = flight.wait_for_progress(bytes_sent)
+                    while bytes_sent < available:
+                        read_payload = f.read(min(CHUNK_SIZE, available - bytes_sent))
+                        if not read_payload:
+                            break
+                        self.wfile.write(read_payload)
+                        bytes_sent += len(read_payload)
+                    if done and bytes_sent >= available:
+                        break
+                if not complete:
+                    self.close_connection = 1
+            except (IOError, OSError, socket.error) as e:
+                self.server._node.print_error(TAG, 'Could not deliver fetched content to client: %s' % e)
+                self.close_connection = 1
+            finally:
+                f.close()
+            return bytes_sent
+
+        def _fetch_and_send_object(self, url, object_path=None, flight=None, fetched=None):
+            """Fetch the object from the original external location and deliver this to the client.
+
+            The body is written to the client and, if an 'object_path' is given (and the origin allows it to
+            be cached), to a temporary file alongside it. Progress is published to the given 'flight', if any,
+            so that other requests for the same object can follow the temporary file as it is written. If the
+            response has already been 'fetched', it is used instead of making the request.
+
+            Returns the number of bytes read from the origin, the path of the temporary file if the body was
+            received completely (and its length checked) or None otherwise, and the object's metadata.
+
+            """
+            if fetched is not None:
+                connection, response = fetched
+            else:
                 try:
-                    f = open(object_path, 'w')
-                    f.write(remote_object)
-                    f.close()
-                    self.server._server._database.create({'expr' : self.server._expr, 'key' : key, 'path' : object_path})
+                    connection, response = self.server._origins.request(url, self.path)
+                except (httplib.HTTPException, socket.error) as e:
+                    self.server._node.print_error(TAG, 'Could not retrieve content from origin server: %s' % e)
+                    self._send_empty(502)
+                    return 0, None, None
+            length = self._relay_headers(response)
+            metadata = object_metadata(response, self.server._default_max_age)
+            cache_file = None
+            temp_path = None
+            if object_path is not None and response.status == httplib.OK and freshness.storable(response):
+                try:
+                    cache_file, temp_path = open_temp_file(object_path)
                 except (IOError, OSError) as e:
                     self.server._node.print_warn(TAG, ('Could not save content to filesystem: %s' % e))
+            if flight is not None:
+                flight.start(temp_path, object_path, response.status, length, response_headers(response))
+            bytes_read, complete, stored = self._relay_body(response, length, cache_file, flight)
+            if complete:
+                self.server._origins.release(url, connection, response)
             else:
-                self.server._node.print_info(TAG, 'Cache instance has reached maximum disk usage and cannot store object: %s%s' %(self.server._expr, self.path))
-            self.server._cache_miss += 1
-            self.server._cache_miss_size += sys.getsizeof(remote_object)
+                connection.close()
+            self.server._node.print_debug(TAG, 'cache fetched: %s%s at %s bytes' %(url, self.path, bytes_read))
+            if cache_file is not None:
+                cache_file.close()
+                if flight is not None:
+                    flight.finish(complete and stored)
+                if not complete or not stored:
+                    discard_file(temp_path)
+                    temp_path = None
+            return bytes_read, temp_path, metadata
 
-        def _disk_check(self):
-            """Check if it possible to write a given object to disk.
+        def _fetch_and_send_range(self, url, key):
+            """Fetch the byte ranges requested from the origin and deliver them to the client.
 
-            If the current directory size is greater than the 'alert_disk' configuration setting, send an alert to the controller.
+            The origin's response is relayed as it is. If it holds a single range of an object of known
+            length, and there is room on disk, the range is also written into the object's partial file.
+            Once the ranges fetched cover the whole object, it is moved into place as a complete cached
+            object. Should the origin send the whole object instead, it is stored as for any cache miss.
+
+            Returns the number of bytes read from the origin.
 
             """
-            dir_size = get_dir_size(self.server._server_path)
-            if int(dir_size) > int(self.server._node.config["alert_disk"]):
-                self.server._server._send_message_to_controller(self.server._server._get_alert('disk', dir_size))
-                if int(dir_size) > int(self.server._node.config["max_disk"]):
-                    return False
-            return True
+            headers = {'Range' : self.headers.getheader('range')}
+            if self.headers.getheader('if-range') is not None:
+                headers['If-Range'] = self.headers.getheader('if-range')
+            try:
+                connection, response = self.server._origins.request(url, self.path, headers)
+            except (httplib.HTTPException, socket.error) as e:
+                self.server._node.print_error(TAG, 'Could not retrieve content from origin server: %s' % e)
+                self._send_empty(502)
+                return 0
+            length = self._relay_headers(response)
+            received = byte_range.parse_content_range(response.getheader('content-range'))
+            metadata = object_metadata(response, self.server._default_max_age)
+            cache_file = None
+            temp_path = None
+            if (response.status in (httplib.OK, httplib.PARTIAL_CONTENT) and freshness.storable(response) and
+                    self.server._server._disk_check()):
+                try:
+                    if response.status == httplib.OK:
+                        object_path = self.server._server._get_object_path(key)
+                        cache_file, temp_path = open_temp_file(object_path)
+                    elif received is not None and length == received[1] - received[0] + 1:
+                        cache_file = self.server._partial.open_writer(key, received[2], received[0])
+                except (IOError, OSError) as e:
+                    self.server._node.print_warn(TAG, ('Could not save content to filesystem: %s' % e))
+            bytes_read, complete, stored = self._relay_body(response, length, cache_file)
+            if complete:
+                self.server._origins.release(url, connection, response)
+            else:
+                connection.close()
+            self.server._node.print_debug(TAG, 'cache fetched: %s%s at %s bytes' %(url, self.path, bytes_read))
+            if cache_file is not None:
+                cache_file.close()
+                if temp_path is not None:
+                    if complete and stored:
+                        self.server._server._store_object(key, temp_path, object_path, metadata)
+                    else:
+                        discard_file(temp_path)
+                elif complete and stored and self.server._partial.add(key, received[0], received[1]):
+                    object_path = self.server._server._get_object_path(key)
+                    self.server._server._store_object(key, self.server._partial.data_path(key), object_path, metadata)
+            return bytes_read
 
-        def _fetch_and_send_object(self, url):
-            """Fetch the object from the original external location and deliver this to the client. """
-            connection = httplib.HTTPConnection(url)
-            connection.request("GET", self.path)
-            response = connection.getresponse()
-            length = int(response.getheader('content-length'))
-            self.send_response(200)
-            self.send_header('Content-type','text-html')
-            self.send_header('Content-length', length)
+        def _relay_headers(self, response):
+            """Send the status and headers of a response from the origin to the client. Returns the body length, if known.
+
+            The headers relayed are those stored with cached objects, together with any 'Content-Range'.
+
+            """
+            length = response.getheader('content-length')
+            self.send_response(response.status)
+            for name, value in response_headers(response):
+                self.send_header(name, value)
+            if response.getheader('content-range') is not None:
+                self.send_header('Content-range', response.getheader('content-range'))
+            if length is None:
+                self.send_header('Connection', 'close')
+                self.close_connection = 1
+            else:
+                length = int(length)
+                self.send_header('Content-length', length)
             self.end_headers()
-            total_payload = ""
+            return length
+
+        def _relay_body(self, response, length, cache_file=None, flight=None):
+            """Stream a response body from the origin to the client and, if given, a cache file.
+
+            Each chunk read from the origin is written to the client and the cache file, so memory use stays
+            flat regardless of object size. If the client goes away, the fetch continues so that the object
+            can still be cached. Progress is published to the given 'flight', if any.
+
+            Returns the number of bytes read, whether the body was received completely (and its length
+            checked), and whether all of it was written to the cache file.
+
+            """
+            deliver = True
+            stored = cache_file is not None
+            complete = False
             bytes_read = 0
             while True:
                 try:
-                    read_payload = response.read(1448)
+                    read_payload = response.read(CHUNK_SIZE)
                 except Exception as e:
-                    self.server._node.print_error(TAG, 'Could not retrieve content from origin server: %s', e)
+                    self.server._node.print_error(TAG, 'Could not retrieve content from origin server: %s' % e)
                     break
-                try:
-                    self.wfile.write(read_payload)
-                except Exception as e:
-                    self.server._node.print_error(TAG, 'Could not deliver fetched content to client: %s', e)
+                if not read_payload:
+                    complete = (length is None or bytes_read == length)
                     break
-                total_payload += read_payload
-                bytes_read += 1448
-                if bytes_read > length:
+                bytes_read += len(read_payload)
+                if deliver:
+                    try:
+                        self.wfile.write(read_payload)
+                    except Exception as e:
+                        self.server._node.print_error(TAG, 'Could not deliver fetched content to client: %s' % e)
+                        deliver = False
+                if stored:
+                    try:
+                        cache_file.write(read_payload)
+                        if flight is not None:
+                            flight.advance(len(read_payload))
+                    except (IOError, OSError) as e:
+                        self.server._node.print_warn(TAG, ('Could not save content to filesystem: %s' % e))
+                        stored = False
+                        if flight is not None:
+                            flight.finish(False)
+                if not deliver and not stored:
                     break
-            connection.close()
-            self.server._node.print_debug(TAG, 'cache fetched: %s%s at approx. %s bytes' %(url, self.path, bytes_read))
-            return total_payload
+            if not deliver or not complete:
+                self.close_connection = 1
+            return bytes_read, complete, stored
+
+        def _send_encoded(self, key, source, metadata, headers, modified):
+            """Deliver a compressed object, from memory or from an open file.
 
-        def _send_object(self, data):
-            """Deliver the cached object to the client"""
+            Clients that accept the object's encoding are sent the compressed bytes as they are (and an
+            object read from disk is promoted to the memory tier, still compressed). Other clients, and
+            range requests, are sent the object decompressed. Returns the number of bytes sent.
+
+            """
+            encoding = metadata['encoding']
+            length = metadata['length']
+            if self.headers.getheader('range') is None and compression.accepts(self.headers.getheader('accept-encoding'), encoding):
+                encoded_headers = headers + compression.encoded_headers(encoding)
+                if isinstance(source, str):
+                    return self._send_object(source, encoded_headers)
+                size = os.fstat(source.fileno()).st_size
+                if self.server._sendfile and not self.server._memory.admits(size):
+                    return self._send_file(source, size, encoded_headers)
+                local_object = source.read()
+                sent = self._send_object(local_object, encoded_headers)
+                self.server._memory.put(key, headers, local_object)
+                return sent
+            headers = headers + [('Vary', 'Accept-Encoding')]
+            ranges = self._requested_ranges(length, modified, metadata.get('etag'))
+            if ranges is not None:
+                data = compression.decompress(source if isinstance(source, str) else source.read(), encoding)
+                return self._send_ranges(data, length, ranges, headers)
             self.send_response(200)
-            self.send_header('Content-type','text-html')
+            for name, value in headers:
+                self.send_header(name, value)
+            self.send_header('Content-length', length)
+            self.end_headers()
+            sent = 0
+            try:
+                if isinstance(source, str):
+                    source = StringIO.StringIO(source)
+                for chunk in compression.decompress_chunks(source, encoding):
+                    self.wfile.write(chunk)
+                    sent += len(chunk)
+            except Exception as e:
+                self.server._node.print_error(TAG, 'Could not deliver cached content to client: %s' % e)
+            if sent != length:
+                self.close_connection = 1
+            return sent
+
+        def _send_file(self, f, length, headers=DEFAULT_HEADERS):
+            """Deliver a cached file to the client without reading it into memory.
+
+            The headers are held back (corked) so that they leave in the same segment as the start of
+            the body, which is then passed from the file to the socket by the kernel where possible.
+            Returns the number of bytes of the body sent.
+
+            """
+            sent = 0
+            self._set_cork(True)
+            try:
+                self.send_response(200)
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.send_header('Content-length', length)
+                self.end_headers()
+                self.wfile.flush()
+                sent = send_file(self.connection, f, 0, length)
+                if sent < length:
+                    self.server._node.print_error(TAG, 'Cached object is shorter than expected, closing connection')
+                    self.close_connection = 1
+            except (IOError, OSError, socket.error) as e:
+                self.server._node.print_error(TAG, 'Could not deliver cached content to client: %s' % e)
+                self.close_connection = 1
+            finally:
+                self._set_cork(False)
+            return sent
+
+        def _send_ranges(self, source, length, ranges, headers=DEFAULT_HEADERS):
+            """Deliver byte ranges of a cached object to the client, from memory or from an open file.
+
+            If none of the ranges can be satisfied, a 416 is sent instead. Returns the number of bytes of
+            the body sent.
+
+            """
+            if not ranges:
+                self.send_response(416)
+                self.send_header('Content-range', 'bytes */%d' % length)
+                self.send_header('Content-length', 0)
+                self.end_headers()
+                return 0
+            headers, parts, body_length = byte_range.range_response(ranges, length, headers)
+            sent = 0
+            self._set_cork(True)
+            try:
+                self.send_response(206)
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.send_header('Content-length', body_length)
+                self.end_headers()
+                for part in parts:
+                    if isinstance(part, str):
+                        self.wfile.write(part)
+                        sent += len(part)
+                    else:
+                        sent += self._send_slice(source, part[0], part[1] - part[0] + 1)
+                self.wfile.flush()
+            except (IOError, OSError, socket.error) as e:
+                self.server._node.print_error(TAG, 'Could not deliver cached content to client: %s' % e)
+                self.close_connection = 1
+            finally:
+                self._set_cork(False)
+            return sent
+
+        def _send_slice(self, source, offset, count):
+            """Send 'count' bytes of an object, starting at 'offset', from a string or an open file."""
+            if isinstance(source, str):
+                self.wfile.write(source[offset:offset + count])
+                return count
+            if self.server._sendfile:
+                self.wfile.flush()
+                sent = send_file(self.connection, source, offset, count)
+            else:
+                source.seek(offset)
+                sent = 0
+                while sent < count:
+                    chunk = source.read(min(CHUNK_SIZE, count - sent))
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+                    sent += len(chunk)
+            if sent < count:
+                raise IOError('Cached object is shorter than expected')
+            return sent
+
+        def _set_cork(self, enabled):
+            """Cork or uncork the client socket, if the platform supports it."""
+            if hasattr(socket, 'TCP_CORK'):
+                try:
+                    self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, int(enabled))
+                except socket.error:
+                    pass
+
+        def _send_object(self, data, headers=DEFAULT_HEADERS):
+            """Deliver the cached object to the client.
+
+            The output stream is buffered, so the headers and body are coalesced into a single write.
+            Returns the number of bytes of the body sent.
+
+            """
+            self.send_response(200)
+            for name, value in headers:
+                self.send_header(name, value)
             self.send_header('Content-length', len(data))
             self.end_headers()
             try:
                 self.wfile.write(data)
             except Exception as e:
-                self.server._node.print_error(TAG, 'Could not deliver cached content to client: %s', e)
+                self.server._node.print_error(TAG, 'Could not deliver cached content to client: %s' % e)
+                self.close_connection = 1
+                return 0
+            return len(data)
+
+class Counter:
+    """A statistics counter that can be safely updated from many request threads."""
+
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def increment(self, amount=1):
+        """Add the given amount to the counter."""
+        with self._lock:
+            self._value += amount
+
+    def value(self):
+        """Return the current value of the counter."""
+        return self._value
+
+    def reset(self):
+        """Atomically return the current value of the counter and set it back to zero."""
+        with self._lock:
+            value = self._value
+            self._value = 0
+            return value
+
+class RequestLatency:
+    """Latency histograms of the requests handled by a cache instance.
+
+    The time to first byte (the response headers) and the total time of each request are recorded
+    separately for cache hits and cache misses (requests that went to the origin). The 'origin'
+    histogram records the time the origin took to answer each request sent to it (up to its response
+    headers). Like the other counters, the histograms cover every request since the instance was created.
+
+    """
+
+    KINDS = ['hit_ttfb', 'hit_total', 'miss_ttfb', 'miss_total', 'origin']
+
+    def __init__(self):
+        self._histograms = dict((kind, lib.LatencyHistogram()) for kind in self.KINDS)
+        self.origin = self._histograms['origin']
+
+    def record(self, missed, started, first_byte, finished):
+        """Record a request, given the times it started, sent its first byte (None if it sent nothing) and finished."""
+        kind = 'miss' if missed else 'hit'
+        if first_byte is not None:
+            self._histograms[kind + '_ttfb'].record(first_byte - started)
+        self._histograms[kind + '_total'].record(finished - started)
+
+    def merge_dict(self, histograms):
+        """Add the histograms of 'to_dict' (such as those of another worker process) to these."""
+        for kind, counts in histograms.items():
+            if kind in self._histograms:
+                self._histograms[kind].merge_dict(counts)
+
+    def to_dict(self):
+        """Return the bucket counts of each histogram."""
+        return dict((kind, histogram.to_dict()) for kind, histogram in self._histograms.items())
+
+    def percentiles(self):
+        """Return the percentiles of each histogram (in seconds), named as e.g. 'latency_miss_ttfb_p99'."""
+        stats = dict()
+        for kind, histogram in self._histograms.items():
+            for name, value in histogram.percentiles().items():
+                stats['latency_' + kind + '_' + name] = value
+        return stats
+
+class DiskUsage:
+    """A running total of the bytes on disk and the objects stored in a cache instance's directory.
+
+    The total is updated as objects are stored and removed, so that it can be read without walking the
+    directory. An occasional background scan reconciles it with the directory, picking up anything not
+    accounted for (such as temporary files, or files left behind by a previous run).
+
+    The total is kept in an anonymous shared memory map. A 'shared' total also has a lock shared between
+    processes (as for the Bloom filter of keys), so that every worker process forked after it is created
+    adds to, and reads, the same total.
+
+    """
+
+    _totals = None
+    _lock = None
+    _scan_lock = None
+
+    def __init__(self, shared=False):
+        self._totals = mmap.mmap(-1, DISK_USAGE_FORMAT.size)
+        if shared:
+            self._lock = multiprocessing.Lock()
+        else:
+            self._lock = threading.Lock()
+        self._scan_lock = threading.Lock()
+
+    def size(self):
+        """Return the number of bytes on disk."""
+        return self._read()[0]
+
+    def count(self):
+        """Return the number of objects stored."""
+        return self._read()[1]
+
+    def add(self, size, count=1):
+        """Record that 'size' bytes and 'count' objects have been added (or removed, if negative)."""
+        with self._lock:
+            total_size, total_count, changed_size, changed_count, scanning = self._read()
+            if scanning:
+                changed_size += size
+                changed_count += count
+            self._write(total_size + size, total_count + count, changed_size, changed_count, scanning)
+
+    def reset(self):
+        """Set the total back to zero, once the directory has been emptied."""
+        with self._lock:
+            self._write(0, 0, 0, 0, 0)
+
+    def reconcile(self, path):
+        """Walk the directory and correct the running total. Changes made whilst walking are added on to what is found.
+
+        The walk pauses regularly so as to leave the disk to requests. Only one walk is made at a time.
+
+        """
+        if not self._scan_lock.acquire(False):
             return
+        try:
+            with self._lock:
+                total_size, total_count = self._read()[:2]
+                self._write(total_size, total_count, 0, 0, 1)
+            size, count = get_dir_usage(path, pause=0.01)
+            with self._lock:
+                changed_size, changed_count, scanning = self._read()[2:]
+                if scanning:
+                    self._write(size + changed_size, count + changed_count, 0, 0, 0)
+        finally:
+            self._scan_lock.release()
+
+    def _read(self):
+        return DISK_USAGE_FORMAT.unpack(self._totals[:])
 
-def get_dir_size(path):
-    """Get size of files (actual, in bytes) for given path"""
+    def _write(self, *totals):
+        self._totals[:] = DISK_USAGE_FORMAT.pack(*totals)
+
+class Flight:
+    """An origin fetch (or revalidation) in progress, which other requests for the same object can attach to.
+
+    The fetching request publishes where the object is being written to and how much of it has been
+    written so far. Attached requests wait on the condition for more of the object to arrive.
+
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._started = False
+        self._temp_path = None
+        self._object_path = None
+        self._status = None
+        self._length = None
+        self._headers = None
+        self._received = 0
+        self._done = False
+        self._complete = False
+        self._cached = False
+
+    def start(self, temp_path, object_path, status, length, headers):
+        """Publish the response status, length and headers, and where the object is being written to.
+
+        A 'temp_path' of None indicates that the object is not being stored, and cannot be shared.
+
+        """
+        with self._condition:
+            self._temp_path = temp_path
+            self._object_path = object_path
+            self._status = status
+            self._length = length
+            self._headers = headers
+            self._started = True
+            self._condition.notify_all()
+
+    def advance(self, size):
+        """Record that another 'size' bytes have been written to the temporary file."""
+        with self._condition:
+            self._received += size
+            self._condition.notify_all()
+
+    def finish(self, complete, cached=False):
+        """Record that the fetch has ended, successfully or not. Only the first call has any effect.
+
+        A revalidation that leaves the cached object to be served (as the origin answered 304, or could not
+        be reached) finishes with 'cached' set.
+
+        """
+        with self._condition:
+            if not self._done:
+                self._started = True
+                self._done = True
+                self._complete = complete
+                self._cached = cached
+                self._condition.notify_all()
+
+    def cached(self):
+        """Return True if the flight was a revalidation that left the cached object to be served."""
+        return self._cached
+
+    def wait_for_start(self):
+        """Wait for the fetch to start and return (temp_path, object_path, status, length, headers)."""
+        with self._condition:
+            while not self._started:
+                self._condition.wait()
+            if self._done and not self._complete:
+                return None, None, None, None, None
+            return self._temp_path, self._object_path, self._status, self._length, self._headers
+
+    def wait_for_progress(self, position):
+        """Wait until more than 'position' bytes are written (or the fetch ends).
+
+        Returns (bytes written, done, complete).
+
+        """
+        with self._condition:
+            while self._received <= position and not self._done:
+                self._condition.wait()
+            return self._received, self._done, self._complete
+
+def response_headers(headers):
+    """Get the headers of an origin response that are stored with, and replayed for, a cached object.
+
+    Falls back to the default content type if the origin did not give one.
+
+    """
+    stored = []
+    for name in STORED_HEADERS:
+        value = headers.getheader(name)
+        if value is not None:
+            stored.append((name, value))
+    if headers.getheader('content-type') is None:
+        stored = DEFAULT_HEADERS + stored
+    return stored
+
+def object_metadata(headers, default_max_age, previous=None):
+    """Get the metadata stored with an object: its freshness (see opencachefreshness) and the headers to replay on hits.
+
+    When revalidating, headers sent with the origin's 304 replace those held in the 'previous' metadata,
+    and the rest are kept.
+
+    """
+    metadata = freshness.metadata(headers, default_max_age, previous)
+    stored = collections.OrderedDict()
+    if previous is not None and 'headers' in previous:
+        for name, value in previous['headers']:
+            stored[name] = value
+        for name in STORED_HEADERS:
+            if headers.getheader(name) is not None:
+                stored[name] = headers.getheader(name)
+    else:
+        stored.update(response_headers(headers))
+    metadata['headers'] = [[name, value] for name, value in stored.iteritems()]
+    return metadata
+
+def object_headers(metadata):
+    """Get the headers to send with a cached object, from its metadata (or the defaults, for objects stored without any)."""
+    if 'headers' in metadata:
+        return [(name, value) for name, value in metadata['headers']]
+    return DEFAULT_HEADERS + freshness.validator_headers(metadata)
+
+def not_modified_headers(metadata):
+    """Get the headers to send with a 304 for a cached object: those stored, other than the ones describing the body."""
+    return [(name, value) for name, value in object_headers(metadata) if not name.lower().startswith('content-')]
+
+def _load_sendfile():
+    """Find a zero-copy sendfile implementation: os.sendfile (Python 3.3+), or libc via ctypes."""
+    if hasattr(os, 'sendfile'):
+        return os.sendfile
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc_sendfile = libc.sendfile
+    except (OSError, AttributeError, TypeError):
+        return None
+    libc_sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    libc_sendfile.restype = ctypes.c_ssize_t
+    def _sendfile(out_fd, in_fd, offset, count):
+        offset = ctypes.c_int64(offset)
+        sent = libc_sendfile(out_fd, in_fd, ctypes.byref(offset), count)
+        if sent < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        return sent
+    return _sendfile
+
+_sendfile = _load_sendfile()
+
+def send_file(sock, f, offset, count):
+    """Send 'count' bytes from an open file, starting at 'offset', to the given socket.
+
+    Uses sendfile where available, so that the data is never copied into user space. Otherwise,
+    falls back to reading and sending the file in chunks. Returns the number of bytes sent, which is
+    less than 'count' if the file is shorter. Raises socket.timeout if the socket's timeout passes
+    without the client accepting more data.
+
+    """
+    sent = 0
+    if _sendfile is not None:
+        while sent < count:
+            try:
+                result = _sendfile(sock.fileno(), f.fileno(), offset + sent, count - sent)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    if not select.select([], [sock], [], sock.gettimeout())[1]:
+                        raise socket.timeout('timed out')
+                    continue
+                if e.errno in (errno.EINVAL, errno.ENOSYS) and sent == 0:
+                    break
+                raise
+            if result == 0:
+                return sent
+            sent += result
+        if sent == count:
+            return sent
+    f.seek(offset + sent)
+    while sent < count:
+        chunk = f.read(min(CHUNK_SIZE, count - sent))
+        if not chunk:
+            break
+        sock.sendall(chunk)
+        sent += len(chunk)
+    return sent
+
+def open_temp_file(path):
+    """Open a new temporary file in the same directory as the given path (creating it if need be), ready to be renamed over it."""
+    lib.create_directory(os.path.dirname(path))
+    fd, temp_path = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=os.path.dirname(path))
+    return os.fdopen(fd, 'wb', 0), temp_path
+
+def discard_file(path):
+    """Remove a file, ignoring it if it has already gone."""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def get_dir_usage(path, pause=0):
+    """Get size of files (actual, in bytes) and number of cached objects for given path, including its subdirectories.
+
+    Cached objects are named by their key alone; temporary and partial files carry a suffix. Pauses for
+    'pause' seconds after every thousand files, to limit the load placed on the disk.
+
+    """
     total_size = 0
+    total_count = 0
+    seen = 0
     for dirpath, dirnames, filenames in os.walk(path):
         for f in filenames:
-            fp = os.path.join(dirpath, f)
-            total_size += os.path.getsize(fp)
-    return total_size
+            try:
+                total_size += os.path.getsize(os.path.join(dirpath, f))
+            except OSError:
+                continue
+            if '.' not in f:
+                total_count += 1
+            seen += 1
+            if pause and seen % 1000 == 0:
+                time.sleep(pause)
+    return total_size, total_count
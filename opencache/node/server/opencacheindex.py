@@ -0,0 +1,217 @@
+#!/usr/bin/env python2.7
+
+"""opencacheindex.py: Object Index - an in-memory index of the objects held by a cache instance, written through to the database."""
+
+import os
+import Queue
+import threading
+
+TAG = 'index'
+
+class ObjectIndex:
+    """Maps each cached object's key to its (path, size, metadata), so that requests never wait on the database.
+
+    The index is loaded from the database once, when the cache instance starts. Changes are made in memory
+    straight away, and queued to be written to the database, in order, by a background thread.
+
+    Objects seeded by the node are shared by every cache instance. They are indexed so that they can be
+    served, but are not counted among (or written to the database as) this instance's own objects.
+
+    When the instance is served by several worker processes, the index is 'shared': each process holds
+    its own copy, and objects stored by the others are found in the database when first requested. A
+    counting Bloom filter of the keys held, shared by the processes, lets objects that none of them
+    hold be ruled out without looking in the database. Each key is counted in it once: by the process
+    that stores the object, or by the one that loads it, and is taken out when the object is removed.
+
+    """
+
+    _node = None
+    _database = None
+    _expr = None
+    _objects = None
+    _seeded = None
+    _lock = None
+    _writes = None
+    loaded = False
+    shared = False
+    keys = None
+    filtered = 0
+
+    def __init__(self, node, expr, shared=False, keys=None):
+        """Initialise the index. A shared index is given the Bloom filter of 'keys' held by every process."""
+        self._node = node
+        self._database = node.database
+        self._expr = expr
+        self.shared = shared
+        self.keys = keys
+        self._objects = dict()
+        self._seeded = set()
+        self._lock = threading.Lock()
+        self._writes = Queue.Queue()
+
+    def load(self, add_keys=True):
+        """Load the objects recorded for this expression, and those seeded for all instances, from the database.
+
+        Records of objects whose files have gone are removed. If the database cannot be read, the index
+        starts out empty and 'loaded' is left unset. The keys of the objects are added to the Bloom filter
+        only if 'add_keys' is set, as only one of the processes sharing it should add them.
+
+        """
+        try:
+            documents = self._database.lookup({'expr' : self._expr})
+            documents += self._database.lookup({'expr' : {'$exists' : False}})
+        except Exception as e:
+            self._node.print_warn(TAG, 'Could not load object index from database: %s' % e)
+            return
+        for document in documents:
+            size = document.get('size')
+            if size is None:
+                try:
+                    size = os.path.getsize(document['path'])
+                except OSError:
+                    if 'expr' in document:
+                        self._writes.put(('remove', document['key']))
+                    continue
+            with self._lock:
+                if 'expr' not in document:
+                    self._seeded.add(document['key'])
+                elif add_keys and self.keys is not None and document['key'] not in self._objects:
+                    self.keys.add(document['key'])
+                self._objects[document['key']] = (document['path'], size, document.get('metadata', dict()))
+        self.loaded = True
+
+    def get(self, key):
+        """Return (path, size, metadata) for a cached object, or None if it is not held."""
+        return self._objects.get(key)
+
+    def may_find(self, key):
+        """Return False if 'find' would certainly not find an object, so that it need not be called."""
+        if not self.shared:
+            return False
+        if self.keys is not None and not self.keys.might_contain(key):
+            self.filtered += 1
+            return False
+        return True
+
+    def find(self, key):
+        """Look in the database for an object not held in a shared index, which another worker process may have stored.
+
+        An object found (whose file still exists) is added to the index, though not to the Bloom filter, which
+        the process that stored it has added it to already. Returns (path, size, metadata), or
+        None if the object is not found, the index is not shared, or the object is ruled out by the Bloom
+        filter. This blocks on the database, so should only be called once an object has not been found
+        with 'get'.
+
+        """
+        if not self.may_find(key):
+            return None
+        try:
+            documents = self._database.lookup({'expr' : self._expr, 'key' : key})
+        except Exception as e:
+            self._node.print_warn(TAG, 'Could not look up object in database: %s' % e)
+            return None
+        for document in documents:
+            if document.get('size') is None or not os.path.exists(document['path']):
+                continue
+            with self._lock:
+                return self._objects.setdefault(key, (document['path'], document['size'], document.get('metadata', dict())))
+        return None
+
+    def put(self, key, path, size, metadata=None, persist=True):
+        """Add (or replace) an object in the index, and record it in the database unless 'persist' is unset.
+
+        Objects that are not persisted are those seeded by the node, which has recorded them already. An
+        object newly stored here is added to the Bloom filter.
+
+        """
+        if metadata is None:
+            metadata = dict()
+        with self._lock:
+            if persist and self.keys is not None and (key not in self._objects or key in self._seeded):
+                self.keys.add(key)
+            self._objects[key] = (path, size, metadata)
+            if persist:
+                self._seeded.discard(key)
+            else:
+                self._seeded.add(key)
+        if persist:
+            self._writes.put(('put', key, path, size, metadata))
+
+    def move(self, key, old_path, path, changes=None):
+        """Record that an object has moved from 'old_path' to 'path', with 'changes' made to its metadata.
+
+        Nothing is recorded if the object has been removed or replaced since it was at 'old_path'. Returns
+        True if the move was recorded.
+
+        """
+        with self._lock:
+            entry = self._objects.get(key)
+            if entry is None or entry[0] != old_path:
+                return False
+            metadata = dict(entry[2])
+            metadata.update(changes or dict())
+            self._objects[key] = (path, entry[1], metadata)
+        self._writes.put(('put', key, path, entry[1], metadata))
+        return True
+
+    def remove(self, key, keep_key=False):
+        """Remove an object from the index and the database.
+
+        The key is taken out of the Bloom filter unless 'keep_key' is set, for when another process sharing
+        it removes the object too.
+
+        """
+        with self._lock:
+            if (self._objects.pop(key, None) is not None and key not in self._seeded and not keep_key
+                    and self.keys is not None):
+                self.keys.remove(key)
+            self._seeded.discard(key)
+        self._writes.put(('remove', key))
+
+    def clear(self):
+        """Remove every object recorded for this expression from the index and the database.
+
+        Objects seeded by the node are kept, as they are shared by every cache instance (and recorded by the node).
+        The Bloom filter is emptied, as every process sharing it clears its index together.
+
+        """
+        with self._lock:
+            for key in self._objects.keys():
+                if key not in self._seeded:
+                    del self._objects[key]
+            if self.keys is not None:
+                self.keys.clear()
+        self._writes.put(('clear', ))
+
+    def count(self):
+        """Return the number of objects in the index, including those seeded."""
+        return len(self._objects)
+
+    def stored(self):
+        """Return the number of objects stored by this cache instance (kept up to date as objects come and go)."""
+        with self._lock:
+            return len(self._objects) - len(self._seeded)
+
+    def items(self):
+        """Return a list of (key, (path, size, metadata)) for every object in the index."""
+        with self._lock:
+            return self._objects.items()
+
+    def run(self):
+        """Write queued changes to the database, in order. Never returns."""
+        while True:
+            write = self._writes.get()
+            try:
+                self._write(write)
+            except Exception as e:
+                self._node.print_warn(TAG, 'Could not write object index change to database: %s' % e)
+
+    def _write(self, write):
+        if write[0] == 'put':
+            operation, key, path, size, metadata = write
+            self._database.update({'expr' : self._expr, 'key' : key},
+                {'expr' : self._expr, 'key' : key, 'path' : path, 'size' : size, 'metadata' : metadata})
+        elif write[0] == 'remove':
+            self._database.remove({'expr' : self._expr, 'key' : write[1]})
+        else:
+            self._database.remove({'expr' : self._expr})
@@ -0,0 +1,92 @@
+#!/usr/bin/env python2.7
+
+"""opencachememory.py: Memory Tier - holds the hottest cached objects in memory, in front of the disk cache."""
+
+import collections
+import threading
+
+TAG = 'memory'
+
+class MemoryTier:
+
+    _objects = None
+    _lock = None
+    _max_size = 0
+    _max_object_size = 0
+    size = 0
+    hit = 0
+    miss = 0
+    eviction = 0
+
+    def __init__(self, max_size, max_object_size):
+        """Initialise an empty memory tier.
+
+        The tier is bounded by the total number of bytes it holds ('max_size'). Objects larger than
+        'max_object_size' are never admitted. A 'max_size' of zero disables the tier entirely.
+
+        """
+        self._objects = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._max_size = int(max_size)
+        self._max_object_size = min(int(max_object_size), self._max_size)
+
+    def get(self, key):
+        """Return the (headers, data) pair stored for the given key, or None if not held in memory.
+
+        A successful lookup moves the object to the most recently used position.
+
+        """
+        with self._lock:
+            try:
+                entry = self._objects.pop(key)
+            except KeyError:
+                self.miss += 1
+                return None
+            self._objects[key] = entry
+            self.hit += 1
+            return entry
+
+    def admits(self, size):
+        """Return True if an object of the given size (in bytes) may be held in the memory tier."""
+        return 0 < size <= self._max_object_size
+
+    def put(self, key, headers, data):
+        """Store an object and its headers, evicting the least recently used objects to make room."""
+        if len(data) > self._max_object_size:
+            return False
+        with self._lock:
+            self._discard(key)
+            while self._objects and self.size + len(data) > self._max_size:
+                evicted_key, (evicted_headers, evicted_data) = self._objects.popitem(last=False)
+                self.size -= len(evicted_data)
+                self.eviction += 1
+            self._objects[key] = (headers, data)
+            self.size += len(data)
+        return True
+
+    def replace_headers(self, key, headers):
+        """Replace the headers stored with an object, if it is held, without counting an access to it."""
+        with self._lock:
+            entry = self._objects.get(key)
+            if entry is not None:
+                self._objects[key] = (headers, entry[1])
+
+    def remove(self, key):
+        """Remove a single object from the memory tier, if present."""
+        with self._lock:
+            self._discard(key)
+
+    def clear(self):
+        """Remove all objects from the memory tier."""
+        with self._lock:
+            self._objects.clear()
+            self.size = 0
+
+    def count(self):
+        """Return the number of objects currently held in memory."""
+        return len(self._objects)
+
+    def _discard(self, key):
+        entry = self._objects.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
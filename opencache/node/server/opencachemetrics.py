@@ -0,0 +1,142 @@
+#!/usr/bin/env python2.7
+
+"""opencachemetrics.py: Metrics - collects the metrics of every cache instance on a node, and renders them for Prometheus."""
+
+import threading
+import time
+
+import opencache.lib.opencachelib as lib
+import zmq
+
+TAG = 'metrics'
+
+ADDRESS = "ipc://oc-metrics"
+EXPIRY = 5
+
+LATENCY_BOUNDS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+# The statistics sent to the controller are those below, and also: 'status', 'expr', 'node_id',
+# 'avg_load', 'connection_reuse' (the fraction of requests made over a connection already used),
+# 'key_filter_size' and 'key_filter_false_positive' (the counters and estimated false positive rate of the
+# Bloom filter of keys shared by worker processes), percentiles of the latency histograms (such as
+# 'latency_hit_ttfb_p50', with _p95, _p99 and _p999) and, from the threaded engine, 'worker_threads',
+# 'worker_utilisation', 'worker_queue_wait', 'worker_queue' and 'worker_rejected'.
+
+COUNTERS = [
+    ('cache_hits_total', 'cache_hit', 'Requests served from the cache.'),
+    ('cache_misses_total', 'cache_miss', 'Requests for objects fetched from the origin.'),
+    ('cache_hit_bytes_total', 'cache_hit_size', 'Bytes served from the cache.'),
+    ('cache_miss_bytes_total', 'cache_miss_size', 'Bytes served whilst fetching objects from the origin.'),
+    ('cache_coalesced_total', 'cache_coalesced', 'Cache misses served by an origin fetch already in progress.'),
+    ('cache_revalidated_total', 'cache_revalidated', 'Stale objects the origin confirmed were unchanged.'),
+    ('cache_not_modified_total', 'cache_not_modified', 'Conditional requests answered with a 304 from the object index.'),
+    ('cache_evictions_total', 'cache_eviction', 'Objects evicted from the disk.'),
+    ('cache_eviction_bytes_total', 'cache_eviction_size', 'Bytes of objects evicted from the disk.'),
+    ('connections_total', 'connection_count', 'Client connections accepted.'),
+    ('requests_total', 'connection_requests', 'Requests received from clients.'),
+    ('origin_connections_total', 'origin_connection', 'Connections opened to the origin.'),
+    ('origin_connections_reused_total', 'origin_connection_reused', 'Origin requests sent over an already open connection.'),
+    ('memory_hits_total', 'memory_hit', 'Cache hits served from the memory tier.'),
+    ('memory_misses_total', 'memory_miss', 'Requests not found in the memory tier.'),
+    ('memory_evictions_total', 'memory_eviction', 'Objects evicted from the memory tier to make room for others.'),
+    ('segments_compacted_total', 'segment_compacted', 'Segment files compacted and deleted.'),
+    ('key_filter_skipped_total', 'key_filter_skipped', 'Requests for objects ruled out by the Bloom filter of keys.'),
+]
+
+GAUGES = [
+    ('objects', 'cache_object', 'Objects stored by the cache instance.'),
+    ('disk_bytes', 'cache_object_size', 'Bytes used on disk by the cache instance.'),
+    ('load', 'load', 'Requests received in the last second.'),
+    ('workers', 'workers', 'Worker processes serving the expression.'),
+    ('memory_objects', 'memory_object', 'Objects held in the memory tier.'),
+    ('memory_bytes', 'memory_object_size', 'Bytes of objects held in the memory tier.'),
+    ('segment_objects', 'segment_object', 'Small objects packed into segment files.'),
+]
+
+HISTOGRAMS = [
+    ('request_duration_seconds', 'Time taken to answer requests, to the first byte and in full.', [
+        ('hit_ttfb', {'result' : 'hit', 'phase' : 'ttfb'}),
+        ('hit_total', {'result' : 'hit', 'phase' : 'total'}),
+        ('miss_ttfb', {'result' : 'miss', 'phase' : 'ttfb'}),
+        ('miss_total', {'result' : 'miss', 'phase' : 'total'})]),
+    ('origin_latency_seconds', 'Time taken by the origin to answer requests, up to its response headers.', [
+        ('origin', {})]),
+]
+
+class MetricsCollector:
+    """Keeps the latest metrics pushed by each cache instance on the node, to be served from its metrics endpoint.
+
+    Each cache instance (the first worker process, where there are several) pushes its metrics every
+    second. Those of instances that have not pushed for EXPIRY seconds, such as those stopped, are
+    dropped. Nothing is read from the database or from the cache instances when metrics are rendered.
+
+    """
+
+    _node = None
+    _snapshots = None
+    _lock = None
+
+    def __init__(self, node):
+        self._node = node
+        self._snapshots = dict()
+        self._lock = threading.Lock()
+
+    def run(self):
+        """Receive the metrics pushed by cache instances. Never returns."""
+        context = zmq.Context()
+        metrics_socket = context.socket(zmq.PULL)
+        metrics_socket.bind(ADDRESS)
+        while True:
+            snapshot = metrics_socket.recv_json()
+            with self._lock:
+                self._snapshots[snapshot['expr']] = (time.time(), snapshot)
+
+    def render(self):
+        """Render the metrics of every cache instance in the Prometheus text format."""
+        now = time.time()
+        with self._lock:
+            for expr, (received, snapshot) in self._snapshots.items():
+                if now - received > EXPIRY:
+                    del self._snapshots[expr]
+            snapshots = [snapshot for received, snapshot in self._snapshots.values()]
+        return render(snapshots)
+
+def render(snapshots):
+    """Render the given cache instance metrics in the Prometheus text format."""
+    snapshots = sorted(snapshots, key=lambda snapshot: snapshot['expr'])
+    lines = []
+    for name, field, description in COUNTERS:
+        _add_family(lines, name, 'counter', description)
+        for snapshot in snapshots:
+            lines.append(_sample(name, {'expr' : snapshot['expr']}, snapshot['counters'].get(field, 0)))
+    for name, field, description in GAUGES:
+        _add_family(lines, name, 'gauge', description)
+        for snapshot in snapshots:
+            lines.append(_sample(name, {'expr' : snapshot['expr']}, snapshot.get(field, snapshot['counters'].get(field, 0))))
+    _add_family(lines, 'status', 'gauge', 'Status of the cache instance (1 for the current status).')
+    for snapshot in snapshots:
+        lines.append(_sample('status', {'expr' : snapshot['expr'], 'status' : snapshot['status']}, 1))
+    for name, description, kinds in HISTOGRAMS:
+        _add_family(lines, name, 'histogram', description)
+        for snapshot in snapshots:
+            for kind, labels in kinds:
+                histogram = lib.LatencyHistogram(snapshot['latency'].get(kind))
+                labels = dict(labels, expr=snapshot['expr'])
+                counts, total = histogram.cumulative(LATENCY_BOUNDS)
+                for bound, count in zip(LATENCY_BOUNDS, counts):
+                    lines.append(_sample(name + '_bucket', dict(labels, le=repr(bound)), count))
+                lines.append(_sample(name + '_bucket', dict(labels, le='+Inf'), histogram.count()))
+                lines.append(_sample(name + '_sum', labels, total))
+                lines.append(_sample(name + '_count', labels, histogram.count()))
+    return '\n'.join(lines) + '\n'
+
+def _add_family(lines, name, metric_type, description):
+    lines.append('# HELP opencache_%s %s' % (name, description))
+    lines.append('# TYPE opencache_%s %s' % (name, metric_type))
+
+def _sample(name, labels, value):
+    pairs = ['%s="%s"' % (label, _escape(labels[label])) for label in sorted(labels)]
+    return 'opencache_%s{%s} %s' % (name, ','.join(pairs), repr(value) if isinstance(value, float) else value)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
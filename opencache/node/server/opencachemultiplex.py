@@ -0,0 +1,260 @@
+#!/usr/bin/env python2.7
+
+"""opencachemultiplex.py: Multiplexer - serves every expression on a node from one process, port and pool of worker threads."""
+
+import signal
+import threading
+
+import opencache.node.server.opencachehttp as http
+import opencache.node.server.opencachenotify as notify
+import zmq
+
+TAG = 'multiplex'
+
+class Multiplexer:
+    """Serves the cache instances of every expression started on the node, in place of a process and port for each.
+
+    Connections are accepted on a single port and handled by a single pool of worker threads. Each
+    request is routed to a cache instance by its Host header and path. Starting,
+    pausing and stopping an expression add or remove its route; the instance itself is kept, ready to be
+    started again.
+
+    Instances are created when the node sends 'create' for an expression, and are otherwise controlled by
+    the same start/stop/pause/stat/seed messages as a cache instance in a process of its own. Their
+    notifications to the controller share a single channel.
+
+    """
+
+    _node = None
+    _port = None
+    _server = None
+    _instances = None
+    _routes = None
+    _prefixes = None
+    _lock = None
+    _notifier = None
+
+    def __init__(self, node, port):
+        """Create the listening socket and worker pool, then serve requests until terminated."""
+        signal.signal(signal.SIGINT, self._exit_multiplexer)
+        signal.signal(signal.SIGQUIT, self._exit_multiplexer)
+        self._node = node
+        self._port = port
+        self._instances = dict()
+        self._routes = dict()
+        self._prefixes = dict()
+        self._lock = threading.Lock()
+        self._notifier = notify.Notifier(self._node, self._node.config["notification_hwm"], self._node.config["notification_interval"],
+            self._node.config["alert_interval"])
+        if self._node.config["server_engine"] != 'threaded':
+            self._node.print_warn(TAG, 'Multiplexed cache instances use the threaded server engine')
+        self._server = MultiplexHTTPServer(('', self._port), self)
+        self._server.start_workers(int(self._node.config["worker_threads"]), int(self._node.config["worker_queue"]),
+            self._node.config["worker_overflow"] == 'reject')
+        self._server._keep_alive_timeout = float(self._node.config["keep_alive_timeout"])
+        threading.Thread(target=self._conn_manager, args=()).start()
+        threading.Thread(target=self._load_monitor, args=()).start()
+        threading.Thread(target=self._stat_reporter, args=()).start()
+        threading.Thread(target=self._notifier.run, args=()).start()
+        self._server.resume()
+        self._server.serve_forever()
+
+    def _exit_multiplexer(self, signal, frame):
+        raise SystemExit
+
+    def _conn_manager(self):
+        """Receive the messages sent by the node to every expression, and pass them to the cache instance concerned."""
+        context = zmq.Context()
+        ipc_socket = context.socket(zmq.SUB)
+        ipc_socket.connect("ipc://oc")
+        ipc_socket.setsockopt_string(zmq.SUBSCRIBE, u'')
+        while True:
+            self._dispatch(ipc_socket.recv_string())
+
+    def _dispatch(self, string):
+        """Carry out a message from the node, passing it to the cache instance concerned (if there is one)."""
+        expr, call, path, transaction = string.split()
+        try:
+            if call == 'create':
+                self._create(expr, path)
+                return
+            instance = self._instances.get(expr)
+            if instance is None:
+                return
+            if transaction == '?' or path == '?':
+                getattr(instance, "_" + str(call))()
+            else:
+                getattr(instance, "_" + str(call))(path, transaction)
+        except Exception as e:
+            self._node.print_error(TAG, "Error occured with '%s' command for expression '%s': %s" % (call, expr, e))
+
+    def _create(self, expr, path):
+        """Create (or start again) the cache instance for an expression, routing requests under the given path to it."""
+        prefix = ''
+        if path != '?':
+            prefix = '/' + path.strip('/')
+        with self._lock:
+            self._prefixes.setdefault(expr.lower(), set()).add(prefix)
+            instance = self._instances.get(expr)
+        if instance is not None:
+            instance._start()
+            return
+        self._instances[expr] = Instance(self, self._node, expr, self._port)
+        self._node.print_info(TAG, 'New cache instance created with expr: %s' % expr)
+
+    def _load_monitor(self):
+        """Check the request load of every cache instance every second."""
+        threading.Timer(interval=int(1), function=self._load_monitor, args=()).start()
+        for instance in self._instances.values():
+            instance._check_load()
+
+    def _stat_reporter(self):
+        """Report the statistics of every cache instance that is not stopped back to the controller periodically."""
+        threading.Timer(interval=int(self._node.config["stat_refresh"]), function=self._stat_reporter, args=()).start()
+        for instance in self._instances.values():
+            if instance._server._status != 'stop':
+                instance._stat()
+
+    def remove(self, expr):
+        """Stop routing requests to a (stopped) cache instance, and forget the paths that were routed to it."""
+        with self._lock:
+            self._routes.pop(expr.lower(), None)
+            self._prefixes.pop(expr.lower(), None)
+
+    def route(self, expr, server):
+        """Route requests for an expression to the given (instance) server."""
+        with self._lock:
+            self._routes[expr.lower()] = server
+
+    def unroute(self, expr):
+        """Stop routing requests for an expression."""
+        with self._lock:
+            self._routes.pop(expr.lower(), None)
+
+    def find_route(self, host, path):
+        """Get the server that requests for the given host and path are routed to, or None if there is not one.
+
+        A host given with the default port is matched with an expression given without it. A path is routed
+        under a prefix only if it is the prefix itself or continues it with a '/'.
+
+        """
+        if host is None:
+            return None
+        host = host.strip().lower()
+        if host.endswith(':80'):
+            hosts = [host, host[:-3]]
+        else:
+            hosts = [host]
+        path = path.split('?', 1)[0]
+        with self._lock:
+            for host in hosts:
+                server = self._routes.get(host)
+                if server is None:
+                    continue
+                for prefix in self._prefixes.get(host, ()):
+                    if path == prefix or path.startswith(prefix.rstrip('/') + '/'):
+                        return server
+        return None
+
+class Instance(http.Server):
+    """A cache instance served by the multiplexer, rather than by a process and port of its own.
+
+    Its state and statistics are kept as for any other cache instance. Starting it adds its route to the
+    multiplexer, and pausing or stopping it removes the route. A stopped instance is started again when
+    the node next creates its expression, rather than a new one (and its threads) being created.
+
+    """
+
+    _multiplexer = None
+
+    def __init__(self, multiplexer, node, expr, port):
+        self._multiplexer = multiplexer
+        http.Server.__init__(self, node, expr, port)
+
+    def _setup_signal_handling(self):
+        """Signals are handled by the multiplexer."""
+        pass
+
+    def _create_notifier(self):
+        """Notifications are sent over the multiplexer's channel to the controller, shared by every instance."""
+        return self._multiplexer._notifier
+
+    def _create_server(self):
+        """Create the (socketless) server holding the state of this cache instance."""
+        server = RoutedHTTPServer(self._multiplexer, self._expr)
+        server._keep_alive_timeout = float(self._node.config["keep_alive_timeout"])
+        server._keep_alive_requests = int(self._node.config["keep_alive_requests"])
+        return server
+
+    def _run(self):
+        """Start the background threads and the instance. Requests are served by the multiplexer's worker threads."""
+        self._start_background()
+        self._start()
+
+    def _stop(self):
+        """Stop the instance (reporting its final statistics), and forget the paths routed to it."""
+        http.Server._stop(self)
+        self._multiplexer.remove(self._expr)
+
+class RoutedHTTPServer(http.Server.BaseCacheServer):
+    """The state of a cache instance served by the multiplexer.
+
+    It has no socket or worker pool of its own. Requests routed to it are handled by the multiplexer's worker threads.
+
+    """
+
+    _multiplexer = None
+    _route = None
+
+    def __init__(self, multiplexer, expr):
+        http.Server.BaseCacheServer.__init__(self)
+        self._multiplexer = multiplexer
+        self._route = expr
+
+    def _setup_signal_handling(self):
+        """Signals are handled by the multiplexer."""
+        pass
+
+    def resume(self):
+        """Start routing requests to this cache instance."""
+        http.Server.BaseCacheServer.resume(self)
+        self._multiplexer.route(self._route, self)
+
+    def suspend(self):
+        """Stop routing requests to this cache instance, and close the connections already routed to it once they are idle."""
+        self._multiplexer.unroute(self._route)
+        http.Server.BaseCacheServer.suspend(self)
+
+class MultiplexHTTPServer(http.Server.ThreadedHTTPServer):
+    """Accepts connections for every cache instance. Each request on them is handled by the instance it is routed to."""
+
+    _multiplexer = None
+
+    def __init__(self, server_address, multiplexer):
+        http.Server.ThreadedHTTPServer.__init__(self, server_address, RoutingHandler)
+        self._multiplexer = multiplexer
+
+class RoutingHandler(http.Server.HandlerClass):
+    """Handles a connection accepted by the multiplexer, moving it to the server of each cache instance a request on it is routed to."""
+
+    def _accept_request(self):
+        """Route the request, or answer it with a 404 (and close the connection) if its expression is not started."""
+        host, path = request_target(self.headers.getheader('Host'), self.path)
+        server = self.server._multiplexer.find_route(host, path)
+        if server is None:
+            self.close_connection = 1
+            self._send_empty(404)
+            return False
+        if server is not self.server:
+            self.server.remove_handler(self)
+            self.server = server
+            self.server._connections.increment()
+            self.server.add_handler(self)
+        return http.Server.HandlerClass._accept_request(self)
+
+def request_target(host, path):
+    """Get the host and path a request is for. An absolute URI given as the path names the host in place of the Host header."""
+    if path.startswith('http://'):
+        host, separator, path = path[7:].partition('/')
+        path = '/' + path
+    return host, path
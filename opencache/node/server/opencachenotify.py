@@ -0,0 +1,130 @@
+#!/usr/bin/env python2.7
+
+"""opencachenotify.py: Notifier - a single, long-lived channel for the notifications a process sends to the controller."""
+
+import threading
+import time
+
+import zmq
+
+TAG = 'notify'
+
+class Notifier:
+    """Sends the redirect, stat and alert notifications of the cache instances in a process to the controller.
+
+    One PUSH socket is kept open for the life of the process. Up to 'high_water_mark' messages are queued
+    for the controller whilst it is not receiving them; further messages are dropped, rather than holding
+    up the caller.
+
+    Redirects are sent straight away. Stats and alerts are held and sent together, every 'interval' seconds,
+    as a single 'batch' notification (or on their own, if there is only one). Only the latest stat of each
+    expression is sent. Alerts of the same type for the same expression are collapsed into a summary of how
+    many were raised, and the latest and greatest values, which is sent at most once every 'alert_interval'
+    seconds.
+
+    """
+
+    _address = None
+    _context = None
+    _socket = None
+    _interval = 0
+    _alert_interval = 0
+    _lock = None
+    _stats = None
+    _alerts = None
+    _node = None
+    _dropping = False
+    sent = 0
+    dropped = 0
+    suppressed = 0
+
+    def __init__(self, node, high_water_mark, interval, alert_interval):
+        """Open the channel to the controller's notification port."""
+        self._node = node
+        self._address = "tcp://" + node.config["controller_host"] + ":" + node.config["notification_port"]
+        self._interval = float(interval)
+        self._alert_interval = float(alert_interval)
+        self._lock = threading.Lock()
+        self._stats = dict()
+        self._alerts = dict()
+        self._context = zmq.Context()
+        self._socket = self._context.socket(zmq.PUSH)
+        self._socket.setsockopt(zmq.SNDHWM, int(high_water_mark))
+        self._socket.setsockopt(zmq.LINGER, 0)
+        self._socket.connect(self._address)
+
+    def send(self, message):
+        """Send a notification to the controller: straight away for a redirect, otherwise with the next batch."""
+        if message['method'] == 'stat':
+            with self._lock:
+                self._stats[message['params']['expr']] = message
+        elif message['method'] == 'alert':
+            self._add_alert(message['params'])
+        else:
+            self._send(message)
+
+    def run(self):
+        """Send the stats and alerts held every 'interval' seconds. Never returns."""
+        while True:
+            time.sleep(self._interval)
+            self.flush()
+
+    def flush(self):
+        """Send the stats held, and a summary of each type of alert held that is due to be sent."""
+        now = time.time()
+        with self._lock:
+            messages = self._stats.values()
+            self._stats = dict()
+            for summary in self._alerts.values():
+                if summary['count'] > 0 and now - summary['sent'] >= self._alert_interval:
+                    messages.append(self._get_alert(summary, now))
+                    self.suppressed += summary['count'] - 1
+                    summary['count'] = 0
+                    summary['sent'] = now
+        if len(messages) == 1:
+            self._send(messages[0])
+        elif messages:
+            self._send({'method' : 'batch', 'id' : None, 'params' : {'messages' : messages}})
+
+    def close(self):
+        """Close the channel, dropping anything not yet sent."""
+        self._socket.close()
+        self._context.term()
+
+    def _add_alert(self, params):
+        with self._lock:
+            summary = self._alerts.get((params['expr'], params['type']))
+            if summary is None:
+                summary = {'params' : params, 'count' : 0, 'max' : params['value'], 'first' : time.time(), 'sent' : 0}
+                self._alerts[(params['expr'], params['type'])] = summary
+            if summary['count'] == 0:
+                summary['max'] = params['value']
+                summary['first'] = time.time()
+            summary['params'] = params
+            summary['count'] += 1
+            summary['max'] = max(summary['max'], params['value'])
+
+    def _get_alert(self, summary, now):
+        """Get the message body for a summary of the alerts of one type raised since the last was sent."""
+        alert = dict()
+        alert['method'] = 'alert'
+        alert['id'] = None
+        alert['params'] = dict(summary['params'])
+        alert['params']['count'] = summary['count']
+        alert['params']['max'] = summary['max']
+        alert['params']['period'] = now - summary['first']
+        return alert
+
+    def _send(self, message):
+        """Queue a message for the controller, dropping it if the queue is full. ZMQ sockets are not thread-safe."""
+        with self._lock:
+            try:
+                self._socket.send_json(message, zmq.NOBLOCK)
+            except zmq.ZMQError:
+                self.dropped += 1
+                if not self._dropping:
+                    self._node.print_warn(TAG, 'Controller is not receiving notifications: dropping them until it is')
+                self._dropping = True
+                return
+            self.sent += 1
+            self._dropping = False
@@ -0,0 +1,171 @@
+#!/usr/bin/env python2.7
+
+"""opencacheorigin.py: Origin Pool - keeps persistent connections to origin servers for reuse between cache misses."""
+
+import httplib
+import select
+import socket
+import threading
+import time
+
+TAG = 'origin'
+
+class OriginPool:
+
+    _idle = None
+    _lock = None
+    _max_size = 0
+    _idle_timeout = 0
+    _timeout = None
+    _swept = 0
+    created = 0
+    reused = 0
+    latency = None
+
+    def __init__(self, max_size, idle_timeout, timeout=None, latency=None):
+        """Initialise an empty pool.
+
+        At most 'max_size' idle connections are kept for each origin host. Idle connections are closed
+        once they have not been used for 'idle_timeout' seconds. New connections are made with the given
+        socket 'timeout' (in seconds). The time taken for each response to arrive is recorded in the
+        'latency' histogram, if one is given.
+
+        """
+        self.latency = latency
+        self._idle = dict()
+        self._lock = threading.Lock()
+        self._max_size = int(max_size)
+        self._idle_timeout = float(idle_timeout)
+        if timeout is not None:
+            self._timeout = float(timeout)
+        self._swept = time.time()
+
+    def request(self, host, path, headers=None):
+        """Send a GET request to the origin host, over a pooled connection if one is available.
+
+        Returns the connection and the response. Once the response has been read, the connection
+        should be handed back with release(). If a reused connection turns out to have been closed
+        by the origin, the request is retried once on a new connection.
+
+        """
+        if headers is None:
+            headers = dict()
+        connection, reused = self._get(host)
+        started = time.time()
+        try:
+            connection.request("GET", path, headers=headers)
+            return connection, self._get_response(connection, started)
+        except (httplib.HTTPException, socket.error):
+            connection.close()
+            if not reused:
+                raise
+        connection = self._create(host)
+        started = time.time()
+        connection.request("GET", path, headers=headers)
+        return connection, self._get_response(connection, started)
+
+    def _get_response(self, connection, started):
+        """Read the response headers for a request sent at the time given, recording how long they took to arrive."""
+        response = connection.getresponse()
+        if self.latency is not None:
+            self.latency.record(time.time() - started)
+        return response
+
+    def release(self, host, connection, response):
+        """Hand a connection back to the pool once its response has been completely read.
+
+        Connections that the origin intends to close, or whose response has not been completely read,
+        are closed instead.
+
+        """
+        if response.will_close or not response.isclosed() or connection.sock is None:
+            connection.close()
+            return
+        self.keep(host, connection)
+
+    def connect(self, host, reuse=True):
+        """Get an open connection to the origin host, for a caller that sends the request and reads the response itself.
+
+        Returns the connection, and whether it is a pooled one being reused ('reuse' may be cleared to
+        make a new connection, as when a reused one turns out to have been closed by the origin).
+
+        """
+        if reuse:
+            connection, reused = self._get(host)
+            if reused:
+                return connection, True
+        else:
+            connection = self._create(host)
+        connection.connect()
+        return connection, False
+
+    def keep(self, host, connection):
+        """Hand a connection back to the pool whose response has been completely read, and which the origin has left open."""
+        now = time.time()
+        with self._lock:
+            idle = self._idle.setdefault(host, [])
+            if len(idle) < self._max_size:
+                idle.append((connection, now))
+                connection = None
+        if connection is not None:
+            connection.close()
+        self._sweep(now)
+
+    def close_all(self):
+        """Close every idle connection in the pool."""
+        with self._lock:
+            idle = self._idle
+            self._idle = dict()
+        for connections in idle.itervalues():
+            for connection, last_used in connections:
+                connection.close()
+
+    def count(self):
+        """Return the number of idle connections currently held."""
+        return sum(len(connections) for connections in self._idle.values())
+
+    def _get(self, host):
+        """Return a healthy idle connection to the host (most recently used first), or a new connection."""
+        now = time.time()
+        while True:
+            with self._lock:
+                idle = self._idle.get(host)
+                if not idle:
+                    break
+                connection, last_used = idle.pop()
+            if now - last_used < self._idle_timeout and _healthy(connection):
+                self.reused += 1
+                return connection, True
+            connection.close()
+        return self._create(host), False
+
+    def _create(self, host):
+        self.created += 1
+        return httplib.HTTPConnection(host, timeout=self._timeout)
+
+    def _sweep(self, now):
+        """Close idle connections that have expired, at most once per idle timeout period."""
+        if now - self._swept < self._idle_timeout:
+            return
+        self._swept = now
+        expired = []
+        with self._lock:
+            for host, idle in self._idle.items():
+                keep = [(connection, last_used) for connection, last_used in idle if now - last_used < self._idle_timeout]
+                expired.extend(connection for connection, last_used in idle if now - last_used >= self._idle_timeout)
+                if keep:
+                    self._idle[host] = keep
+                else:
+                    del self._idle[host]
+        for connection in expired:
+            connection.close()
+
+def _healthy(connection):
+    """Check an idle connection is still open. An idle socket that is readable has been closed (or is out of step)."""
+    if connection.sock is None:
+        return False
+    try:
+        readable, writable, exceptional = select.select([connection.sock], [], [], 0)
+    except (select.error, socket.error, ValueError):
+        return False
+    return not readable
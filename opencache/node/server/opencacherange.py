@@ -0,0 +1,313 @@
+#!/usr/bin/env python2.7
+
+"""opencacherange.py: Byte Ranges - parses HTTP range requests and stores objects of which only some ranges have been fetched."""
+
+import email.utils
+import json
+import mimetools
+import os
+import tempfile
+import threading
+import time
+
+import opencache.lib.opencachelib as lib
+
+TAG = 'range'
+
+MAX_RANGES = 16
+
+def parse_range(header, length):
+    """Parse a 'Range' header for an object of the given length (in bytes).
+
+    Returns a list of (first, last) byte positions (inclusive), in the order requested. An empty list
+    means that none of the ranges can be satisfied. None means that the header is missing, is not a
+    valid byte range request or asks for too many ranges, and so should be ignored.
+
+    """
+    if header is None:
+        return None
+    unit, separator, specs = header.strip().partition('=')
+    if unit.strip().lower() != 'bytes' or not separator:
+        return None
+    specs = [spec.strip() for spec in specs.split(',') if spec.strip()]
+    if not specs or len(specs) > MAX_RANGES:
+        return None
+    ranges = []
+    for spec in specs:
+        first, separator, last = spec.partition('-')
+        first = first.strip()
+        last = last.strip()
+        if not separator or (not first and not last):
+            return None
+        try:
+            if not first:
+                suffix = int(last)
+                if suffix > 0 and length > 0:
+                    ranges.append((max(0, length - suffix), length - 1))
+                continue
+            first = int(first)
+            last = int(last) if last else None
+        except ValueError:
+            return None
+        if first < 0 or (last is not None and last < first):
+            return None
+        if first < length:
+            ranges.append((first, length - 1 if last is None else min(last, length - 1)))
+    return ranges
+
+def parse_content_range(header):
+    """Parse a 'Content-Range' header. Returns (first, last, length), or None if it does not describe a known range."""
+    if header is None:
+        return None
+    unit, separator, value = header.strip().partition(' ')
+    if unit.lower() != 'bytes':
+        return None
+    span, separator, length = value.strip().partition('/')
+    first, separator, last = span.partition('-')
+    try:
+        first, last, length = int(first), int(last), int(length)
+    except ValueError:
+        return None
+    if first < 0 or last < first or last >= length:
+        return None
+    return first, last, length
+
+def content_range(first, last, length):
+    """Format a 'Content-Range' header value."""
+    return 'bytes %d-%d/%d' % (first, last, length)
+
+def if_range_matches(header, modified, etag=None):
+    """Check an 'If-Range' validator against a copy of the object stored at the given time, with the given entity tag.
+
+    A date matches if the copy was stored no later than that date. An entity tag matches only if it is
+    the same strong tag as the copy's. Without an 'If-Range' header, the range request is unconditional.
+
+    """
+    if header is None:
+        return True
+    header = header.strip()
+    if header.startswith('"') or header.startswith('W/'):
+        return etag is not None and header.startswith('"') and header == etag.strip()
+    date = email.utils.parsedate_tz(header)
+    if date is None or modified is None:
+        return False
+    return int(modified) <= email.utils.mktime_tz(date)
+
+def requested_ranges(range_header, if_range_header, length, modified, etag=None):
+    """Get the byte ranges a request asks for from an object of the given length, stored at the given time.
+
+    Returns None if the whole object should be sent instead (there is no valid 'Range' header, or the
+    'If-Range' validator does not match), otherwise as parse_range().
+
+    """
+    ranges = parse_range(range_header, length)
+    if ranges is None or not if_range_matches(if_range_header, modified, etag):
+        return None
+    return ranges
+
+def range_response(ranges, length, headers):
+    """Lay out a 206 response for the given (satisfiable) byte ranges of an object with the given headers.
+
+    A single range is sent on its own, with a 'Content-Range' header. Several ranges are sent as a
+    'multipart/byteranges' body, each part carrying the object's content type. Returns the response
+    headers, the parts of the body to send in order (each either a string or a (first, last) range of
+    the object), and the length of the body.
+
+    """
+    if len(ranges) == 1:
+        first, last = ranges[0]
+        return list(headers) + [('Content-range', content_range(first, last, length))], [(first, last)], last - first + 1
+    content_type = 'text-html'
+    for name, value in headers:
+        if name.lower() == 'content-type':
+            content_type = value
+    boundary = mimetools.choose_boundary()
+    parts = []
+    total = 0
+    for first, last in ranges:
+        part_header = '\r\n--%s\r\nContent-type: %s\r\nContent-range: %s\r\n\r\n' % (boundary, content_type,
+            content_range(first, last, length))
+        parts.append(part_header)
+        parts.append((first, last))
+        total += len(part_header) + last - first + 1
+    trailer = '\r\n--%s--\r\n' % boundary
+    parts.append(trailer)
+    total += len(trailer)
+    headers = [(name, value) for name, value in headers if name.lower() != 'content-type']
+    headers.append(('Content-type', 'multipart/byteranges; boundary=%s' % boundary))
+    return headers, parts, total
+
+class PartialStore:
+    """Objects of which only some byte ranges have been fetched from the origin.
+
+    Each range is written at its own offset in a sparse file, and the list of ranges held is recorded
+    alongside it, so that later requests for those ranges can be served from disk (including after a
+    restart). Once the ranges cover the whole object, the file can be moved into place as a complete
+    cached object.
+
+    """
+
+    _path = None
+    _lock = None
+    _objects = None
+    _usage = None
+    _levels = 0
+
+    def __init__(self, path, usage=None, levels=0):
+        """Initialise a store for partial objects in the given directory, sharded into 'levels' of subdirectories.
+
+        The size of each partial file is added to the running disk 'usage' total, if one is given, for as
+        long as the file is held here.
+
+        """
+        self._path = path
+        self._lock = threading.Lock()
+        self._objects = dict()
+        self._usage = usage
+        self._levels = levels
+
+    def data_path(self, key):
+        """Return the path of the (sparse) file holding the ranges of an object."""
+        return lib.shard_path(self._path, key, self._levels) + '.part'
+
+    def get(self, key):
+        """Return (length, ranges, modified) for a partially stored object, or None if no ranges are held."""
+        with self._lock:
+            entry = self._load(key)
+            if entry is None:
+                return None
+            return entry['length'], list(entry['ranges']), entry['modified']
+
+    def covers(self, key, ranges):
+        """Return True if all of the given (first, last) ranges of an object are held."""
+        held = self.get(key)
+        if held is None:
+            return False
+        for first, last in ranges:
+            if not any(start <= first and last <= end for start, end in held[1]):
+                return False
+        return True
+
+    def open_writer(self, key, length, first):
+        """Open the file holding an object's ranges for writing at byte 'first'.
+
+        If ranges of a different total length are already held, the object has changed at the origin,
+        so they are discarded first.
+
+        """
+        with self._lock:
+            entry = self._load(key)
+            if entry is not None and entry['length'] != length:
+                self._discard(key)
+                entry = None
+            if entry is None:
+                self._objects[key] = {'length' : length, 'ranges' : [], 'modified' : time.time()}
+            lib.create_directory(os.path.dirname(self.data_path(key)))
+            fd = os.open(self.data_path(key), os.O_RDWR | os.O_CREAT, 0644)
+            try:
+                size = os.fstat(fd).st_size
+                if size != length:
+                    os.ftruncate(fd, length)
+                    self._add_usage(length - size)
+            except OSError:
+                os.close(fd)
+                raise
+        f = os.fdopen(fd, 'r+b', 0)
+        f.seek(first)
+        return f
+
+    def add(self, key, first, last):
+        """Record that bytes 'first' to 'last' of an object have been written.
+
+        Returns True if the object is now complete, in which case it is no longer tracked here and its
+        file should be moved into place (or discarded) by the caller.
+
+        """
+        with self._lock:
+            entry = self._load(key)
+            if entry is None or last >= entry['length']:
+                return False
+            entry['ranges'] = merge_ranges(entry['ranges'] + [(first, last)])
+            if entry['ranges'] == [(0, entry['length'] - 1)]:
+                del self._objects[key]
+                self._remove_file(self._record_path(key))
+                self._add_usage(-entry['length'])
+                return True
+            self._save(key, entry)
+            return False
+
+    def remove(self, key):
+        """Discard any ranges held for an object."""
+        with self._lock:
+            self._discard(key)
+
+    def clear(self):
+        """Forget every object tracked (once their files have been deleted)."""
+        with self._lock:
+            self._objects.clear()
+
+    def _record_path(self, key):
+        return lib.shard_path(self._path, key, self._levels) + '.ranges'
+
+    def _load(self, key):
+        """Find the record of ranges held for an object, reading it from disk if it is not already known."""
+        entry = self._objects.get(key)
+        if entry is not None:
+            return entry
+        try:
+            with open(self._record_path(key), 'rb') as f:
+                record = json.load(f)
+            entry = {'length' : int(record['length']), 'ranges' : [tuple(r) for r in record['ranges']],
+                'modified' : float(record['modified'])}
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return None
+        if not os.path.exists(self.data_path(key)):
+            self._remove_file(self._record_path(key))
+            return None
+        self._objects[key] = entry
+        return entry
+
+    def _save(self, key, entry):
+        fd, temp_path = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=os.path.dirname(self._record_path(key)))
+        with os.fdopen(fd, 'wb') as f:
+            json.dump(entry, f)
+        size = os.path.getsize(temp_path)
+        try:
+            size -= os.path.getsize(self._record_path(key))
+        except OSError:
+            pass
+        os.rename(temp_path, self._record_path(key))
+        self._add_usage(size)
+
+    def _discard(self, key):
+        self._objects.pop(key, None)
+        self._remove_file(self._record_path(key))
+        self._remove_file(self.data_path(key))
+
+    def _remove_file(self, path):
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        _remove(path)
+        self._add_usage(-size)
+
+    def _add_usage(self, size):
+        if self._usage is not None:
+            self._usage.add(size, 0)
+
+def merge_ranges(ranges):
+    """Merge overlapping or adjacent (first, last) ranges into a sorted list of disjoint ranges."""
+    merged = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -0,0 +1,241 @@
+#!/usr/bin/env python2.7
+
+"""opencachesegment.py: Segment Store - packs small cached objects into large, pre-allocated segment files."""
+
+import mmap
+import os
+import threading
+
+import opencache.lib.opencachelib as lib
+
+TAG = 'segment'
+
+class SegmentStore:
+    """Small objects appended, one after another, to large segment files, and read back through mmap.
+
+    Objects are written to the active segment until it is full, when it is sealed and a new segment is
+    started. Each segment file is created at its full size. The caller records where each
+    object was written (the segment's path and the offset within it), such as in the object index.
+
+    Objects that are removed leave holes. Once the objects still held in a sealed segment take up less
+    than the 'compact_threshold' fraction of it, they are copied to the active segment in the background
+    and the sealed segment is deleted. Each object moved is reported by calling 'relocate' with its key,
+    old path, new path and new offset.
+
+    """
+
+    _path = None
+    _segment_size = 0
+    _max_object_size = 0
+    _compact_threshold = 0.5
+    _usage = None
+    _relocate = None
+    _lock = None
+    _wakeup = None
+    _segments = None
+    _objects = None
+    _active = None
+    _active_file = None
+    _offset = 0
+    _next = 0
+    compacted = 0
+
+    def __init__(self, path, segment_size, max_object_size, compact_threshold, usage=None, relocate=None):
+        """Initialise a segment store in the given directory.
+
+        Objects of up to 'max_object_size' bytes are admitted. The size of each segment file is added to the
+        running disk 'usage' total, if one is given, for as long as the segment exists.
+
+        """
+        self._path = path
+        self._segment_size = int(segment_size)
+        self._max_object_size = min(int(max_object_size), self._segment_size)
+        self._compact_threshold = float(compact_threshold)
+        self._usage = usage
+        self._relocate = relocate
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._segments = dict()
+        self._objects = dict()
+
+    def admits(self, size):
+        """Return True if an object of the given size (in bytes) should be stored in a segment."""
+        return 0 < size <= self._max_object_size
+
+    def holds(self, path):
+        """Return True if the given path is that of a segment file in this store."""
+        return os.path.dirname(path) == self._path and path.endswith('.seg')
+
+    def load(self, objects):
+        """Open the segments holding the given (key, path, offset, size) objects, left by a previous run.
+
+        Segments holding none of the objects are deleted. New objects are written to a new segment.
+
+        """
+        lib.create_directory(self._path)
+        with self._lock:
+            for key, path, offset, size in objects:
+                segment = self._segments.get(path)
+                if segment is None:
+                    try:
+                        segment = Segment(path)
+                    except (IOError, OSError, ValueError):
+                        continue
+                    self._segments[path] = segment
+                segment.objects[key] = (offset, size)
+                segment.live += size
+                self._objects[key] = path
+            for name in os.listdir(self._path):
+                path = os.path.join(self._path, name)
+                number, separator, suffix = name.partition('.')
+                if suffix != 'seg' or not number.isdigit():
+                    continue
+                self._next = max(self._next, int(number) + 1)
+                if path in self._segments:
+                    self._add_usage(self._segments[path].size)
+                else:
+                    _remove(path)
+        self._wakeup.set()
+
+    def append(self, key, data):
+        """Write an object to the active segment. Returns the path of the segment and the offset it was written at.
+
+        Any copy of the object already held is removed.
+
+        """
+        with self._lock:
+            self._discard(key)
+            return self._append(key, data)
+
+    def read(self, path, offset, size):
+        """Read an object from a segment. Raises IOError if the segment (or the object) is no longer held."""
+        with self._lock:
+            segment = self._segments.get(path)
+            if segment is None or offset + size > segment.size:
+                raise IOError('Segment no longer holds object: %s' % path)
+            return segment.map[offset:offset + size]
+
+    def remove(self, key):
+        """Remove an object, leaving a hole in its segment to be reclaimed by compaction."""
+        with self._lock:
+            if self._discard(key):
+                self._wakeup.set()
+
+    def clear(self):
+        """Close every segment and forget every object held (once the segment files have been deleted)."""
+        with self._lock:
+            for segment in self._segments.values():
+                segment.close()
+            if self._active_file is not None:
+                self._active_file.close()
+            self._segments.clear()
+            self._objects.clear()
+            self._active = None
+            self._active_file = None
+            self._offset = 0
+
+    def count(self):
+        """Return the number of objects held."""
+        return len(self._objects)
+
+    def run(self):
+        """Compact sealed segments whenever objects are removed from them. Never returns."""
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            self.compact()
+
+    def compact(self):
+        """Copy the objects out of each sealed segment that is mostly holes to the active segment, and delete it."""
+        with self._lock:
+            sparse = [segment.path for segment in self._segments.itervalues() if segment is not self._active and
+                segment.live < self._compact_threshold * segment.size]
+        for path in sparse:
+            self._compact_segment(path)
+
+    def _compact_segment(self, path):
+        """Move the objects out of a sealed segment, one at a time, then delete it."""
+        while True:
+            with self._lock:
+                segment = self._segments.get(path)
+                if segment is None:
+                    return
+                if not segment.objects:
+                    del self._segments[path]
+                    segment.close()
+                    _remove(path)
+                    self._add_usage(-segment.size)
+                    self.compacted += 1
+                    return
+                key, (offset, size) = segment.objects.iteritems().next()
+                data = segment.map[offset:offset + size]
+                self._discard(key)
+                new_path, new_offset = self._append(key, data)
+            if self._relocate is not None:
+                self._relocate(key, path, new_path, new_offset)
+
+    def _append(self, key, data):
+        if self._active is None or self._offset + len(data) > self._active.size:
+            self._start_segment()
+        offset = self._offset
+        self._active_file.seek(offset)
+        self._active_file.write(data)
+        self._offset += len(data)
+        self._active.objects[key] = (offset, len(data))
+        self._active.live += len(data)
+        self._objects[key] = self._active.path
+        return self._active.path, offset
+
+    def _start_segment(self):
+        """Seal the active segment (if any) and start a new one."""
+        if self._active_file is not None:
+            self._active_file.close()
+            if self._active.live < self._compact_threshold * self._active.size:
+                self._wakeup.set()
+        path = os.path.join(self._path, '%d.seg' % self._next)
+        self._next += 1
+        lib.create_directory(self._path)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0644)
+        try:
+            os.ftruncate(fd, self._segment_size)
+        except OSError:
+            os.close(fd)
+            raise
+        self._active_file = os.fdopen(fd, 'r+b', 0)
+        self._active = Segment(path)
+        self._segments[path] = self._active
+        self._offset = 0
+        self._add_usage(self._segment_size)
+
+    def _discard(self, key):
+        path = self._objects.pop(key, None)
+        if path is None:
+            return False
+        segment = self._segments[path]
+        offset, size = segment.objects.pop(key)
+        segment.live -= size
+        return segment is not self._active and segment.live < self._compact_threshold * segment.size
+
+    def _add_usage(self, size):
+        if self._usage is not None:
+            self._usage.add(size, 0)
+
+class Segment:
+    """A segment file, mapped into memory for reading, and the objects it holds."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.size = os.fstat(f.fileno()).st_size
+            self.map = mmap.mmap(f.fileno(), self.size, access=mmap.ACCESS_READ)
+        self.objects = dict()
+        self.live = 0
+
+    def close(self):
+        self.map.close()
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -28,13 +28,20 @@ class State:
             except Exception as e:
                 self._node.print_warn(TAG, "Could not connect to MongoDB database, retrying in 15 seconds: " + str(e))
                 time.sleep(15)
+        self._database.content.ensure_index([('expr', pymongo.ASCENDING), ('key', pymongo.ASCENDING)])
 
     def create(self, document):
         return self._database.content.insert(document, upsert=True)
 
+    def update(self, query, document):
+        return self._database.content.update(query, {'$set' : document}, upsert=True)
+
     def remove(self, document):
         return self._database.content.remove(document)
 
+    def count(self, document):
+        return self._database.content.find(document).count()
+
     def lookup(self, document):
         result = self._database.content.find(document)
         result_obj = []
@@ -1,8 +1,54 @@
 #!/usr/bin/env python2.7
 
+import json
+
 import opencache.lib.opencachelib as lib
 
 def test_expr_split():
     root, path = lib.expr_split('127.0.0.1/path/to/object')
     assert root == '127.0.0.1'
-    assert path == 'path/to/object'
\ No newline at end of file
+    assert path == 'path/to/object'
+
+def test_shard_path():
+    assert lib.shard_path('/cache', 'abcdef', 2) == '/cache/ab/cd/abcdef'
+    assert lib.shard_path('/cache', 'abcdef', 1) == '/cache/ab/abcdef'
+    assert lib.shard_path('/cache', 'abcdef', 0) == '/cache/abcdef'
+
+def test_config_enabled():
+    assert lib.config_enabled('true')
+    assert lib.config_enabled('Yes')
+    assert lib.config_enabled('1')
+    assert not lib.config_enabled('false')
+    assert not lib.config_enabled('0')
+
+def test_latency_histogram_percentile():
+    histogram = lib.LatencyHistogram()
+    assert histogram.percentile(50) == 0.0
+    for i in range(1, 101):
+        histogram.record(i / 1000.0)
+    assert histogram.count() == 100
+    assert abs(histogram.percentile(50) - 0.050) <= 0.050 / 32
+    assert abs(histogram.percentile(99) - 0.099) <= 0.099 / 32
+    assert histogram.percentile(100) >= 0.100
+
+def test_latency_histogram_merge():
+    first = lib.LatencyHistogram()
+    second = lib.LatencyHistogram()
+    for i in range(90):
+        first.record(0.001)
+    for i in range(10):
+        second.record(1.0)
+    merged = lib.LatencyHistogram(json.loads(json.dumps(first.to_dict())))
+    merged.merge(second)
+    assert merged.count() == 100
+    assert merged.percentile(50) < 0.002
+    assert merged.percentile(95) > 0.9
+
+def test_latency_histogram_cumulative():
+    histogram = lib.LatencyHistogram()
+    histogram.record(0.000010)
+    histogram.record(0.002)
+    histogram.record(0.5)
+    counts, total = histogram.cumulative([0.001, 0.01, 1.0])
+    assert counts == [1, 2, 3]
+    assert abs(total - 0.50201) < 0.50201 / 32
@@ -0,0 +1,1245 @@
+#!/usr/bin/env python2.7
+
+import BaseHTTPServer
+import contextlib
+import hashlib
+import httplib
+import mimetools
+import multiprocessing
+import os
+import resource
+import shutil
+import socket
+import SocketServer
+import StringIO
+import struct
+import tempfile
+import threading
+import time
+import zlib
+
+import opencache.lib.opencachelib as lib
+import opencache.node.opencachenode as node
+import opencache.node.server.opencachebloom as bloom
+import opencache.node.server.opencachecompression as compression
+import opencache.node.server.opencacheevent as event
+import opencache.node.server.opencacheeviction as eviction
+import opencache.node.server.opencachefreshness as freshness
+import opencache.node.server.opencachehttp as http
+import opencache.node.server.opencacheindex as index
+import opencache.node.server.opencachememory as memory
+import opencache.node.server.opencachemetrics as metrics
+import opencache.node.server.opencachemultiplex as multiplex
+import opencache.node.server.opencachenotify as notify
+import opencache.node.server.opencacheorigin as origin
+import opencache.node.server.opencacherange as byte_range
+import opencache.node.server.opencachesegment as segment
+
+CHUNK_SIZE = 16384
+
+class OriginHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the objects held by the origin server (or a single range of one, or a 304 if the client's entity tag
+    matches), closing the connection after any whose length is given wrongly. Objects with a Transfer-encoding
+    header are sent chunked."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        headers, body = self.server.objects.get(self.path, ([], None))
+        if body is None:
+            self.send_response(404)
+            self.send_header('Content-length', 0)
+            self.end_headers()
+            return
+        etag = dict(headers).get('ETag')
+        if etag is not None and self.headers.getheader('if-none-match') == etag:
+            time.sleep(self.server.delay)
+            self.send_response(304)
+            for name, value in headers:
+                self.send_header(name, value)
+            self.end_headers()
+            return
+        requested = self.headers.getheader('range')
+        if requested is not None and requested.startswith('bytes=') and ',' not in requested:
+            first, last = requested[6:].split('-')
+            if not first:
+                first, last = len(body) - int(last), len(body) - 1
+            else:
+                first, last = int(first), min(int(last or len(body) - 1), len(body) - 1)
+            self.send_response(206)
+            self.send_header('Content-range', 'bytes %d-%d/%d' % (first, last, len(body)))
+            body = body[first:last + 1]
+        else:
+            self.send_response(200)
+        for name, value in headers:
+            self.send_header(name, value)
+        chunked = 'Transfer-encoding' in dict(headers)
+        if 'Content-length' in dict(headers):
+            self.close_connection = 1
+        elif not chunked:
+            self.send_header('Content-length', len(body))
+        self.end_headers()
+        for i in range(0, len(body), CHUNK_SIZE):
+            if chunked:
+                self.wfile.write('%x\r\n%s\r\n' % (len(body[i:i + CHUNK_SIZE]), body[i:i + CHUNK_SIZE]))
+            else:
+                self.wfile.write(body[i:i + CHUNK_SIZE])
+            if self.server.delay:
+                self.wfile.flush()
+                time.sleep(self.server.delay)
+        if chunked:
+            self.wfile.write('0\r\n\r\n')
+
+class OriginServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """An origin server on a free local port, holding 'objects' (path -> (headers, body)) and recording the
+    'requests' made and 'connections' accepted."""
+
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), OriginHandler)
+        self.objects = dict()
+        self.requests = []
+        self.connections = 0
+        self.delay = 0
+        self.expr = '127.0.0.1:%d' % self.server_address[1]
+
+    def handle_error(self, request, client_address):
+        pass
+
+class Database:
+    """Holds content documents in memory, in place of the node's MongoDB state."""
+
+    def __init__(self, documents=None):
+        self.documents = documents if documents is not None else []
+
+    def create(self, document):
+        self.documents.append(dict(document))
+
+    def update(self, query, document):
+        for i, existing in enumerate(self.documents[:]):
+            if self._matches(existing, query):
+                existing.update(document)
+                self.documents[i] = existing
+                return
+        query = dict(query)
+        query.update(document)
+        self.documents.append(query)
+
+    def remove(self, query):
+        self.documents[:] = [document for document in self.documents[:] if not self._matches(document, query)]
+
+    def count(self, query):
+        return len(self.lookup(query))
+
+    def lookup(self, query):
+        return [document for document in self.documents[:] if self._matches(document, query)]
+
+    def _matches(self, document, query):
+        for name, value in query.items():
+            if isinstance(value, dict):
+                if (name in document) != value['$exists']:
+                    return False
+            elif document.get(name) != value:
+                return False
+        return True
+
+class Node(node.Node):
+    """The parts of a node that cache instances use: its default configuration (with any changes given) and database."""
+
+    def __init__(self, cache_path=None, database=None, **config):
+        self.node_id = 1
+        self.config = self._create_config_defaults()
+        if cache_path is not None:
+            self.config['cache_path'] = cache_path
+        self.config.update(config)
+        self.database = database if database is not None else Database()
+        self.origins = origin.OriginPool(self.config['origin_pool_size'], self.config['origin_idle_timeout'],
+            self.config['origin_timeout'])
+
+    def print_debug(self, tag, string):
+        pass
+
+    def print_info(self, tag, string):
+        pass
+
+    def print_warn(self, tag, string):
+        pass
+
+    def print_error(self, tag, string):
+        pass
+
+class Controlled:
+    """Takes the node's messages from a queue, rather than the node's ipc socket. Comes first among the bases of a
+    cache instance, as the servers are old-style classes (whose methods are looked up depth first). Puts the
+    instance's counters on the 'reports' queue (if any) when sent 'report'."""
+
+    def __init__(self, node, expr, port, messages, reports=None):
+        self._messages = messages
+        self._reports = reports
+        http.Server.__init__(self, node, expr, port)
+
+    def _conn_manager(self, expr):
+        while True:
+            expr, call, path, transaction = self._messages.get().split()
+            getattr(self, "_" + call)()
+
+    def _report(self):
+        self._reports.put(self._get_counters())
+
+class ControlledServer(Controlled, http.Server):
+    """A cache instance that takes the node's messages from a queue."""
+
+class ControlledEventServer(Controlled, event.Server):
+    """An event-loop cache instance that takes the node's messages from a queue."""
+
+class Multiplexer(multiplex.Multiplexer):
+    """A multiplexer that takes the node's messages from a queue, rather than the node's ipc socket."""
+
+    def __init__(self, node, port, messages):
+        self._messages = messages
+        multiplex.Multiplexer.__init__(self, node, port)
+
+    def _conn_manager(self):
+        while True:
+            self._dispatch(self._messages.get())
+
+@contextlib.contextmanager
+def temp_directory():
+    directory = tempfile.mkdtemp()
+    try:
+        yield directory
+    finally:
+        shutil.rmtree(directory, True)
+
+@contextlib.contextmanager
+def origin_server():
+    origin = OriginServer()
+    thread = threading.Thread(target=origin.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield origin
+    finally:
+        origin.shutdown()
+        origin.server_close()
+
+@contextlib.contextmanager
+def cache_instance(expr, target=http.Server, workers=1, messages=None, reports=None, **config):
+    """Run a cache instance for the expression in a process of its own (or one per worker, sharing a database), as the
+    node does. Queues of 'messages' and 'reports' are passed on to a controlled target. Yields its port and directory."""
+    with temp_directory() as directory:
+        port = free_port()
+        database = None
+        if workers > 1:
+            manager = multiprocessing.Manager()
+            database = Database(manager.list())
+        node = Node(directory + '/', database, workers=str(workers), **config)
+        if workers > 1:
+            keys = bloom.CountingBloomFilter(node.config['key_filter_capacity'], node.config['key_filter_error_rate'], True)
+            usage = http.DiskUsage(True)
+        processes = []
+        for worker in range(workers):
+            if workers > 1:
+                args = (node, expr, port, worker, workers, keys, usage)
+            elif messages is not None:
+                args = (node, expr, port, messages, reports)
+            else:
+                args = (node, expr, port)
+            processes.append(multiprocessing.Process(target=target, args=args))
+            processes[-1].daemon = True
+            processes[-1].start()
+        try:
+            wait_for_port(port)
+            yield port, os.path.join(directory, hashlib.sha224(expr).hexdigest())
+        finally:
+            for process in processes:
+                process.terminate()
+                process.join()
+            if workers > 1:
+                manager.shutdown()
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except socket.error:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.05)
+
+def get(port, path, headers=None, connection=None):
+    """Make a GET request of a cache instance (over the given connection, if any). Returns the response and its body."""
+    if connection is None:
+        connection = httplib.HTTPConnection('127.0.0.1', port, timeout=10)
+    connection.request('GET', path, headers=headers or dict())
+    response = connection.getresponse()
+    return response, response.read()
+
+class PlainHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers every GET with a short plain body (once the server's 'release' event, if any, is set)."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        release = getattr(self.server, 'release', None)
+        if release is not None:
+            release.wait()
+        self.send_response(200)
+        self.send_header('Content-length', 2)
+        self.end_headers()
+        self.wfile.write('ok')
+
+def wait_until(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.05)
+
+def stored_files(path):
+    """Get the contents of the files in a cache instance's directory (other than temporary files), by name."""
+    files = dict()
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            if not name.startswith('.'):
+                with open(os.path.join(dirpath, name), 'rb') as f:
+                    files[name] = f.read()
+    return files
+
+def test_memory_tier_evicts_least_recently_used():
+    tier = memory.MemoryTier(100, 60)
+    assert tier.put('a', [], 'a' * 40)
+    assert tier.put('b', [], 'b' * 40)
+    assert tier.get('a') == ([], 'a' * 40)
+    assert tier.put('c', [('Content-type', 'text/plain')], 'c' * 40)
+    assert tier.get('b') is None
+    assert tier.get('c') == ([('Content-type', 'text/plain')], 'c' * 40)
+    assert not tier.put('d', [], 'd' * 61)
+    assert tier.count() == 2
+    assert tier.size == 80
+    assert (tier.hit, tier.miss, tier.eviction) == (2, 1, 1)
+    tier.remove('a')
+    assert tier.size == 40
+
+def test_memory_tier_disabled():
+    tier = memory.MemoryTier(0, 60)
+    assert not tier.put('a', [], 'a')
+    assert tier.get('a') is None
+
+def test_send_file():
+    data = ''.join(chr(i % 251) for i in range(30000))
+    with tempfile.TemporaryFile() as f:
+        f.write(data)
+        f.flush()
+        for sendfile in (http._sendfile, None):
+            original, http._sendfile = http._sendfile, sendfile
+            sender, receiver = socket.socketpair()
+            try:
+                assert http.send_file(sender, f, 10, 20000) == 20000
+                assert http.send_file(sender, f, len(data) - 5, 10) == 5
+            finally:
+                http._sendfile = original
+                sender.close()
+            received = ''
+            while True:
+                chunk = receiver.recv(65536)
+                if not chunk:
+                    break
+                received += chunk
+            receiver.close()
+            assert received == data[10:20010] + data[-5:]
+
+def test_send_file_times_out():
+    with tempfile.TemporaryFile() as f:
+        f.write('x' * 10000000)
+        f.flush()
+        for sendfile in (http._sendfile, None):
+            original, http._sendfile = http._sendfile, sendfile
+            sender, receiver = socket.socketpair()
+            sender.settimeout(0.2)
+            try:
+                http.send_file(sender, f, 0, 10000000)
+                assert False
+            except socket.timeout:
+                pass
+            finally:
+                http._sendfile = original
+                sender.close()
+                receiver.close()
+
+def test_cache_miss_streamed_to_client_and_disk():
+    with origin_server() as origin:
+        body = os.urandom(300000)
+        origin.objects['/large'] = ([], body)
+        origin.objects['/truncated'] = ([('Content-length', 1000)], 'x' * 600)
+        with cache_instance(origin.expr) as (port, path):
+            assert get(port, '/large')[1] == body
+            assert get(port, '/large')[1] == body
+            assert origin.requests == ['/large']
+            for i in range(2):
+                try:
+                    get(port, '/truncated')
+                    assert False
+                except httplib.IncompleteRead:
+                    pass
+            assert origin.requests.count('/truncated') == 2
+            assert stored_files(path) == {hashlib.sha224('/large').hexdigest() : body}
+            assert [name for dirpath, dirnames, filenames in os.walk(path) for name in filenames] == [hashlib.sha224('/large').hexdigest()]
+
+def test_concurrent_misses_coalesced():
+    with origin_server() as origin:
+        body = os.urandom(200000)
+        origin.objects['/shared'] = ([], body)
+        origin.delay = 0.05
+        with cache_instance(origin.expr) as (port, path):
+            bodies = []
+            clients = [threading.Thread(target=lambda: bodies.append(get(port, '/shared')[1])) for i in range(4)]
+            for client in clients:
+                client.start()
+                time.sleep(0.05)
+            for client in clients:
+                client.join()
+            assert bodies == [body] * 4
+            assert origin.requests == ['/shared']
+            assert stored_files(path) == {hashlib.sha224('/shared').hexdigest() : body}
+
+def test_serve_loop_blocks_while_suspended():
+    server = http.Server.ThreadedHTTPServer(('127.0.0.1', 0), PlainHandler)
+    server.handle_error = lambda request, client_address: None
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    port = server.server_address[1]
+    server.resume()
+    assert get(port, '/')[1] == 'ok'
+    server.suspend()
+    time.sleep(0.1)
+    used = resource.getrusage(resource.RUSAGE_SELF)
+    connection = httplib.HTTPConnection('127.0.0.1', port, timeout=0.5)
+    try:
+        get(port, '/', connection=connection)
+        assert False
+    except socket.timeout:
+        pass
+    time.sleep(0.5)
+    now = resource.getrusage(resource.RUSAGE_SELF)
+    assert (now.ru_utime + now.ru_stime) - (used.ru_utime + used.ru_stime) < 0.3
+    server.resume()
+    connection = httplib.HTTPConnection('127.0.0.1', port, timeout=5)
+    assert get(port, '/', connection=connection)[1] == 'ok'
+    server.suspend()
+    server.server_close()
+
+def test_event_engine_miss_hit_and_coalescing():
+    with origin_server() as origin:
+        body = os.urandom(200000)
+        origin.objects['/shared'] = ([], body)
+        origin.objects['/small'] = ([], 'small')
+        origin.delay = 0.05
+        with cache_instance(origin.expr, target=event.Server) as (port, path):
+            bodies = []
+            clients = [threading.Thread(target=lambda: bodies.append(get(port, '/shared')[1])) for i in range(4)]
+            for client in clients:
+                client.start()
+                time.sleep(0.05)
+            for client in clients:
+                client.join()
+            assert bodies == [body] * 4
+            connection = httplib.HTTPConnection('127.0.0.1', port, timeout=10)
+            assert get(port, '/shared', connection=connection)[1] == body
+            assert get(port, '/small', connection=connection)[1] == 'small'
+            assert get(port, '/small', connection=connection)[1] == 'small'
+            response, content = get(port, '/missing', connection=connection)
+            assert response.status == 404
+            assert origin.requests == ['/shared', '/small', '/missing']
+            wait_until(lambda: len(stored_files(path)) == 2)
+            assert stored_files(path) == {hashlib.sha224('/shared').hexdigest() : body, hashlib.sha224('/small').hexdigest() : 'small'}
+
+def test_event_engine_requests_after_fetch_wait_for_commit():
+    with origin_server() as origin:
+        for i in range(20):
+            origin.objects['/%d' % i] = ([], str(i) * 1000)
+        with cache_instance(origin.expr, target=event.Server) as (port, path):
+            connection = httplib.HTTPConnection('127.0.0.1', port, timeout=10)
+            for i in range(20):
+                assert get(port, '/%d' % i, connection=connection)[1] == str(i) * 1000
+                assert get(port, '/%d' % i, connection=connection)[1] == str(i) * 1000
+            assert origin.requests == ['/%d' % i for i in range(20)]
+
+def test_read_ahead_producers_read_with_given_callable():
+    submit = lambda function, args, callback: callback(function(*args), None)
+    def produced(producer):
+        data = []
+        while producer.ready() and producer._chunks:
+            data.append(producer.more())
+        return data
+    chunks = ['a', 'b', 'c', '']
+    assert produced(event.ReadAheadProducer(submit, lambda: chunks.pop(0))) == ['a', 'b', 'c']
+    body = os.urandom(http.CHUNK_SIZE * 2 + 10)
+    assert ''.join(produced(event.FileProducer(submit, StringIO.StringIO(body), len(body) - 5, 5))) == body[5:]
+    compressor = zlib.compressobj(6, zlib.DEFLATED, compression.ENCODINGS['gzip'])
+    compressed = StringIO.StringIO(compressor.compress(body) + compressor.flush())
+    assert ''.join(produced(event.DecompressProducer(submit, compressed, 'gzip'))) == body
+
+def test_worker_pool_rejects_overflow():
+    server = http.Server.ThreadedHTTPServer(('127.0.0.1', 0), PlainHandler)
+    server.handle_error = lambda request, client_address: None
+    server.release = threading.Event()
+    server.start_workers(1, 1, True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    port = server.server_address[1]
+    server.resume()
+    connections = [httplib.HTTPConnection('127.0.0.1', port, timeout=10) for i in range(3)]
+    for connection in connections:
+        connection.request('GET', '/')
+        time.sleep(0.2)
+    response = connections[2].getresponse()
+    assert response.status == 503
+    assert server.get_worker_stats()['worker_rejected'] == 1
+    server.release.set()
+    for connection in connections[:2]:
+        assert connection.getresponse().read() == 'ok'
+        connection.close()
+    server.suspend()
+    server.server_close()
+
+def test_persistent_connections():
+    for target in (http.Server, event.Server):
+        with origin_server() as origin:
+            origin.objects['/object'] = ([], 'object')
+            with cache_instance(origin.expr, target=target, keep_alive_requests='2', keep_alive_timeout='0.5') as (port, path):
+                connection = httplib.HTTPConnection('127.0.0.1', port, timeout=10)
+                response, body = get(port, '/object', connection=connection)
+                assert body == 'object' and response.getheader('connection') is None
+                response, body = get(port, '/object', connection=connection)
+                assert body == 'object' and response.getheader('connection') == 'close'
+                connection = httplib.HTTPConnection('127.0.0.1', port, timeout=10)
+                get(port, '/object', connection=connection)
+                time.sleep(2)
+                assert connection.sock.recv(1) == ''
+        with cache_instance('127.0.0.1:%d' % free_port(), target=target) as (port, path):
+            connection = httplib.HTTPConnection('127.0.0.1', port, timeout=10)
+            for i in range(2):
+                response, body = get(port, '/object', connection=connection)
+                assert (response.status, body, response.getheader('connection')) == (502, '', None)
+
+def test_origin_pool_reuses_connections():
+    with origin_server() as server:
+        server.objects['/object'] = ([], 'ok')
+        pool = origin.OriginPool(2, 30, 5)
+        for i in range(3):
+            connection, response = pool.request(server.expr, '/object')
+            assert response.read() == 'ok'
+            pool.release(server.expr, connection, response)
+        assert (pool.created, pool.reused, pool.count()) == (1, 2, 1)
+        assert server.connections == 1
+        pool.close_all()
+        assert pool.count() == 0
+
+def test_origin_pool_closes_unread_responses():
+    with origin_server() as server:
+        server.objects['/object'] = ([], 'ok')
+        pool = origin.OriginPool(2, 30, 5)
+        connection, response = pool.request(server.expr, '/object')
+        pool.release(server.expr, connection, response)
+        assert pool.count() == 0
+
+def test_cache_misses_share_origin_connections():
+    with origin_server() as server:
+        for name in ('a', 'b', 'c'):
+            server.objects['/' + name] = ([], name)
+        with cache_instance(server.expr) as (port, path):
+            for name in ('a', 'b', 'c'):
+                assert get(port, '/' + name)[1] == name
+        assert server.requests == ['/a', '/b', '/c']
+        assert server.connections == 1
+
+def test_event_engine_misses_share_origin_connections():
+    with origin_server() as server:
+        for name in ('a', 'b', 'c'):
+            server.objects['/' + name] = ([], name)
+        body = os.urandom(100000)
+        server.objects['/chunked'] = ([('Transfer-encoding', 'chunked')], body)
+        with cache_instance(server.expr, target=event.Server) as (port, path):
+            for name in ('a', 'b', 'c'):
+                assert get(port, '/' + name)[1] == name
+            assert get(port, '/chunked')[1] == body
+            assert get(port, '/chunked')[1] == body
+            assert get(port, '/a')[1] == 'a'
+        assert server.requests == ['/a', '/b', '/c', '/chunked']
+        assert server.connections == 1
+
+def test_parse_range():
+    assert byte_range.parse_range('bytes=0-99', 1000) == [(0, 99)]
+    assert byte_range.parse_range('bytes=900-', 1000) == [(900, 999)]
+    assert byte_range.parse_range('bytes=-100', 1000) == [(900, 999)]
+    assert byte_range.parse_range('bytes=990-2000', 1000) == [(990, 999)]
+    assert byte_range.parse_range('bytes=0-0, 10-19', 1000) == [(0, 0), (10, 19)]
+    assert byte_range.parse_range('bytes=1000-', 1000) == []
+    assert byte_range.parse_range(None, 1000) is None
+    assert byte_range.parse_range('items=0-99', 1000) is None
+    assert byte_range.parse_range('bytes=99-0', 1000) is None
+    assert byte_range.parse_range('bytes=a-b', 1000) is None
+    assert byte_range.parse_range('bytes=' + ','.join(['0-1'] * (byte_range.MAX_RANGES + 1)), 1000) is None
+
+def test_if_range_matches():
+    stored = 1000000000
+    assert byte_range.if_range_matches(None, stored)
+    assert byte_range.if_range_matches('"v1"', stored, '"v1"')
+    assert not byte_range.if_range_matches('"v2"', stored, '"v1"')
+    assert not byte_range.if_range_matches('W/"v1"', stored, 'W/"v1"')
+    assert byte_range.if_range_matches('Sun, 09 Sep 2001 01:46:40 GMT', stored)
+    assert not byte_range.if_range_matches('Sun, 09 Sep 2001 01:46:39 GMT', stored)
+    assert not byte_range.if_range_matches('Sun, 09 Sep 2001 01:46:40 GMT', None)
+    assert byte_range.requested_ranges('bytes=0-9', '"v2"', 1000, stored, '"v1"') is None
+    assert byte_range.requested_ranges('bytes=0-9', None, 1000, stored) == [(0, 9)]
+
+def test_range_requests():
+    for target in (http.Server, event.Server):
+        with origin_server() as origin:
+            body = os.urandom(100000)
+            origin.objects['/object'] = ([], body)
+            with cache_instance(origin.expr, target=target) as (port, path):
+                response, content = get(port, '/object', {'Range' : 'bytes=10-19'})
+                assert (response.status, content) == (206, body[10:20])
+                assert response.getheader('content-range') == 'bytes 10-19/100000'
+                assert get(port, '/object')[1] == body
+                response, content = get(port, '/object', {'Range' : 'bytes=-5'})
+                assert (response.status, content) == (206, body[-5:])
+                response, content = get(port, '/object', {'Range' : 'bytes=200000-'})
+                assert response.status == 416
+
+def evict_all(policy):
+    victims = []
+    while True:
+        key = policy.evict()
+        if key is None:
+            return victims
+        victims.append(key)
+
+def test_lru_policy_order():
+    policy = eviction.LRUPolicy()
+    for key in ('a', 'b', 'c'):
+        policy.add(key, 10)
+    policy.touch('a')
+    assert evict_all(policy) == ['b', 'c', 'a']
+
+def test_lfu_policy_order():
+    policy = eviction.LFUPolicy()
+    for key in ('a', 'b', 'c'):
+        policy.add(key, 10)
+    policy.touch('a')
+    policy.touch('a')
+    policy.touch('c')
+    policy.remove('x')
+    assert evict_all(policy) == ['b', 'c', 'a']
+
+def test_gdsf_policy_order():
+    policy = eviction.GDSFPolicy()
+    policy.add('large', 1000)
+    policy.add('small', 10)
+    policy.add('popular', 10)
+    policy.touch('popular')
+    assert evict_all(policy) == ['large', 'small', 'popular']
+
+def test_priority_policy_uses_given_priority():
+    policy = eviction._PriorityPolicy(lambda size, frequency: -size)
+    for key, size in (('small', 10), ('large', 1000), ('medium', 100)):
+        policy.add(key, size)
+    assert evict_all(policy) == ['large', 'medium', 'small']
+
+def test_s3fifo_policy_order():
+    policy = eviction.S3FIFOPolicy()
+    for key in ('a', 'b', 'c', 'd'):
+        policy.add(key, 10)
+    policy.touch('b')
+    assert policy.evict() == 'a'
+    policy.add('a', 10)
+    policy.add('e', 10)
+    assert evict_all(policy) == ['c', 'd', 'e', 'a', 'b']
+
+def test_evictor_evicts_to_low_watermark():
+    removed = []
+    evictor = eviction.Evictor(eviction.LRUPolicy(), 100, 50, lambda key, path, size: removed.append(key))
+    for i in range(4):
+        evictor.add('k%d' % i, '/cache/k%d' % i, 30)
+    evictor.touch('k0')
+    evictor.evict(50)
+    assert removed == ['k1', 'k2', 'k3']
+    assert evictor.size == 30
+    assert evictor.count() == 1
+
+def test_partial_objects_count_towards_eviction():
+    with origin_server() as origin:
+        for name in ('a', 'b', 'c'):
+            origin.objects['/' + name] = ([], name * 10000)
+        with cache_instance(origin.expr, max_disk='25000', memory_size='0') as (port, path):
+            for name in ('a', 'b'):
+                get(port, '/' + name)
+            wait_until(lambda: len(stored_files(path)) == 2)
+            assert get(port, '/c', {'Range' : 'bytes=0-99'})[1] == 'c' * 100
+            wait_until(lambda: 'a' * 10000 not in stored_files(path).values())
+            assert get(port, '/b')[1] == 'b' * 10000
+            assert get(port, '/a')[1] == 'a' * 10000
+            assert origin.requests == ['/a', '/b', '/c', '/a']
+
+def test_objects_missing_from_disk_are_forgotten():
+    for target in (http.Server, event.Server):
+        with origin_server() as origin:
+            origin.objects['/a'] = ([('ETag', '"1"')], 'a' * 10000)
+            with cache_instance(origin.expr, target=target, memory_size='0') as (port, path):
+                get(port, '/a')
+                wait_until(lambda: len(stored_files(path)) == 1)
+                for name in stored_files(path):
+                    os.remove(lib.shard_path(path, name, 2))
+                origin.objects['/a'] = ([('ETag', '"1"'), ('Cache-control', 'no-store')], 'a' * 10000)
+                assert get(port, '/a')[1] == 'a' * 10000
+                response, body = get(port, '/a', {'If-None-Match' : '"1"'})
+                assert (response.status, body) == (200, 'a' * 10000)
+                assert origin.requests == ['/a'] * 3
+
+def test_cache_instance_evicts_past_max_disk():
+    with origin_server() as origin:
+        for name in ('a', 'b', 'c', 'd'):
+            origin.objects['/' + name] = ([], name * 10000)
+        with cache_instance(origin.expr, max_disk='25000', memory_size='0') as (port, path):
+            for name in ('a', 'b', 'c'):
+                get(port, '/' + name)
+            wait_until(lambda: sorted(stored_files(path).values()) == ['b' * 10000, 'c' * 10000])
+            assert get(port, '/b')[1] == 'b' * 10000
+            get(port, '/d')
+            wait_until(lambda: sorted(stored_files(path).values()) == ['b' * 10000, 'd' * 10000])
+            assert get(port, '/a')[1] == 'a' * 10000
+            assert origin.requests == ['/a', '/b', '/c', '/d', '/a']
+
+def test_disk_usage_reconciles_with_directory():
+    with temp_directory() as directory:
+        for name, size in (('a', 10), ('b', 20), ('.a.tmp', 5)):
+            with open(os.path.join(directory, name), 'wb') as f:
+                f.write('x' * size)
+        usage = http.DiskUsage()
+        usage.add(100)
+        assert (usage.size(), usage.count()) == (100, 1)
+        usage.reconcile(directory)
+        assert (usage.size(), usage.count()) == (35, 2)
+        usage.add(-10, -1)
+        assert (usage.size(), usage.count()) == (25, 1)
+        usage.reset()
+        assert (usage.size(), usage.count()) == (0, 0)
+
+def test_object_index_writes_through():
+    with tempfile.NamedTemporaryFile() as seeded:
+        seeded.write('seeded')
+        seeded.flush()
+        database = Database([
+            {'expr' : 'example.com', 'key' : 'a', 'path' : '/cache/a', 'size' : 10},
+            {'expr' : 'example.com', 'key' : 'gone', 'path' : '/cache/gone'},
+            {'expr' : 'other.com', 'key' : 'c', 'path' : '/cache/c', 'size' : 30},
+            {'key' : 's', 'path' : seeded.name}])
+        objects = index.ObjectIndex(Node(database=database), 'example.com')
+        objects.load()
+        assert objects.count() == 2
+        assert objects.get('a') == ('/cache/a', 10, dict())
+        assert objects.get('c') is None and objects.get('gone') is None
+        assert objects.get('s') == (seeded.name, 6, dict())
+        objects.put('d', '/cache/d', 40, {'etag' : '"v1"'})
+        objects.remove('a')
+        writer = threading.Thread(target=objects.run)
+        writer.daemon = True
+        writer.start()
+        stored = [{'expr' : 'example.com', 'key' : 'd', 'path' : '/cache/d', 'size' : 40, 'metadata' : {'etag' : '"v1"'}}]
+        wait_until(lambda: database.lookup({'expr' : 'example.com'}) == stored)
+        objects.clear()
+        wait_until(lambda: database.count({'expr' : 'example.com'}) == 0)
+        assert objects.count() == 1
+        assert objects.get('s') is not None
+        assert database.count({}) == 2
+
+def test_object_index_counts():
+    with tempfile.NamedTemporaryFile() as seeded:
+        seeded.write('seeded')
+        seeded.flush()
+        database = Database([
+            {'expr' : 'example.com', 'key' : 'a', 'path' : '/cache/a', 'size' : 10},
+            {'expr' : 'example.com', 'key' : 'b', 'path' : '/cache/b', 'size' : 20},
+            {'expr' : 'other.com', 'key' : 'c', 'path' : '/cache/c', 'size' : 30},
+            {'key' : 's', 'path' : seeded.name}])
+        objects = index.ObjectIndex(Node(database=database), 'example.com')
+        objects.load()
+        assert objects.loaded
+        assert objects.count() == 3
+        assert objects.stored() == 2
+        objects.put('d', '/cache/d', 40)
+        objects.remove('a')
+        assert objects.stored() == 2
+        objects.clear()
+        assert objects.stored() == 0
+        assert objects.count() == 1
+        assert objects.get('s') == (seeded.name, 6, dict())
+
+def test_shared_object_indexes_count_keys_once():
+    database = Database([{'expr' : 'example.com', 'key' : 'a', 'path' : '/cache/a', 'size' : 10}])
+    keys = bloom.CountingBloomFilter(1000, 0.01)
+    first = index.ObjectIndex(Node(database=database), 'example.com', True, keys)
+    second = index.ObjectIndex(Node(database=database), 'example.com', True, keys)
+    first.load()
+    second.load(False)
+    with tempfile.NamedTemporaryFile() as stored:
+        assert not second.may_find('b')
+        assert second.filtered == 1
+        first.put('b', stored.name, 10)
+        first.put('b', stored.name, 10)
+        database.create({'expr' : 'example.com', 'key' : 'b', 'path' : stored.name, 'size' : 10})
+        assert second.may_find('b')
+        assert second.find('b') == (stored.name, 10, dict())
+        first.remove('b')
+        assert not keys.might_contain('b')
+        second.remove('a', True)
+        assert keys.might_contain('a')
+        first.remove('a')
+        assert not keys.might_contain('a')
+        first.put('c', stored.name, 10)
+        second.clear()
+        assert not keys.might_contain('c')
+
+def headers(**fields):
+    lines = ['%s: %s\r\n' % (name.replace('_', '-'), value) for name, value in fields.items()]
+    return mimetools.Message(StringIO.StringIO(''.join(lines) + '\r\n'))
+
+def test_freshness_lifetime():
+    now = 1000000000
+    date = 'Sun, 09 Sep 2001 01:46:40 GMT'
+    assert freshness.lifetime(headers(cache_control='max-age=60'), 3600, now) == 60
+    assert freshness.lifetime(headers(cache_control='max-age=60, s-maxage=120'), 3600, now) == 120
+    assert freshness.lifetime(headers(cache_control='no-cache, max-age=60'), 3600, now) == 0
+    assert freshness.lifetime(headers(cache_control='max-age=soon'), 3600, now) == 0
+    assert freshness.lifetime(headers(date=date, expires='Sun, 09 Sep 2001 01:56:40 GMT'), 3600, now) == 600
+    assert freshness.lifetime(headers(date=date, expires='0'), 3600, now) == 0
+    assert freshness.lifetime(headers(date=date, last_modified='Sat, 08 Sep 2001 23:46:40 GMT'), 3600, now) == 720
+    assert freshness.lifetime(headers(date=date, last_modified='Sat, 01 Sep 2001 01:46:40 GMT'), 3600, now) == 3600
+    assert freshness.lifetime(headers(), 3600, now) == 3600
+
+def test_freshness_metadata():
+    now = 1000000000
+    metadata = freshness.metadata(headers(cache_control='max-age=60', age='20', etag='"v1"'), 3600, now=now)
+    assert metadata['expires'] == now + 40
+    assert metadata['date'] == now - 20
+    assert metadata['etag'] == '"v1"'
+    assert freshness.age(metadata, now + 5) == 25
+    assert freshness.is_fresh(metadata, now + 39)
+    assert not freshness.is_fresh(metadata, now + 40)
+    assert freshness.is_fresh(dict(), now)
+    revalidated = freshness.metadata(headers(cache_control='max-age=60'), 3600, previous=metadata, now=now + 60)
+    assert revalidated['etag'] == '"v1"'
+    assert revalidated['expires'] == now + 120
+    assert freshness.not_modified('W/"v1", "v2"', None, revalidated)
+    assert not freshness.not_modified('"v3"', None, revalidated)
+
+def test_stale_objects_revalidated():
+    for target in (http.Server, event.Server):
+        with origin_server() as origin:
+            origin.objects['/object'] = ([('ETag', '"v1"'), ('Cache-Control', 'max-age=1')], 'object')
+            origin.objects['/private'] = ([('Cache-Control', 'private')], 'private')
+            with cache_instance(origin.expr, target=target) as (port, path):
+                assert get(port, '/object')[1] == 'object'
+                wait_until(lambda: len(stored_files(path)) == 1)
+                assert get(port, '/object')[1] == 'object'
+                response, body = get(port, '/object', {'If-None-Match' : '"v1"'})
+                assert (response.status, body) == (304, '')
+                assert origin.requests == ['/object']
+                time.sleep(1.1)
+                origin.delay = 0.5
+                bodies = []
+                clients = [threading.Thread(target=lambda: bodies.append(get(port, '/object')[1])) for i in range(4)]
+                for client in clients:
+                    client.start()
+                for client in clients:
+                    client.join()
+                origin.delay = 0
+                assert bodies == ['object'] * 4
+                assert origin.requests == ['/object', '/object']
+                assert get(port, '/private')[1] == 'private'
+                assert get(port, '/private')[1] == 'private'
+                assert origin.requests[2:] == ['/private', '/private']
+                assert len(stored_files(path)) == 1
+
+def test_origin_headers_replayed_on_hits():
+    stored_headers = [('Content-Type', 'application/json'), ('Content-Language', 'en'), ('ETag', '"v1"'),
+        ('Cache-Control', 'max-age=600')]
+    for target in (http.Server, event.Server):
+        with origin_server() as origin:
+            origin.objects['/object'] = (stored_headers + [('X-Origin', 'dropped')], '{}')
+            with cache_instance(origin.expr, target=target) as (port, path):
+                for i in range(3):
+                    response, body = get(port, '/object')
+                    assert body == '{}'
+                    for name, value in stored_headers:
+                        assert response.getheader(name) == value
+                    assert response.getheader('x-origin') is None
+                    wait_until(lambda: len(stored_files(path)) == 1)
+                response, body = get(port, '/object', {'If-None-Match' : '"v1"'})
+                assert (response.status, response.getheader('etag'), response.getheader('content-type')) == (304, '"v1"', None)
+                time.sleep(1)
+                assert int(get(port, '/object')[0].getheader('age')) >= 1
+                assert origin.requests == ['/object']
+
+def test_accepts_encoding():
+    assert compression.accepts('gzip, deflate', 'gzip')
+    assert compression.accepts('x-gzip', 'gzip')
+    assert compression.accepts('deflate, *', 'gzip')
+    assert not compression.accepts('gzip;q=0', 'gzip')
+    assert not compression.accepts('*;q=0', 'gzip')
+    assert not compression.accepts('gzip;q=0, *', 'gzip')
+    assert not compression.accepts('deflate', 'gzip')
+    assert not compression.accepts(None, 'gzip')
+
+def test_compress_file():
+    compressor = compression.Compressor('gzip', 'text/, application/json', 6)
+    assert compressor.compressible([('Content-type', 'text/css; charset=utf-8')])
+    assert compressor.compressible([('Content-type', 'application/json')])
+    assert not compressor.compressible([('Content-type', 'image/png')])
+    assert not compressor.compressible([('Content-type', 'text/plain'), ('Content-encoding', 'br')])
+    with temp_directory() as directory:
+        path = os.path.join(directory, 'object')
+        data = '{"key" : "value"}\n' * 1000
+        with open(path, 'wb') as f:
+            f.write(data)
+        compressed_path = compressor.compress_file(path)
+        assert os.path.getsize(compressed_path) < len(data)
+        with open(compressed_path, 'rb') as f:
+            assert compression.decompress(f.read(), 'gzip') == data
+        with open(compressed_path, 'rb') as f:
+            assert ''.join(compression.decompress_chunks(f, 'gzip')) == data
+        with open(path, 'wb') as f:
+            f.write(os.urandom(1000))
+        assert compressor.compress_file(path) is None
+        assert sorted(os.listdir(directory)) == sorted(['object', os.path.basename(compressed_path)])
+
+def test_compressed_objects_served_by_accept_encoding():
+    data = '{"key" : "value"}\n' * 10000
+    for target in (http.Server, event.Server):
+        with origin_server() as origin:
+            origin.objects['/object'] = ([('Content-Type', 'application/json')], data)
+            with cache_instance(origin.expr, target=target, compression='gzip', memory_size='0') as (port, path):
+                assert get(port, '/object')[1] == data
+                wait_until(lambda: len(stored_files(path)) == 1)
+                assert len(stored_files(path).values()[0]) < len(data) / 10
+                response, body = get(port, '/object', {'Accept-Encoding' : 'gzip'})
+                assert response.getheader('content-encoding') == 'gzip'
+                assert compression.decompress(body, 'gzip') == data
+                response, body = get(port, '/object')
+                assert (response.getheader('content-encoding'), body) == (None, data)
+                response, body = get(port, '/object', {'Range' : 'bytes=5-14'})
+                assert (response.status, body) == (206, data[5:15])
+                assert origin.requests == ['/object']
+
+def test_objects_stored_in_sharded_directories():
+    with origin_server() as origin:
+        origin.objects['/object'] = ([], 'object')
+        with cache_instance(origin.expr) as (port, path):
+            get(port, '/object')
+            key = hashlib.sha224('/object').hexdigest()
+            wait_until(lambda: os.path.exists(os.path.join(path, key[:2], key[2:4], key)))
+            assert get(port, '/object')[1] == 'object'
+            assert origin.requests == ['/object']
+
+def test_segment_store():
+    with temp_directory() as directory:
+        usage = http.DiskUsage()
+        relocated = []
+        store = segment.SegmentStore(directory, 100, 40, 0.5, usage, lambda *args: relocated.append(args))
+        assert store.admits(40)
+        assert not store.admits(41)
+        assert not store.admits(0)
+        first = [store.append(key, key * 30) for key in ('a', 'b', 'c')]
+        path, offset = store.append('d', 'd' * 30)
+        assert [placed[1] for placed in first] == [0, 30, 60]
+        assert first[0][0] != path and store.holds(path)
+        assert store.read(path, offset, 30) == 'd' * 30
+        assert usage.size() == 200
+        store.remove('a')
+        store.remove('b')
+        store.compact()
+        assert relocated == [('c', first[2][0], path, 30)]
+        assert store.read(path, 30, 30) == 'c' * 30
+        assert not os.path.exists(first[0][0])
+        assert usage.size() == 100
+        assert store.count() == 2
+        try:
+            store.read(first[0][0], 60, 30)
+            assert False
+        except IOError:
+            pass
+        store.clear()
+        open(os.path.join(directory, '7.seg'), 'w').close()
+        reloaded = segment.SegmentStore(directory, 100, 40, 0.5)
+        reloaded.load([('c', path, 30, 30), ('d', path, 0, 30)])
+        assert reloaded.count() == 2
+        assert reloaded.read(path, 30, 30) == 'c' * 30
+        assert os.listdir(directory) == [os.path.basename(path)]
+        assert reloaded.append('e', 'e' * 10)[0] == os.path.join(directory, '8.seg')
+        reloaded.clear()
+
+def test_small_objects_stored_in_segments():
+    with origin_server() as origin:
+        for name in ('a', 'b', 'c'):
+            origin.objects['/' + name] = ([], name * 100)
+        origin.objects['/large'] = ([], 'l' * 5000)
+        with cache_instance(origin.expr, segment_store='true', segment_size='4096', segment_object_size='1024',
+                memory_size='0') as (port, path):
+            for name in ('a', 'b', 'c', 'large'):
+                get(port, '/' + name)
+            wait_until(lambda: len(stored_files(path)) == 2)
+            assert sorted(stored_files(path)) == ['0.seg', hashlib.sha224('/large').hexdigest()]
+            for name in ('a', 'b', 'c'):
+                assert get(port, '/' + name)[1] == name * 100
+            assert len(origin.requests) == 4
+
+def test_workers_share_port_and_objects():
+    with origin_server() as origin:
+        for i in range(8):
+            origin.objects['/%d' % i] = ([], str(i) * 1000)
+        with cache_instance(origin.expr, workers=2) as (port, path):
+            time.sleep(1)
+            for i in range(8):
+                assert get(port, '/%d' % i)[1] == str(i) * 1000
+            wait_until(lambda: len(stored_files(path)) == 8)
+            time.sleep(0.5)
+            for i in range(8):
+                assert get(port, '/%d' % i)[1] == str(i) * 1000
+            assert sorted(origin.requests) == ['/%d' % i for i in range(8)]
+
+def test_workers_use_neither_segments_nor_memory():
+    with origin_server() as origin:
+        for i in range(8):
+            origin.objects['/%d' % i] = ([], str(i) * 100)
+        with cache_instance(origin.expr, workers=2, segment_store='true', segment_object_size='1024') as (port, path):
+            time.sleep(1)
+            for i in range(8):
+                get(port, '/%d' % i)
+            wait_until(lambda: len(stored_files(path)) == 8)
+            assert sorted(stored_files(path)) == sorted(hashlib.sha224('/%d' % i).hexdigest() for i in range(8))
+            assert not os.path.exists(os.path.join(path, 'segments'))
+            for i in range(8):
+                assert get(port, '/%d' % i)[1] == str(i) * 100
+            for root, directories, files in os.walk(path):
+                for name in files:
+                    os.remove(os.path.join(root, name))
+            for i in range(8):
+                origin.objects['/%d' % i] = ([], 'changed')
+            for i in range(8):
+                assert get(port, '/%d' % i)[1] == 'changed'
+
+def test_multiplexer_routes_by_host():
+    with origin_server() as first, origin_server() as second:
+        first.objects['/object'] = ([], 'first')
+        second.objects['/object'] = ([], 'second')
+        second.objects['/media/object'] = ([], 'media')
+        with temp_directory() as directory:
+            port = free_port()
+            messages = multiprocessing.Queue()
+            process = multiprocessing.Process(target=Multiplexer, args=(Node(directory + '/'), port, messages))
+            process.daemon = True
+            process.start()
+            try:
+                wait_for_port(port)
+                for origin in (first, second):
+                    messages.put('%s create ? ?' % origin.expr)
+                for origin, body in ((first, 'first'), (second, 'second')):
+                    wait_until(lambda: get(port, '/object', {'Host' : origin.expr})[0].status == 200)
+                    assert get(port, '/object', {'Host' : origin.expr})[1] == body
+                assert get(port, '/object', {'Host' : 'example.com'})[0].status == 404
+                connection = httplib.HTTPConnection('127.0.0.1', port, timeout=10)
+                for origin, body in ((first, 'first'), (second, 'second'), (first, 'first')):
+                    assert get(port, '/object', {'Host' : origin.expr}, connection)[1] == body
+                response, body = get(port, '/object', {'Host' : 'example.com'}, connection)
+                assert response.status == 404 and response.getheader('Connection') == 'close'
+                connection.close()
+                messages.put('%s pause ? ?' % first.expr)
+                wait_until(lambda: get(port, '/object', {'Host' : first.expr})[0].status == 404)
+                assert get(port, '/object', {'Host' : second.expr})[1] == 'second'
+                messages.put('%s create ? ?' % first.expr)
+                wait_until(lambda: get(port, '/object', {'Host' : first.expr})[0].status == 200)
+                assert (first.requests, second.requests) == (['/object'], ['/object'])
+                messages.put('%s stop ? ?' % second.expr)
+                wait_until(lambda: get(port, '/object', {'Host' : second.expr})[0].status == 404)
+                messages.put('%s create /media ?' % second.expr)
+                wait_until(lambda: get(port, '/media/object', {'Host' : second.expr})[0].status == 200)
+                assert get(port, '/object', {'Host' : second.expr})[0].status == 404
+                assert get(port, '/mediaobject', {'Host' : second.expr})[0].status == 404
+                assert second.requests == ['/object', '/media/object']
+                threads = len(os.listdir('/proc/%d/task' % process.pid))
+                for i in range(5):
+                    messages.put('%s stop ? ?' % second.expr)
+                    wait_until(lambda: get(port, '/media/object', {'Host' : second.expr})[0].status == 404)
+                    messages.put('%s create /media ?' % second.expr)
+                    wait_until(lambda: get(port, '/media/object', {'Host' : second.expr})[0].status == 200)
+                assert len(os.listdir('/proc/%d/task' % process.pid)) < threads + 5
+            finally:
+                process.terminate()
+                process.join()
+
+def test_routed_server_has_no_socket_or_workers():
+    descriptors = len(os.listdir('/proc/self/fd'))
+    threads = threading.active_count()
+    server = multiplex.RoutedHTTPServer(None, 'example.com')
+    assert len(os.listdir('/proc/self/fd')) == descriptors
+    assert threading.active_count() == threads
+    assert not hasattr(server, 'socket')
+    assert server.get_worker_stats() == dict()
+
+def test_counting_bloom_filter():
+    keys = bloom.CountingBloomFilter(1000, 0.01)
+    assert keys.size > 1000
+    assert keys.hashes > 1
+    assert not keys.might_contain('a')
+    keys.add('a')
+    keys.add('a')
+    keys.add('b')
+    assert keys.might_contain('a')
+    assert keys.might_contain('b')
+    keys.remove('a')
+    assert keys.might_contain('a')
+    keys.remove('a')
+    assert not keys.might_contain('a')
+    assert keys.might_contain('b')
+    keys.remove('b')
+    assert keys.false_positive_rate() == 0.0
+
+def test_counting_bloom_filter_false_positives():
+    keys = bloom.CountingBloomFilter(1000, 0.01)
+    for i in range(1000):
+        keys.add('held-%d' % i)
+    assert all(keys.might_contain('held-%d' % i) for i in range(1000))
+    false_positives = sum(1 for i in range(10000) if keys.might_contain('missing-%d' % i))
+    assert false_positives < 300
+    assert 0.001 < keys.false_positive_rate() < 0.03
+
+def test_notifier_batches_stats_and_alerts():
+    notifier = notify.Notifier(Node(controller_host='127.0.0.1', notification_port='49999'), 10, 5, 60)
+    sent = []
+    notifier._send = sent.append
+    notifier.send({'method' : 'redirect', 'id' : None, 'params' : {'expr' : 'a'}})
+    assert len(sent) == 1
+    for load in (1, 2):
+        notifier.send({'method' : 'stat', 'id' : None, 'params' : {'expr' : 'a', 'load' : load}})
+    for value in (5, 9, 7):
+        notifier.send({'method' : 'alert', 'id' : None, 'params' : {'expr' : 'a', 'type' : 'load', 'value' : value}})
+    notifier.flush()
+    assert len(sent) == 2
+    batch = sent[1]
+    assert batch['method'] == 'batch'
+    stat, alert = sorted(batch['params']['messages'], key=lambda message: message['method'], reverse=True)
+    assert stat['params']['load'] == 2
+    assert alert['params']['count'] == 3
+    assert alert['params']['max'] == 9
+    assert alert['params']['value'] == 7
+    notifier.send({'method' : 'alert', 'id' : None, 'params' : {'expr' : 'a', 'type' : 'load', 'value' : 4}})
+    notifier.flush()
+    assert len(sent) == 2
+    notifier.send({'method' : 'stat', 'id' : None, 'params' : {'expr' : 'a', 'load' : 3}})
+    notifier.flush()
+    assert sent[2]['method'] == 'stat'
+    assert notifier.suppressed == 2
+    notifier.close()
+
+def test_render_metrics():
+    histogram = lib.LatencyHistogram()
+    histogram.record(0.002)
+    histogram.record(0.3)
+    snapshot = {'expr' : 'example.com', 'status' : 'start', 'load' : 4, 'workers' : 1, 'cache_object' : 2,
+        'cache_object_size' : 300, 'counters' : {'cache_hit' : 5}, 'latency' : {'hit_total' : histogram.to_dict()}}
+    lines = metrics.render([snapshot]).splitlines()
+    assert '# TYPE opencache_cache_hits_total counter' in lines
+    assert 'opencache_cache_hits_total{expr="example.com"} 5' in lines
+    assert 'opencache_cache_misses_total{expr="example.com"} 0' in lines
+    assert 'opencache_key_filter_skipped_total{expr="example.com"} 0' in lines
+    assert 'opencache_load{expr="example.com"} 4' in lines
+    assert 'opencache_disk_bytes{expr="example.com"} 300' in lines
+    assert 'opencache_status{expr="example.com",status="start"} 1' in lines
+    assert '# TYPE opencache_request_duration_seconds histogram' in lines
+    bucket = 'opencache_request_duration_seconds_bucket{expr="example.com",le="%s",phase="total",result="hit"} %d'
+    assert bucket % ('0.001', 0) in lines
+    assert bucket % ('0.0025', 1) in lines
+    assert bucket % ('0.5', 2) in lines
+    assert bucket % ('+Inf', 2) in lines
+    assert 'opencache_request_duration_seconds_count{expr="example.com",phase="total",result="hit"} 2' in lines
+    assert 'opencache_origin_latency_seconds_count{expr="example.com"} 0' in lines
+
+def test_render_metrics_escapes_labels():
+    snapshot = {'expr' : 'a"b\\c', 'status' : 'stop', 'counters' : dict(), 'latency' : dict()}
+    assert 'opencache_status{expr="a\\"b\\\\c",status="stop"} 1' in metrics.render([snapshot]).splitlines()
+
+def test_disk_usage_shared_between_processes():
+    usage = http.DiskUsage(True)
+    usage.add(10)
+    process = multiprocessing.Process(target=usage.add, args=(32, 2))
+    process.start()
+    process.join()
+    assert (usage.size(), usage.count()) == (42, 3)
+
+def test_persistent_connections_closed_on_pause():
+    for target in (ControlledServer, ControlledEventServer):
+        with origin_server() as origin:
+            origin.objects['/object'] = ([], 'object')
+            messages = multiprocessing.Queue()
+            with cache_instance(origin.expr, target=target, messages=messages) as (port, path):
+                connection = httplib.HTTPConnection('127.0.0.1', port, timeout=10)
+                assert get(port, '/object', connection=connection)[1] == 'object'
+                messages.put('%s pause ? ?' % origin.expr)
+                assert connection.sock.recv(1) == ''
+                messages.put('%s start ? ?' % origin.expr)
+                wait_until(lambda: get(port, '/object')[1] == 'object')
+
+def test_cache_hit_size_counts_bytes_sent():
+    for target in (ControlledServer, ControlledEventServer):
+        with origin_server() as origin:
+            origin.objects['/small'] = ([], 's' * 1000)
+            origin.objects['/large'] = ([], 'l' * 16000000)
+            messages = multiprocessing.Queue()
+            reports = multiprocessing.Queue()
+            with cache_instance(origin.expr, target=target, messages=messages, reports=reports,
+                    memory_object_size='2000') as (port, path):
+                def counters():
+                    messages.put('%s report ? ?' % origin.expr)
+                    return reports.get(timeout=10)
+                get(port, '/small')
+                get(port, '/large')
+                wait_until(lambda: len(stored_files(path)) == 2)
+                assert get(port, '/small')[1] == 's' * 1000
+                assert get(port, '/small')[1] == 's' * 1000
+                assert get(port, '/small', {'Range' : 'bytes=0-99'})[1] == 's' * 100
+                assert len(get(port, '/large')[1]) == 16000000
+                wait_until(lambda: counters()['cache_hit_size'] == 16002100)
+                client = socket.socket()
+                client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+                client.connect(('127.0.0.1', port))
+                client.sendall('GET /large HTTP/1.1\r\nHost: localhost\r\n\r\n')
+                client.recv(4096)
+                client.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+                client.close()
+                wait_until(lambda: counters()['cache_hit'] == 5)
+                time.sleep(0.5)
+                assert 16002100 <= counters()['cache_hit_size'] < 32002100